@@ -0,0 +1,390 @@
+import argparse
+import json
+import os
+import platform
+import shlex
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_BLENDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub', 'blender')
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def build_tree(depth, fanout):
+
+    # Nodes are numbered breadth first, each with the index of its parent and its depth in the tree.
+    nodes = [(None, 0)]
+    for node, (parent, node_depth) in enumerate(nodes):
+        if node_depth < depth:
+            nodes += [(node, node_depth + 1)] * fanout
+
+    return nodes
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), 0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+
+    sys.exit(f"Server on port {port} did not start within {timeout} seconds, exiting.")
+
+
+def peak_memory(pid):
+
+    # The high water mark of the resident memory of a process, only available on Linux.
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1000
+    except FileNotFoundError:
+        pass
+
+    return None
+
+
+def start_servers(nodes, ports, bench_dir, stub_env):
+    servers = []
+    for node, (parent, depth) in enumerate(nodes):
+        node_env = dict(stub_env, BRPY_STUB_SPEED=str(speeds[node % len(speeds)]))
+        children = [f"127.0.0.1 {ports[child]}" for child, (child_parent, child_depth) in enumerate(nodes) if child_parent == node]
+
+        command = [sys.executable, os.path.join(PACKAGE_DIR, 'brpy_server.py'), os.path.join(bench_dir, f"node{node}"), STUB_BLENDER, '-p', str(ports[node])]
+        command += ['-l', str(args.local_workers)] + shlex.split(args.server_args)
+        if len(children) > 0:
+            command += ['--children', ', '.join(children)]
+
+        with open(os.path.join(bench_dir, f"node{node}.log"), 'w') as log:
+            servers.append(subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=node_env, start_new_session=True))    # A session of its own,
+                                                                                                                                     # so its workers are stopped along with it.
+    for port in ports:
+        wait_for_port(port)
+
+    return servers
+
+
+def stop_servers(servers):
+    for server in servers:
+        try:
+            os.killpg(server.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    for server in servers:
+        server.wait()
+
+
+def run_client(command, log_path):
+
+    # The client is waited for with wait4, which also reports the peak resident memory of the process.
+    with open(log_path, 'w') as log:
+        client = subprocess.Popen([sys.executable, os.path.join(PACKAGE_DIR, 'brpy_client.py')] + command, stdout=log, stderr=subprocess.STDOUT)
+
+    start = time.perf_counter()
+    pid, status, usage = os.wait4(client.pid, 0)
+    duration = time.perf_counter() - start
+
+    client.returncode = os.waitstatus_to_exitcode(status)
+
+    return duration, usage.ru_maxrss / 1000, client.returncode
+
+
+def run_benchmark(run, bench_dir, stub_env):
+    run_dir = os.path.join(bench_dir, f"run{run}")
+    os.makedirs(run_dir)
+
+    nodes = build_tree(args.depth, args.fanout)
+    ports = [free_port() for node in nodes]
+
+    server_list = os.path.join(run_dir, 'servers.txt')
+    with open(server_list, 'w') as file:
+        file.write(f"127.0.0.1 {ports[0]}\n")
+
+    servers = start_servers(nodes, ports, run_dir, stub_env)
+    try:
+        upload_time, upload_memory, upload_status = run_client(
+            ['UPLOAD', server_list, 'benchmark', blend_file],
+            os.path.join(run_dir, 'upload.log')
+        )
+
+        render_time, render_memory, render_status = run_client(
+            ['RENDER', server_list, 'benchmark', os.path.join(run_dir, 'frames'), '1', str(args.frames)] + shlex.split(args.client_args),
+            os.path.join(run_dir, 'render.log')
+        )
+
+        server_memory = [peak_memory(server.pid) for server in servers]
+    finally:
+        stop_servers(servers)
+
+
+    # Without overhead, every render slot of the tree would render its share of the frames back to back,
+    # a share as large as the speed of its server.
+    render_slots = sum(speeds[node % len(speeds)] for node in range(len(nodes))) * args.local_workers
+    frames_dir = os.path.join(run_dir, 'frames')
+    frames_rendered = len([name for name in os.listdir(frames_dir) if not name.startswith('.')]) if os.path.isdir(frames_dir) else 0    # Skips the manifest.
+
+    relays = [memory for node, memory in enumerate(server_memory) if node > 0 and any(parent == node for parent, depth in nodes)]
+    leaves = [memory for node, memory in enumerate(server_memory) if node > 0 and not any(parent == node for parent, depth in nodes)]
+
+    return {
+        'upload': {
+            'succeeded': upload_status == 0,
+            'seconds': upload_time,
+            'megabytes_per_second': args.blend_size / upload_time
+        },
+        'render': {
+            'succeeded': render_status == 0 and frames_rendered == args.frames,
+            'frames_rendered': frames_rendered,
+            'seconds': render_time,
+            'frames_per_second': frames_rendered / render_time,
+            'overhead_per_frame': render_time * render_slots / args.frames - args.render_time
+        },
+        'peak_memory_megabytes': {
+            'client_upload': upload_memory,
+            'client_render': render_memory,
+            'root': server_memory[0],
+            'relays': max(relays, default=None, key=lambda memory: memory or 0),
+            'leaves': max(leaves, default=None, key=lambda memory: memory or 0)
+        }
+    }
+
+
+def summarize(runs):
+
+    # The median of every number over all runs, which is less affected by an outlier than the mean.
+    summary = {}
+    for section in runs[0]:
+        summary[section] = {}
+        for key, value in runs[0][section].items():
+            values = [run[section][key] for run in runs if run[section][key] != None]
+            if type(value) == bool:
+                summary[section][key] = all(values)
+            elif len(values) > 0:
+                summary[section][key] = statistics.median(values)
+            else:
+                summary[section][key] = None
+
+    return summary
+
+
+# Start of benchmark program.
+
+# Start of argument parsing.
+parser = argparse.ArgumentParser(
+    description="Benchmark a tree of BRP servers on the loopback interface, rendering synthetic frames with a stub of Blender.",
+    formatter_class=argparse.RawTextHelpFormatter
+)
+
+parser.add_argument(
+    '-d', '--depth',
+    metavar='depth',
+    type=int,
+    default=1,
+    help="""the depth of the tree of servers below the root the client connects to
+a depth of 0 benchmarks a single server\n\n"""
+)
+
+parser.add_argument(
+    '-f', '--fanout',
+    metavar='fanout',
+    type=int,
+    default=2,
+    help="the number of children of every server above the lowest level of the tree\n\n"
+)
+
+parser.add_argument(
+    '-l', '--local-workers',
+    metavar='local-workers',
+    type=int,
+    default=1,
+    help="the number of frames rendered at the same time on every server\n\n"
+)
+
+parser.add_argument(
+    '-n', '--frames',
+    metavar='frames',
+    type=int,
+    default=200,
+    help="the number of frames rendered\n\n"
+)
+
+parser.add_argument(
+    '--frame-size',
+    metavar='bytes',
+    type=int,
+    default=1000000,
+    help="the size of every frame in bytes\n\n"
+)
+
+parser.add_argument(
+    '--render-time',
+    metavar='seconds',
+    type=float,
+    default=0,
+    help="""the mean time it takes to render a frame
+with the default of 0, only the overhead of the protocol and scheduling is measured\n\n"""
+)
+
+parser.add_argument(
+    '--render-distribution',
+    choices=('fixed', 'uniform', 'exponential', 'lognormal'),
+    default='fixed',
+    help="how render times are distributed around their mean\n\n"
+)
+
+parser.add_argument(
+    '--render-spread',
+    metavar='spread',
+    type=float,
+    default=0.5,
+    help="""the spread of render times
+a fraction of the mean for uniform and sigma for lognormal distributions\n\n"""
+)
+
+parser.add_argument(
+    '--per-frame',
+    action='store_true',
+    help="""draw the render time of every frame once, so a frame is equally heavy in every run
+and on every server, like the frames of an animation\n\n"""
+)
+
+parser.add_argument(
+    '--speeds',
+    metavar='speeds',
+    default='1',
+    help="""the comma-separated speeds of the servers, a speed of 2 halves every render time
+given in the breadth-first order of the tree, starting over for servers beyond the list\n\n"""
+)
+
+parser.add_argument(
+    '--failure-rate',
+    metavar='rate',
+    type=float,
+    default=0,
+    help="the probability of a worker crashing while rendering a frame\n\n"
+)
+
+parser.add_argument(
+    '--blend-size',
+    metavar='megabytes',
+    type=float,
+    default=50,
+    help="the size of the uploaded .blend file in megabytes\n\n"
+)
+
+parser.add_argument(
+    '--client-args',
+    metavar='arguments',
+    default='',
+    help="""further arguments passed on to the client when rendering, like "-S -T 4"\n\n"""
+)
+
+parser.add_argument(
+    '--server-args',
+    metavar='arguments',
+    default='',
+    help="""further arguments passed on to every server, like "--background-save -w 2"\n\n"""
+)
+
+parser.add_argument(
+    '-r', '--repeat',
+    metavar='runs',
+    type=int,
+    default=1,
+    help="""the number of times the benchmark is run
+the summary gives the median of every result over all runs\n\n"""
+)
+
+parser.add_argument(
+    '-o', '--output',
+    metavar='output-file',
+    help="""the file the results are written to as JSON
+if omitted, the results are written to the standard output\n\n"""
+)
+
+parser.add_argument(
+    '--keep',
+    action='store_true',
+    help="keep the working directories and logs of the servers and the client\n\n"
+)
+
+
+args = parser.parse_args()
+
+if args.depth < 0 or args.fanout < 1 or args.local_workers < 1 or args.frames < 1 or args.repeat < 1:
+    sys.exit("The depth must not be negative, the fanout, local workers, frames and runs must be positive. Exiting.")
+
+try:
+    speeds = [float(speed) for speed in args.speeds.split(',')]
+except ValueError:
+    sys.exit(f"The speeds '{args.speeds}' are not a comma-separated list of numbers, exiting.")
+
+if min(speeds) <= 0:
+    sys.exit("The speeds of the servers must be positive. Exiting.")
+
+
+bench_dir = tempfile.mkdtemp(prefix='brpy_benchmark_')
+
+stub_env = dict(
+    os.environ,
+    BRPY_STUB_FRAME_SIZE=str(args.frame_size),
+    BRPY_STUB_RENDER_TIME=str(args.render_time),
+    BRPY_STUB_RENDER_DISTRIBUTION=args.render_distribution,
+    BRPY_STUB_RENDER_SPREAD=str(args.render_spread),
+    BRPY_STUB_FAILURE_RATE=str(args.failure_rate),
+    BRPY_STUB_PER_FRAME='1' if args.per_frame else '0'
+)
+
+blend_file = os.path.join(bench_dir, 'benchmark.blend')
+with open(blend_file, 'wb') as file:
+    for megabyte in range(int(args.blend_size)):
+        file.write(os.urandom(1000000))
+    file.write(os.urandom(int(args.blend_size % 1 * 1000000)))
+
+
+try:
+    runs = []
+    for run in range(args.repeat):
+        runs.append(run_benchmark(run, bench_dir, stub_env))
+        print(f"Finished run {run + 1} of {args.repeat}.", file=sys.stderr)
+finally:
+    if args.keep:
+        print(f"Kept working directories and logs in '{bench_dir}'.", file=sys.stderr)
+    else:
+        shutil.rmtree(bench_dir)
+
+
+results = {
+    'configuration': {key: value for key, value in vars(args).items() if key not in ('output', 'keep')},
+    'environment': {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    },
+    'summary': summarize(runs),
+    'runs': runs
+}
+
+if args.output == None:
+    print(json.dumps(results, indent=4))
+else:
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=4)
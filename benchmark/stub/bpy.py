@@ -0,0 +1,106 @@
+import os
+import random
+import time
+import types
+
+
+# A stub of the parts of the Blender API used by brpy_render.py, rendering synthetic frames configured by environment variables:
+#
+#     BRPY_STUB_FRAME_SIZE           the size of every frame in bytes
+#     BRPY_STUB_RENDER_TIME          the mean time it takes to render a frame in seconds
+#     BRPY_STUB_RENDER_DISTRIBUTION  how render times are distributed: fixed, uniform, exponential or lognormal
+#     BRPY_STUB_RENDER_SPREAD        the spread of render times, as a fraction of the mean for uniform and as sigma for lognormal
+#     BRPY_STUB_FAILURE_RATE         the probability of the stub crashing while rendering a frame, like Blender running out of memory
+#     BRPY_STUB_LOAD_TIME            the time it takes to load a .blend file in seconds
+#     BRPY_STUB_PER_FRAME            if set to 1, the render time of every frame is drawn once, so it is the same in every render
+#     BRPY_STUB_SPEED                how fast this server renders, a speed of 2 halves every render time
+#
+# Render times scale with the samples set for Cycles, so a frame rendered with a part of its samples is quicker.
+
+FRAME_SIZE = int(os.environ.get('BRPY_STUB_FRAME_SIZE', 1000000))
+RENDER_TIME = float(os.environ.get('BRPY_STUB_RENDER_TIME', 0))
+RENDER_DISTRIBUTION = os.environ.get('BRPY_STUB_RENDER_DISTRIBUTION', 'fixed')
+RENDER_SPREAD = float(os.environ.get('BRPY_STUB_RENDER_SPREAD', 0.5))
+FAILURE_RATE = float(os.environ.get('BRPY_STUB_FAILURE_RATE', 0))
+LOAD_TIME = float(os.environ.get('BRPY_STUB_LOAD_TIME', 0))
+PER_FRAME = os.environ.get('BRPY_STUB_PER_FRAME') == '1'
+SPEED = float(os.environ.get('BRPY_STUB_SPEED', 1))
+
+FILE_SAMPLES = 128
+
+
+frame_data = os.urandom(FRAME_SIZE)    # Every frame has the same content, generating it for each frame would dominate the benchmark.
+
+
+def render_time():
+    generator = random.Random(context.scene.frame_current) if PER_FRAME else random
+    scale = context.scene.cycles.samples / FILE_SAMPLES / SPEED
+
+    if RENDER_DISTRIBUTION == 'uniform':
+        return scale * generator.uniform(RENDER_TIME * (1 - RENDER_SPREAD), RENDER_TIME * (1 + RENDER_SPREAD))
+    if RENDER_DISTRIBUTION == 'exponential':
+        return scale * generator.expovariate(1 / RENDER_TIME) if RENDER_TIME > 0 else 0
+    if RENDER_DISTRIBUTION == 'lognormal':
+
+        # Scaled so the mean stays the configured render time, heavy frames then make up the long tail.
+        return scale * RENDER_TIME * generator.lognormvariate(-RENDER_SPREAD ** 2 / 2, RENDER_SPREAD)
+
+    return scale * RENDER_TIME
+
+
+class Settings(types.SimpleNamespace):
+    pass
+
+
+class RenderSettings(Settings):
+    @property
+    def file_extension(self):
+        return '.exr' if self.image_settings.file_format.startswith('OPEN_EXR') else '.png'
+
+
+def open_mainfile(filepath):
+    if not os.path.exists(filepath):
+        raise RuntimeError(f"Cannot read file '{filepath}'.")
+
+    time.sleep(LOAD_TIME)
+
+
+def render(write_still=False):
+    duration = render_time()
+
+    if random.random() < FAILURE_RATE:
+        time.sleep(random.uniform(0, duration))
+        os._exit(1)
+
+    time.sleep(duration)
+
+    if write_still:
+        save_render(context.scene.render.filepath + context.scene.render.file_extension)
+
+
+def save_render(filepath, scene=None):
+    with open(filepath, 'wb') as file:
+        file.write(frame_data)
+
+
+context = Settings(
+    scene=Settings(
+        render=RenderSettings(
+            filepath='',
+            compositor_device='CPU',
+            threads_mode='AUTO',
+            use_border=False,
+            use_crop_to_border=False,
+            border_min_x=0.0,
+            border_max_x=1.0,
+            border_min_y=0.0,
+            border_max_y=1.0,
+            image_settings=Settings(file_format='PNG', exr_codec='ZIP')
+        ),
+        cycles=Settings(device='CPU', denoising_use_gpu=False, samples=FILE_SAMPLES, seed=0, use_denoising=True),
+        frame_current=1
+    )
+)
+
+data = Settings(images={'Render Result': Settings(save_render=save_render)})
+ops = Settings(wm=Settings(open_mainfile=open_mainfile), render=Settings(render=render))
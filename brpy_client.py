@@ -1,174 +1,819 @@
 import argparse
-import json
+import asyncio
 import os
 import socket
 import sys
-import threading
 import time
 
-from brpy_lib import receive_bytes, SessionRequest, RenderRequest, UploadRequest
+from brpy_delta import compute_delta
+from brpy_exr import average_exr, stitch_exr, ExrFormatError
+from brpy_lib import receive_message, send_message, encode_message, negotiate_protocol, format_stats, hash_file, stream_chunks, parse_codecs, ConnectionBrokenError, JSON_PROTOCOL, CHUNK_SIZE, CODECS, Compressor, FrameQueue, FrameWriter, Upload, SessionRequest, StatsRequest, RenderRequest, UploadRequest, CancelRequest
 
 
-def request_frame(connection, frames, awaited_frames, send_lock, server_prefix):
-    print(f"{server_prefix} Sending request to render frame {frames}.")
-    request_header = json.dumps(RenderRequest(args.session, frames, args.render_format).__dict__).encode()
+MANIFEST = '.brpy_manifest'    # Lists the frames in the output directory that have been completely written.
+COSTS = '.brpy_costs'          # Lists how heavy the frames of each session rendered to the output directory have been.
+
+
+def spawn(tasks, coroutine):
+    task = asyncio.create_task(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)    # The set only keeps running tasks from being garbage collected.
+
+    return task
+
+
+async def request_frame(writer, protocol, frames, awaited_frames, server_prefix, token=None, probe=False):
+    if probe:
+
+        # A probe renders the first of as many parts of the samples of a frame as given, like a sample part of a split frame.
+        print(f"{server_prefix} Sending request to probe frame {frames}.")
+        request = RenderRequest(args.session, [frame * args.probe for frame in frames], args.render_format, token, None, args.probe)
+    else:
+        print(f"{server_prefix} Sending request to render frame {frames}.")
+        request = RenderRequest(args.session, frames, args.render_format, token, args.tiles, args.sample_parts)
+
+    request_header = encode_message(request.__dict__, protocol)
 
     render_start = time.time()
-    with send_lock:
-        connection.sendall(len(request_header).to_bytes(8))
-        connection.sendall(request_header)
+    try:
+        await send_message(writer, request_header)
+    except OSError:
+        return    # The task receiving from the server notices the loss and reassigns the frames.
 
     for frame in frames:
         awaited_frames[frame] = render_start
 
 
-def send_requests(server):
-    server_prefix = f"[{server[0]}:{server[1]}]"    # Indicates which server an output is associated with.
+def frame_priority(frame):
+    cost = estimated_cost(frame)
+
+    if parts_per_frame != None:
+        frame //= parts_per_frame    # All parts of a frame share its priority.
+
+    # For a preview pass, every n-th frame of the range is handed out before all others.
+    # Within each pass, the heaviest frames are handed out first, so no heavy frame handed out last holds up the end of the job.
+    if args.preview_step != None and (frame - first_frame) % args.preview_step != 0:
+        return 1, -cost
+
+    return 0, -cost
+
+
+def estimated_cost(frame):
+
+    # Costs are kept for whole frames, all parts of a split frame get the same share of it.
+    if parts_per_frame != None:
+        return frame_costs.get(frame // parts_per_frame, default_cost) / parts_per_frame
+
+    return frame_costs.get(frame, default_cost)
+
+
+def server_speed(server_index):
+
+    # How much estimated cost a server gets through per second of rendering, unknown until it has delivered a frame.
+    cost, seconds = server_speeds.get(server_index, (0, 0))
+
+    return cost / seconds if cost > 0 and seconds > 0 else None
+
+
+def cost_limit(server_index):
+    speed = server_speed(server_index)
+    if speed == None:
+        return None
+
+
+    # A frame is better left to a faster server if that server would finish it sooner, even after rendering the frames
+    # it is waiting for one after another first. Below the returned cost, this server finishes a frame no later than any of them.
+    limit = None
+    for other_index, other_holder in server_holders.items():
+        other_speed = server_speed(other_index)
+        if other_speed == None or other_speed <= speed:
+            continue
+
+        backlog = sum(estimated_cost(frame) for frame in other_holder[1]) / other_speed
+        other_limit = backlog / (1 / speed - 1 / other_speed)
+
+        limit = other_limit if limit == None else min(limit, other_limit)
+
+    return limit
+
+
+def pick_frame(holder):
+
+    # Take the heaviest frame, unless a faster server would finish it sooner. Then take the heaviest frame of the same
+    # pass this server would finish no later, or the lightest one if it would finish all of them later.
+    frame = frames.peek()
+
+    limit = cost_limit(holder[4])
+    if limit == None or estimated_cost(frame) <= limit:
+        return frames.get_nowait()
+
+
+    # Within a pass, frames are sorted from the heaviest to the lightest, so the heaviest one within the limit is the first
+    # from the limit on, if it is still of the same pass, and the lightest one of the pass is the one before it otherwise.
+    pass_priority = frame_priority(frame)[0]
+    position = frames.find((pass_priority, -limit))
+    if position == len(frames) or frames.priority_at(position)[0] != pass_priority:
+        position -= 1
+
+    return frames.pop_at(position)
+
+
+def hold_frames(frames, holder):
+    for frame in frames:
+        frame_holders.setdefault(frame, []).append(holder)
+
+
+def pick_straggling_frames(frame_count, holder):
+    global duplicates_sent
+
+    # Duplicate the frames that have been rendering the longest, but only those held by a single other server.
+    straggling_frames = []
+    for frame, holders in frame_holders.items():
+        if len(holders) == 1 and holders[0][1] is not holder[1]:
+            render_start = holders[0][1].get(frame)
+            straggling_frames.append((render_start if render_start != None else time.time(), frame))
 
-    send_lock = threading.Lock()
+    straggling_frames = [frame for render_start, frame in sorted(straggling_frames)[:frame_count]]
 
+    for frame in straggling_frames:
+        frame_holders[frame].append(holder)
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as connection:
+    duplicates_sent += len(straggling_frames)
 
-        # Try connecting to server.
+    return straggling_frames
+
+
+async def cancel_frame(frame, holder, server_prefix):
+    loser_prefix, loser_awaited_frames, loser_writer, loser_protocol, loser_index = holder
+
+    loser_awaited_frames.pop(frame, None)
+
+    print(f"{server_prefix} Cancelling frame {frame} on {loser_prefix}.")
+    request_header = encode_message(CancelRequest(args.session, [frame]).__dict__, loser_protocol)
+
+    try:
+        await send_message(loser_writer, request_header)
+    except OSError:
+        pass
+
+
+async def probe_frames(holder, reader):
+    global probes_done
+
+    server_prefix, awaited_frames, writer, protocol, server_index = holder
+
+
+    # Like rendering, probing goes on until all frames have been probed or the server is lost.
+    try:
         while True:
+            if len(awaited_frames) == 0:
+                frame = await probe_queue.get(lambda: probes_done >= probe_count)
+                if frame == None:
+                    return False
+
+                awaited_frames[frame] = None
+                await request_frame(writer, protocol, [frame], awaited_frames, server_prefix, probe=True)
+
+
+            response_header_raw, response_header = await asyncio.wait_for(receive_message(reader, server_prefix, protocol), args.timeout)
+
+            match response_header['type']:
+                case 'REQUEST':
+                    requested_frames = []
+                    while len(requested_frames) < response_header['frame_count'] and len(probe_queue) > 0:
+                        requested_frames.append(probe_queue.get_nowait())
+
+                    for frame in requested_frames:
+                        awaited_frames[frame] = None
+
+                    if len(requested_frames) > 0:
+                        await request_frame(writer, protocol, requested_frames, awaited_frames, server_prefix, response_header.get('token'), True)
+
+                case 'FRAME' | 'FAILED':
+                    frame = response_header['frame_number'] // args.probe
+
+                    # Only the time it took is of interest, the image is thrown away.
+                    if response_header['type'] == 'FRAME':
+                        await frame_writer.discard(reader, response_header['frame_size'], server_prefix, args.timeout, response_header.get('codec'))
+
+                    if frame not in awaited_frames:
+                        continue
+
+                    # Servers don't report a time for frames they had cached or failed to probe, in which case the estimate is left as it was.
+                    probe_time = response_header.get('render_time')
+                    if probe_time != None:
+                        frame_costs[frame] = probe_time * args.probe
+                        print(f"{server_prefix} Probed frame {frame} in {probe_time:.3f} seconds.")
+
+                    del awaited_frames[frame]
+
+                    probes_done += 1
+                    if probes_done == probe_count:
+                        finish_probing()
+
+                        await probe_queue.notify()    # Lets idle servers go on to render.
+    except (ConnectionError, TimeoutError):
+        for frame in awaited_frames:
+            probe_queue.push(frame, front=True)
+        awaited_frames.clear()
+
+        await probe_queue.notify()
+
+        return True
+
+
+def finish_probing():
+    global default_cost
+
+    # Hand out the frames by the probed costs from now on.
+    default_cost = average_cost()
+    frames.reprioritize(frame_priority)
+
+    costs = [frame_costs[frame] for frame in job_frames if frame in frame_costs]
+    if len(costs) > 0 and min(costs) > 0:
+        print(f"Probed {probe_count} frame(s), the heaviest is estimated to take {max(costs) / min(costs):.1f} times as long as the lightest.")
+
+
+def average_cost():
+
+    # Frames without an estimate are assumed to be as heavy as the frames of the job that have one on average.
+    costs = [frame_costs[frame] for frame in job_frames if frame in frame_costs]
+
+    return sum(costs) / len(costs) if len(costs) > 0 and sum(costs) > 0 else 1
+
+
+async def render_frames(holder, reader):
+    global global_frames_rendered
+    global global_render_end
+    global duplicates_won
+    global time_saved
+
+    server_prefix, awaited_frames, writer, protocol, server_index = holder
+    frames_rendered = 0
+
+
+    # Start loop to render frames, until all frames have been received or the server is lost.
+    try:
+        while True:
+
+            # Frames of lost servers are put back into the queue, so idle servers wait for those until all frames have been received.
+            if len(awaited_frames) == 0:
+                frame = await frames.get(lambda: global_frames_rendered >= frames_count, lambda: pick_frame(holder))
+                if frame == None:
+                    return frames_rendered, False
+
+                requested_frames = [frame]
+
+                hold_frames(requested_frames, holder)
+                awaited_frames[requested_frames[0]] = None
+                await request_frame(writer, protocol, requested_frames, awaited_frames, server_prefix)
+
+
+            # Receive request to render more frames or a rendered frame.
+            # Servers send heartbeats, so silence means the server is lost.
+            response_header_raw, response_header = await asyncio.wait_for(receive_message(reader, server_prefix, protocol), args.timeout)
+
+            match response_header['type']:
+                case 'REQUEST':
+                    requested_frames = []
+
+                    while len(requested_frames) < response_header['frame_count'] and len(frames) > 0:
+                        requested_frames.append(pick_frame(holder))
+
+                    hold_frames(requested_frames, holder)
+
+
+                    # Once all frames have been handed out, idle servers render copies of the slowest frames of other servers.
+                    if args.speculate and len(requested_frames) < response_header['frame_count']:
+                        duplicated_frames = pick_straggling_frames(response_header['frame_count'] - len(requested_frames), holder)
+                        if len(duplicated_frames) > 0:
+                            print(f"{server_prefix} Duplicating straggling frame(s) {duplicated_frames}.")
+
+                        requested_frames += duplicated_frames
+
+
+                    for frame in requested_frames:
+                        awaited_frames[frame] = None    # Avoid race condition where frame arrives before next frame is requested,
+                                                        # resulting in empty awaited_frames and early exit from loop.
+
+
+                    if len(requested_frames) > 0:
+                        await request_frame(
+                            writer,
+                            protocol,
+                            requested_frames,
+                            awaited_frames,
+                            server_prefix,
+                            response_header.get('token')    # Lets the server measure how long its requests take to be answered.
+                        )
+
+                case 'FRAME':
+                    frame = response_header['frame_number']
+
+                    try:
+                        file_extension = response_header['file_extension']
+                    except KeyError:
+                        file_extension = ''
+
+                    if parts_per_frame != None:
+                        frame_number, part = divmod(frame, parts_per_frame)
+                        image = f"{frame_number:04d}_part{part}"
+                    else:
+                        image = f"{frame:04d}"
+
+                    if file_extension.isalnum():
+                        image = f"{image}.{file_extension}"
+
+
+                    # The first server to deliver a frame wins, copies arriving later are discarded.
+                    holders = frame_holders.pop(frame, None)
+
+                    if holders == None:
+                        await frame_writer.discard(reader, response_header['frame_size'], server_prefix, args.timeout, response_header.get('codec'))
+
+                        awaited_frames.pop(frame, None)
+                        print(f"{server_prefix} Discarded frame {frame}, it has already been received from another server.")
+
+                        continue
+
+
+                    # The frame is received straight into the image file, which is written by the writer threads.
+                    try:
+                        await frame_writer.receive(reader, image, response_header['frame_size'], server_prefix, args.timeout, response_header.get('codec'))
+                    except (ConnectionError, TimeoutError):
+
+                        # Let the frame be reassigned along with the others of this server, unless another server still delivers it.
+                        frame_holders[frame] = [other_holder for other_holder in holders if frame in other_holder[1]]
+
+                        raise
+
+                    render_end = time.time()
+                    render_time = render_end - awaited_frames[frame]
+                    if parts_per_frame != None:
+                        print(f"{server_prefix} Received {part_kind} {part} of frame {frame_number} after {render_time:.3f} seconds.")
+
+                        # Once all parts of a frame have arrived, they are merged into the image of the frame.
+                        part_images = frame_part_images.setdefault(frame_number, {})
+                        part_images[part] = image
+                        if len(part_images) == parts_per_frame:
+                            await merge_parts(frame_number, [part_images[part] for part in range(parts_per_frame)], server_prefix)
+                    else:
+                        print(f"{server_prefix} Received frame {frame} after {render_time:.3f} seconds.")
+                        print(f"{server_prefix} Frame {frame} has been saved as '{image}'.")
+
+                        record_frame(frame, image)
+
+                    total_render_time, server_frames_rendered = server_render_times.get(server_index, (0, 0))
+                    server_render_times[server_index] = (total_render_time + render_time, server_frames_rendered + 1)
+
+
+                    # The speed of the server is learned from the time it reports for rendering the frame, or failing that
+                    # from how long the frame took to arrive. Only reported times go into the costs kept for later runs.
+                    observed_time = response_header.get('render_time', render_time)
+
+                    cost, seconds = server_speeds.get(server_index, (0, 0))
+                    server_speeds[server_index] = (cost + estimated_cost(frame), seconds + observed_time)
+
+                    if 'render_time' in response_header:
+                        observed_times[frame] = (server_index, observed_time)
+
+
+                    # If a copy of the frame won, estimate when the original server would have delivered it.
+                    if holders[0][1] is not awaited_frames:
+                        original_awaited_frames, original_index = holders[0][1], holders[0][4]
+                        original_render_start = original_awaited_frames.get(frame)
+
+                        duplicates_won += 1
+
+                        # Without any frame from that server to go by, assume the frame was halfway done.
+                        total_render_time, server_frames_rendered = server_render_times.get(original_index, (0, 0))
+                        if original_render_start != None:
+                            if server_frames_rendered > 0:
+                                expected_render_end = original_render_start + total_render_time / server_frames_rendered
+                            else:
+                                expected_render_end = render_end + (render_end - original_render_start)
+
+                            time_saved = max(time_saved, expected_render_end - render_end)
+
+                    for loser in holders:
+                        if loser[1] is not awaited_frames:
+                            spawn(background_tasks, cancel_frame(frame, loser, server_prefix))    # A stalled server must not hold up this one.
+
+
+                    # Increment the global counter of rendered frames and time the duration of rendering all frames if the last frame has just been rendered.
+                    global_frames_rendered += 1
+                    if global_frames_rendered == frames_count:
+                        global_render_end = time.time()
+
+                        await frames.notify()    # Lets idle servers stop waiting for reassigned frames.
+
+
+                    frames_rendered += 1
+                    del awaited_frames[frame]
+
+                case 'FAILED':
+                    frame = response_header['frame_number']
+                    awaited_frames.pop(frame, None)
+
+
+                    # The frame is only given up on if no other server is rendering a copy of it anymore.
+                    holders = frame_holders.get(frame)
+                    if holders == None:
+                        continue    # Already received from another server.
+
+                    holders[:] = [other_holder for other_holder in holders if other_holder[1] is not awaited_frames]
+                    if len(holders) > 0:
+                        print(f"{server_prefix} Could not render frame {frame}, waiting for it from another server.")
+                        continue
+
+                    del frame_holders[frame]
+                    failed_frames.append(frame)
+
+                    print(f"{server_prefix} Could not render frame {frame}, skipping it. Reason given: \"{response_header['error']}\"")
+
+
+                    # A failed frame counts as handled, so the job ends once all other frames have been received.
+                    global_frames_rendered += 1
+                    if global_frames_rendered == frames_count:
+                        global_render_end = time.time()
+
+                        await frames.notify()
+
+                case 'CANCEL' | 'HEARTBEAT':
+                    pass    # Frames cancelled on this server have already been removed from the awaited frames.
+    except (ConnectionError, TimeoutError):
+        return frames_rendered, True
+
+
+async def merge_parts(frame_number, part_images, server_prefix):
+    image = f"{frame_number:04d}.exr"
+
+    # Merging runs in a thread, so the other servers keep being served in the meantime.
+    # Like received frames, the image is written under a temporary name and renamed once complete.
+    try:
+        if args.tiles != None:
+            await asyncio.to_thread(stitch_exr, part_images, f"{image}.part")
+        else:
+            await asyncio.to_thread(average_exr, part_images, f"{image}.part")
+
+        await asyncio.to_thread(frame_writer.commit, f"{image}.part", image)
+    except (ExrFormatError, OSError) as error:
+        print(f"{server_prefix} The {part_kind}s of frame {frame_number} could not be merged, keeping them as they are. Reason: {error}")
+
+        if os.path.exists(f"{image}.part"):
+            os.remove(f"{image}.part")
+        return
+
+    for part_image in part_images:
+        os.remove(part_image)
+
+    record_frame(frame_number, image)
+
+    print(f"{server_prefix} Frame {frame_number} has been merged from {len(part_images)} {part_kind}s and saved as '{image}'.")
+
+
+def manifest_job():
+
+    # The output directory may be reused for other sessions or formats, so frames are listed along with what decides their
+    # images besides the frame itself. Averaged sample parts aren't denoised, so they don't count for a normal render.
+    return f"{args.session} {args.render_format or '-'} {args.sample_parts or '-'}"
+
+
+def record_frame(frame, image):
+
+    # Only frames listed with their size count as finished when resuming, which rules out images cut off by an interruption.
+    manifest.write(f"{manifest_job()} {frame} {os.path.getsize(image)} {image}\n")
+    manifest.flush()
+
+
+def find_finished_frames():
+    try:
+        with open(MANIFEST) as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        return set()
+
+    # Later entries replace earlier ones of the same image, which another job may have overwritten.
+    recorded_images = {}
+    for line in lines:
+        try:
+            session, render_format, sample_parts, frame, size, image = line.split(' ', 5)
+            recorded_images[image] = (f"{session} {render_format} {sample_parts}", int(frame), int(size))
+        except ValueError:
+            continue    # A line cut off by an interruption, or one of an older version without the job.
+
+
+    # The output directory is scanned once, instead of looking up every frame on its own.
+    image_sizes = {entry.name: entry.stat().st_size for entry in os.scandir() if entry.is_file()}
+
+    job = manifest_job()
+
+    return {frame for image, (image_job, frame, size) in recorded_images.items() if image_job == job and image_sizes.get(image) == size}
+
+
+def load_frame_costs():
+    try:
+        with open(COSTS) as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        return {}
+
+    frame_costs = {}
+    for line in lines:
+        try:
+            session, frame, cost = line.split(' ')
+            if session == args.session:
+                frame_costs[int(frame)] = float(cost)    # Later entries replace earlier ones of the same frame.
+        except ValueError:
+            continue
+
+    return frame_costs
+
+
+def save_frame_costs():
+
+    # The times reported for the frames of this run are turned into costs with the speed of the server that rendered
+    # each of them, so frames rendered by fast and slow servers compare. Split frames only count once all parts have a time.
+    frame_times = {}
+    for frame, (server_index, seconds) in observed_times.items():
+        speed = server_speed(server_index)
+        if speed == None:
+            continue
+
+        if parts_per_frame != None:
+            frame //= parts_per_frame
+        frame_times.setdefault(frame, []).append(seconds * speed)
+
+    rendered_costs = {frame: sum(costs) for frame, costs in frame_times.items() if len(costs) == (parts_per_frame or 1)}
+    if len(rendered_costs) == 0:
+        return
+
+
+    # The costs of other sessions and of frames not rendered this time are kept, the file is replaced as a whole.
+    try:
+        with open(COSTS) as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+
+    with open(f"{COSTS}.part", 'w') as file:
+        for line in lines:
             try:
-                connection.connect(server)
-                break
-            except socket.gaierror:
-                print(f"{server_prefix} Server is unknown, cancelling request.")
-                sys.exit()
-            except OSError:
-                if args.command == 'RENDER':
-                    if len(frames) == 0:
-                        print(f"{server_prefix} Could not connect, but all frames have already been handled, cancelling request.")
-                        sys.exit()
-
-                # Retry to connect for commands other than UPLOAD or if there are still frames left to be handled by RENDER command.
-                print(f"{server_prefix} Could not connect, retrying in 10 seconds.")
-                time.sleep(10)
-
-
-        match args.command:
-            case 'UPLOAD':
-
-                # Send UPLOAD-request to upload .blend file.
-                print(f"{server_prefix} Connected, uploading .blend file.")
-                request_header = json.dumps(UploadRequest(args.session, blend_file_size).__dict__).encode()
-                upload_start = time.time()
-                connection.sendall(len(request_header).to_bytes(8))
-                connection.sendall(request_header)
-                connection.sendall(blend_file)
-
-
-                # Receive status whether upload was successful or not.
-                response_header_size = int.from_bytes(receive_bytes(connection, 8, server_prefix))
-                response_header = json.loads(receive_bytes(connection, response_header_size, server_prefix))
-                upload_end = time.time()
-
-                match response_header['status']:
-                    case 'FAIL':
-                        print(f"{server_prefix} .blend file could not be uploaded, stopping request.")
-                        sys.exit()
-                    case 'OKAY':
-                        upload_time = upload_end - upload_start
-                        print(f"{server_prefix} File ({blend_file_size / 1000000:.1f} MB) uploaded successfully in {upload_time:.3f} seconds ({blend_file_size / upload_time / 1000000:.3f} MB/s).")
-
-            case 'RENDER':
-                global global_frames_rendered
-                global global_render_end
-
-                frames_rendered = 0
-                awaited_frames = {}
+                session, frame, cost = line.split(' ')
+                if session != args.session or int(frame) not in rendered_costs:
+                    file.write(f"{line}\n")
+            except ValueError:
+                continue    # A line cut off by an interruption.
+
+        for frame, cost in sorted(rendered_costs.items()):
+            file.write(f"{args.session} {frame} {cost:.6g}\n")
+
+    os.replace(f"{COSTS}.part", COSTS)
+
+
+async def reassign_frames(holder):
+    server_prefix, awaited_frames = holder[:2]
+
+    # Frames that another server is rendering a copy of or has already delivered aren't put back into the queue.
+    lost_frames = []
+    for frame in list(awaited_frames):
+        holders = frame_holders.get(frame)
+        if holders == None:
+            continue
+
+        holders[:] = [other_holder for other_holder in holders if other_holder[1] is not awaited_frames]
+        if len(holders) == 0:
+            del frame_holders[frame]
+            lost_frames.append(frame)
+
+    awaited_frames.clear()
+
+    for frame in sorted(lost_frames, reverse=True):
+        frames.push(frame, frame_priority(frame), front=True)
+    await frames.notify()
+
+    if len(lost_frames) > 0:
+        print(f"{server_prefix} Reassigning frame(s) {sorted(lost_frames)} to other servers.")
+
+
+async def connect(server, server_prefix):
+    protocol = None
+
+    # Try connecting to server.
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(*server)
+        except socket.gaierror:
+            print(f"{server_prefix} Server is unknown, cancelling request.")
+            return None, None, None, None
+        except OSError:
+            if args.command == 'STATS':
+                print(f"{server_prefix} Could not connect, skipping server.")
+                return None, None, None, None
+
+            if args.command == 'RENDER':
+                if len(frames) == 0:
+                    print(f"{server_prefix} Could not connect, but all frames have already been handled, cancelling request.")
+                    return None, None, None, None
+
+            # Retry to connect for commands other than UPLOAD or if there are still frames left to be handled by RENDER command.
+            print(f"{server_prefix} Could not connect, retrying in 10 seconds.")
+            await asyncio.sleep(10)
+            continue
+
+        if protocol == JSON_PROTOCOL:
+            return reader, writer, protocol, Compressor()
+
+
+        # Agree on a protocol with the server, servers that don't support negotiating it are sent JSON headers on a new connection.
+        try:
+            response_header = await negotiate_protocol(reader, writer, server_prefix, args.timeout, False, codecs)
+        except OSError:
+            response_header = None
 
+        if response_header != None:
+            return reader, writer, response_header['version'], Compressor(codecs, response_header.get('codecs', ()))
 
-                # Initial render request, causing subsequent render request responses by the server.
-                requested_frames = []
+        writer.close()
+        protocol = JSON_PROTOCOL
+
+
+async def upload_blend_file(reader, writer, protocol, compressor, server_prefix):
+
+    # Send UPLOAD-request with the hash of the .blend file first, the server only asks for the file if it doesn't store it yet.
+    # Servers that still have an earlier version of the file for the session may ask for a delta against it instead.
+    request_header = encode_message(UploadRequest(args.session, blend_file_size, blend_hash, None if args.no_delta else '').__dict__, protocol)
+    await send_message(writer, request_header)
+
+    response_header_raw, response_header = await receive_message(reader, server_prefix, protocol)
+
+    if response_header['status'] not in ('SEND', 'DELTA'):
+        return response_header, None
+
+
+    # Stream the file in chunks, starting from the offset the server has already committed from a previous attempt.
+    offset = response_header['offset']
+    if offset > 0:
+        print(f"{server_prefix} Resuming upload at {offset / 1000000:.1f} MB.")
+
+    upload = Upload(args.blend_file, blend_file_size, blend_file_size, blend_file_checksums)
+    bytes_uploaded = blend_file_size - offset
+
+
+    # For a delta, the blocks of the file the server has are looked for in this file, those found are only copied by the server.
+    if response_header['status'] == 'DELTA':
+        try:
+            signatures = await reader.readexactly(response_header['size'])
+        except asyncio.IncompleteReadError:
+            print(f"{server_prefix} Connection broken.")
+            raise ConnectionBrokenError(server_prefix)
+
+        checksums, copies = await asyncio.to_thread(compute_delta, args.blend_file, offset, response_header['block_size'], signatures, CHUNK_SIZE)
+        upload = Upload(args.blend_file, blend_file_size, blend_file_size, checksums, response_header['base'], copies)
+
+        bytes_uploaded -= sum(checksums[chunk_offset][0] for chunk_offset in copies)
+        print(f"{server_prefix} Sending {bytes_uploaded / 1000000:.1f} MB of changes, the server copies the other {(blend_file_size - offset - bytes_uploaded) / 1000000:.1f} MB from its previous file.")
+
+    await stream_chunks(writer, upload, offset, protocol, compressor, response_header['status'] == 'DELTA')
+
+
+    # Receive status whether upload was successful or not.
+    response_header_raw, response_header = await receive_message(reader, server_prefix, protocol)
+
+    return response_header, bytes_uploaded
+
+
+async def send_requests(server, server_index):
+    server_prefix = f"[{server[0]}:{server[1]}]"    # Indicates which server an output is associated with.
+
+
+    reader, writer, protocol, compressor = await connect(server, server_prefix)
+    if writer == None:
+        return
+
+    match args.command:
+        case 'UPLOAD':
+            print(f"{server_prefix} Connected, uploading .blend file.")
+            upload_start = time.time()
+
+
+            # Reconnect after a broken connection and resume the upload where it stopped.
+            while True:
                 try:
-                    requested_frames.append(frames.pop(0))
-                except IndexError:
-                    sys.exit()
+                    response_header, bytes_uploaded = await upload_blend_file(reader, writer, protocol, compressor, server_prefix)
+                    break
+                except ConnectionError:
+                    writer.close()
+                    print(f"{server_prefix} Upload interrupted, resuming in 10 seconds.")
+                    await asyncio.sleep(10)
 
-                request_frame(connection, requested_frames, awaited_frames, send_lock, server_prefix)
+                    reader, writer, protocol, compressor = await connect(server, server_prefix)
+                    if writer == None:
+                        return
 
+            writer.close()
+            upload_end = time.time()
 
-                # Start loop to render frames.
-                while len(awaited_frames) > 0:
 
-                    # Receive request to render more frames or a rendered frame.
-                    response_header_size = int.from_bytes(receive_bytes(connection, 8, server_prefix))
-                    response_header = json.loads(receive_bytes(connection, response_header_size, server_prefix))
+            match response_header['status']:
+                case 'FAIL':
+                    print(f"{server_prefix} .blend file could not be uploaded, stopping request. Reason given: \"{response_header['error']}\"")
+                case 'OKAY':
+                    upload_time = upload_end - upload_start
+                    if bytes_uploaded != None:
+                        print(f"{server_prefix} File ({blend_file_size / 1000000:.1f} MB) uploaded successfully in {upload_time:.3f} seconds ({bytes_uploaded / upload_time / 1000000:.3f} MB/s).")
+                    else:
+                        print(f"{server_prefix} File ({blend_file_size / 1000000:.1f} MB) already stored on server(s), linked it in {upload_time:.3f} seconds.")
 
-                    match response_header['type']:
-                        case 'REQUEST':
-                            requested_frames = []
+        case 'RENDER':
+            frames_rendered = 0
 
-                            for frame in range(response_header['frame_count']):
-                                try:
-                                    frame = frames.pop(0)
-                                except IndexError:
-                                    break
 
-                                requested_frames.append(frame)
+            # Reconnect after losing the server, the frames it hadn't delivered yet are rendered by other servers in the meantime.
+            while True:
+                awaited_frames = {}
+                holder = (server_prefix, awaited_frames, writer, protocol, server_index)    # Identifies this server to the tasks of other servers.
 
-                                awaited_frames[frame] = None    # Avoid race condition where frame arrives before next frame is requested,
-                                                                # resulting in empty awaited_frames and early exit from loop.
+                # All frames are probed before any is rendered, so the first frames handed out are already the heaviest.
+                lost = False
+                if probes_done < probe_count:
+                    lost = await probe_frames(holder, reader)
 
+                if not lost:
+                    server_holders[server_index] = holder
+                    try:
+                        frames_rendered_now, lost = await render_frames(holder, reader)
+                        frames_rendered += frames_rendered_now
+                    finally:
+                        server_holders.pop(server_index, None)
 
-                            if len(requested_frames) > 0:
-                                threading.Thread(target=request_frame, args=(connection, requested_frames, awaited_frames, send_lock, server_prefix)).start()
+                if not lost:
+                    break
 
-                        case 'FRAME':
-                            frame = response_header['frame_number']
-                            image_data = receive_bytes(connection, response_header['frame_size'], server_prefix)
-                            render_end = time.time()
-                            print(f"{server_prefix} Received frame {frame} after {render_end - awaited_frames[frame]:.3f} seconds.")
+                writer.close()
+                await reassign_frames(holder)
 
+                print(f"{server_prefix} Lost connection, reconnecting in 10 seconds.")
+                await asyncio.sleep(10)
 
-                            try:
-                                file_extension = response_header['file_extension']
-                            except KeyError:
-                                file_extension = ''
+                reader, writer, protocol, compressor = await connect(server, server_prefix)
+                if writer == None:
+                    break
 
-                            image = f"{frame:04d}"
-                            if file_extension.isalnum():
-                                image = f"{image}.{file_extension}"
+            if writer != None:
+                writer.close()
 
-                            with open(image, 'wb') as file:
-                                file.write(image_data)
-                            print(f"{server_prefix} Frame {frame} has been saved as '{image}'.")
 
+            print(f"{server_prefix} Rendered {frames_rendered} frame(s) in total, {frames_rendered / frames_count:.2%} of all frames.")
 
-                            # Increment the global counter of rendered frames and time the duration of rendering all frames if the last frame has just been rendered.
-                            with global_frames_rendered_lock:
-                                global_frames_rendered += 1
-                            if global_frames_rendered == frames_count:
-                                global_render_end = time.time()
+        case 'DELETE':
 
+            # Send DELETE-request to delete .blend file from server when all frames have been rendered.
+            print(f"{server_prefix} Requesting deletion of .blend file.")
+            request_header = encode_message(SessionRequest('DELETE', args.session).__dict__, protocol)
+            await send_message(writer, request_header)
 
-                            frames_rendered += 1
-                            del awaited_frames[frame]
 
+            try:
+                response_header_raw, response_header = await receive_message(reader, server_prefix, protocol)
+            except ConnectionBrokenError:
+                return
+            finally:
+                writer.close()
+
+            match response_header['status']:
+                case 'OKAY':
+                    print(f"{server_prefix} Successfully deleted .blend file from server.")
+                case 'FAIL':
+                    print(f"{server_prefix} Failed to delete .blend file from server. Reason given: \"{response_header['error']}\"")
+
+        case 'STATS':
+            request_header = encode_message(StatsRequest().__dict__, protocol)
+            await send_message(writer, request_header)
 
-                print(f"{server_prefix} Rendered {frames_rendered} frame(s) in total, {frames_rendered / frames_count:.2%} of all frames.")
+            try:
+                response_header_raw, response_header = await asyncio.wait_for(receive_message(reader, server_prefix, protocol), args.timeout)
+            except (ConnectionBrokenError, TimeoutError):
+                response_header = {}
+            finally:
+                writer.close()
 
-            case 'DELETE':
+            if 'stats' not in response_header:
+                print(f"{server_prefix} Server does not report statistics.")
+                return
 
-                # Send DELETE-request to delete .blend file from server when all frames have been rendered.
-                print(f"{server_prefix} Requesting deletion of .blend file.")
-                request_header = json.dumps(SessionRequest('DELETE', args.session).__dict__).encode()
-                connection.sendall(len(request_header).to_bytes(8))
-                connection.sendall(request_header)
+            print(f"{server_prefix} Statistics of the server and its children:\n{format_stats(response_header['stats'])}")
 
 
-                response_header_size = int.from_bytes(receive_bytes(connection, 8, server_prefix))
-                response_header = json.loads(receive_bytes(connection, response_header_size, server_prefix))
+async def main():
 
-                match response_header['status']:
-                    case 'OKAY':
-                        print(f"{server_prefix} Successfully deleted .blend file from server.")
-                    case 'FAIL':
-                        print(f"{server_prefix} Failed to delete .blend file from server. Reason given: \"{response_header['error']}\"")
+    # Talk to all servers from one event loop, the requests to the servers run as concurrent tasks.
+    # The same server may be listed more than once, so each entry of the list is told apart by its index.
+    try:
+        await asyncio.gather(*(send_requests(server, server_index) for server_index, server in enumerate(servers)))
+    finally:
+        if args.command == 'RENDER':
+            await frame_writer.close()    # Syncs the last batch of frames.
 
 
 # Start of the program.
@@ -197,6 +842,32 @@ this can be useful for rendering slow encoding formats (PNG) in parallel\n\n"""
 )
 
 
+server_parser.add_argument(
+    '-t', '--timeout',
+    metavar='timeout',
+    type=float,
+    default=30,
+    help="""the number of seconds a server may stay silent before it is considered lost
+servers send heartbeats while rendering, so this should be well above their heartbeat interval
+it also bounds the wait for a server to agree on a protocol when connecting
+
+the frames of a lost server are rendered by the other servers while reconnecting to it\n\n"""
+)
+
+
+server_parser.add_argument(
+    '--compression',
+    metavar='codecs',
+    help=f"""a comma separated list of the codecs the .blend file may be compressed with when uploading
+and frames may be compressed with when rendering, in the order they are preferred in,
+or 'none' to send and accept everything uncompressed
+defaults to all codecs available here, which are: {', '.join(CODECS)}
+
+compression is turned off for a while whenever it doesn't pay off, e.g. for files
+that are already compressed or if the connection is faster than compressing\n\n"""
+)
+
+
 session_parser = argparse.ArgumentParser(add_help=False)
 
 session_parser.add_argument(
@@ -239,6 +910,16 @@ make sure all resources necessary for rendering are packed into the file
 set an image format for render output unless rendering with the '-F' option\n\n"""
 )
 
+parser_upload.add_argument(
+    '--no-delta',
+    action='store_true',
+    help="""always send the whole file
+
+by default, servers that still have an earlier version of the file for the session
+send signatures of its blocks, and only blocks that changed are sent to them
+finding moved blocks needs numpy, without it only blocks that stayed in place are found\n\n"""
+)
+
 
 # RENDER parser
 parser_render = command_parsers.add_parser(
@@ -289,6 +970,97 @@ OpenEXR export is incredibly fast while being suitable for post-production
 optional lossy compression can also reduce file sizes massively\n\n"""
 )
 
+parser_render.add_argument(
+    '-p', '--preview-step',
+    metavar='step',
+    type=int,
+    help="""render every step-th frame of the frame range first, starting with its first frame,
+and the frames in between afterwards
+
+this gives a preview of the whole animation early on\n\n"""
+)
+
+parser_render.add_argument(
+    '-S', '--speculate',
+    action='store_true',
+    help="""once all frames have been handed out, have idle servers render copies of
+the frames that have been rendering the longest on other servers
+
+whichever server delivers a frame first wins and the other render is cancelled
+this keeps a single slow server from holding up the end of a job\n\n"""
+)
+
+parser_render.add_argument(
+    '-P', '--probe',
+    metavar='parts',
+    type=int,
+    help="""before rendering, probe how heavy every frame is by rendering it with a parts-th of its samples
+
+frames are handed out heaviest first, and slower servers leave heavy frames to faster ones
+that would finish them sooner, which keeps heavy frames from holding up the end of a job
+without probing, frames are estimated from earlier runs of the session in the output directory
+probes are only quicker than rendering with Cycles, their images are discarded\n\n"""
+)
+
+parser_render.add_argument(
+    '-T', '--tiles',
+    metavar='count',
+    type=int,
+    help="""split every frame into count horizontal tiles, which are rendered like frames of their own
+and stitched back into one OpenEXR image per frame once all of its tiles have been received
+
+this lets all servers work on a single huge or heavy frame at the same time
+tiles are always rendered as OpenEXR, the stitching is lossless\n\n"""
+)
+
+parser_render.add_argument(
+    '-X', '--sample-parts',
+    metavar='count',
+    type=int,
+    help="""split the samples of every frame into count parts, which are rendered with a seed each like frames
+of their own and averaged into one OpenEXR image per frame once all of its parts have been received
+
+this lets all servers work on a single noise-limited frame at the same time
+only works with Cycles, each part renders the samples of the file divided by count, rounded up
+parts are rendered without denoising, which is left to post-production
+requires NumPy on the client and can't be combined with '-T' / '--tiles'\n\n"""
+)
+
+parser_render.add_argument(
+    '-R', '--resume',
+    action='store_true',
+    help="""skip frames that have already been saved to the output directory by a previous run
+
+every completely saved frame is listed in a manifest in the output directory, along with
+the session, the render format and the number of sample parts it was rendered with
+frames missing from it for this job or whose image has a different size are rendered again\n\n"""
+)
+
+parser_render.add_argument(
+    '--writers',
+    metavar='writers',
+    type=int,
+    default=4,
+    help="""the number of threads writing received frames to disk
+
+received data is queued for the writers, so receiving only waits for the disk
+once the queue is full\n\n"""
+)
+
+parser_render.add_argument(
+    '--fsync',
+    choices=('frame', 'batch', 'none'),
+    default='batch',
+    help="""when to sync written frames to disk
+    frame:  sync every frame before it is given its name
+    batch:  sync frames in batches, a power loss may cost the last batch
+    none:   leave syncing to the operating system
+
+frames are always written under a temporary name and renamed once complete,
+so an interrupted client never leaves a cut off frame behind
+defaults to batch\n\n"""
+)
+
 
 # DELETE parser
 parser_delete = command_parsers.add_parser(
@@ -301,6 +1073,18 @@ parser_delete = command_parsers.add_parser(
 )
 
 
+# STATS parser
+parser_stats = command_parsers.add_parser(
+    'STATS',
+    aliases=('stats',),
+    parents=(server_parser,),
+    description="Show statistics of the server(s) and their children.",
+    help="""show how long frames spend in each stage on the server(s) and their children,
+along with the number of waiting frames, busy workers and throughput\n\n""",
+    formatter_class=argparse.RawTextHelpFormatter
+)
+
+
 args = parser.parse_args()
 args.command = args.command.upper()    # Due to subcommand aliases being saved as lowercase,
                                        # convert command to uppercase for further handling.
@@ -343,16 +1127,28 @@ if len(servers) == 0:
     sys.exit("No active servers were found in the server list. Uncomment a server or add a new one to the server list. Exiting.")
 
 
+if args.timeout <= 0:
+    sys.exit(f"The timeout must be positive, but is {args.timeout}. Exiting.")
+
+if args.compression == None:
+    codecs = list(CODECS)
+else:
+    try:
+        codecs = parse_codecs(args.compression)
+    except ValueError as error:
+        sys.exit(f"Codec '{error}' is not available, must be one of {', '.join(CODECS)} or 'none'. Exiting.")
+
+
 # A server only accepts alphanumeric session names to avoid creating files in arbitrary paths like "../session.blend".
-if not args.session.isalnum():
+if args.command != 'STATS' and not args.session.isalnum():
     sys.exit(f"The session name '{args.session}' is not alphanumeric, exiting.")
 
 
 match args.command:
     case 'UPLOAD':
         try:
-            with open(args.blend_file, 'rb') as file:
-                blend_file = file.read()
+            blend_file_size = os.path.getsize(args.blend_file)
+            blend_hash, blend_file_checksums = hash_file(args.blend_file)    # The hash identifies the file in the content-addressed stores of the servers.
         except FileNotFoundError:
             sys.exit(f"The .blend file '{args.blend_file}' does not exist, exiting.")
         except IsADirectoryError:
@@ -360,27 +1156,46 @@ match args.command:
         except PermissionError:
             sys.exit(f"No permission to read from .blend file '{args.blend_file}', exiting.")
 
-        blend_file_size = len(blend_file)
-
     case 'RENDER':
-        if args.end_frame == None:
-            frames = [args.start_frame]
-        elif args.start_frame > args.end_frame:
-            frames = list(range(args.end_frame, args.start_frame + 1))
-        else:
-            frames = list(range(args.start_frame, args.end_frame + 1))
-
-        frames_count = len(frames)
+        if args.preview_step != None and args.preview_step <= 0:
+            sys.exit(f"The preview step must be positive, but is {args.preview_step}. Exiting.")
+        if args.writers < 1:
+            sys.exit(f"At least one writer is needed, but {args.writers} were requested. Exiting.")
+        if args.tiles != None and args.tiles <= 0:
+            sys.exit(f"The number of tiles must be positive, but is {args.tiles}. Exiting.")
+        if args.sample_parts != None and args.sample_parts <= 0:
+            sys.exit(f"The number of sample parts must be positive, but is {args.sample_parts}. Exiting.")
+        if args.probe != None and args.probe <= 0:
+            sys.exit(f"The number of parts to probe frames with must be positive, but is {args.probe}. Exiting.")
+
+        if args.tiles != None and args.sample_parts != None:
+            sys.exit("Frames can either be split into tiles or sample parts, but not both. Exiting.")
+
+        if args.sample_parts != None:
+            try:
+                import numpy
+            except ImportError:
+                sys.exit("Sample parts are averaged with NumPy, which is not installed. Exiting.")
 
 
-        global_render_end = None                          # This value will later be set by the thread that receives the last frame.
+        # Split frames are rendered in parts, which are numbered frame * parts_per_frame + part.
+        if args.tiles != None:
+            parts_per_frame, part_kind = args.tiles, 'tile'
+        elif args.sample_parts != None:
+            parts_per_frame, part_kind = args.sample_parts, 'sample part'
+        else:
+            parts_per_frame, part_kind = None, None
 
-        global_frames_rendered = 0                        # These two are necessary for measuring the total render-time correctly.
-        global_frames_rendered_lock = threading.Lock()    # Because of timeouts due to reconnection attempts, the end of the render
-                                                          # doesn't necessarily coincide with all threads joining up with the main thread.
+        if args.end_frame == None:
+            first_frame, last_frame = args.start_frame, args.start_frame
+        elif args.start_frame > args.end_frame:
+            first_frame, last_frame = args.end_frame, args.start_frame
+        else:
+            first_frame, last_frame = args.start_frame, args.end_frame
 
 
-        # Change to output directory last so all arguments are read from where the command was executed.
+        # Change to output directory once all arguments have been read from where the command was executed,
+        # the directory is scanned for finished frames when resuming.
         try:
             os.chdir(args.output_dir)
         except FileNotFoundError:
@@ -390,22 +1205,91 @@ match args.command:
         except NotADirectoryError:
             sys.exit(f"'{args.output_dir}' is not a directory, exiting.")
 
+        finished_frames = set()
+        if args.resume:
+            finished_frames = find_finished_frames() & set(range(first_frame, last_frame + 1))
+            print(f"Resuming, {len(finished_frames)} frame(s) have already been rendered.")
+
+            if len(finished_frames) == last_frame - first_frame + 1:
+                sys.exit("All frames have already been rendered, exiting.")
+
+        manifest = open(MANIFEST, 'a')
+
+        frame_writer = FrameWriter(args.writers, args.fsync)    # Also measures how fast frames arrive and how fast they are written.
+
+        job_frames = [frame for frame in range(first_frame, last_frame + 1) if frame not in finished_frames]
 
-# Create threads that send requests to the servers.
-threads = []
-for server in servers:
-    thread = threading.Thread(target=send_requests, args=(server,))
-    thread.start()
-    threads.append(thread)
 
+        # Frames are handed out by how heavy they are estimated to be, from earlier runs of the session or from probing them.
+        frame_costs = load_frame_costs()
+        default_cost = average_cost()
 
-# Wait for threads to finish.
-for thread in threads:
-    thread.join()
+        probe_queue = FrameQueue()
+        if args.probe != None:
+            for frame in job_frames:
+                probe_queue.push(frame)
+
+        probe_count = len(probe_queue)
+        probes_done = 0
+
+
+        frames = FrameQueue(ordered=True)    # Also signals frames being put back into the queue after a server was lost.
+        for frame in job_frames:
+            if parts_per_frame != None:
+                for part in range(parts_per_frame):
+                    frames.push(frame * parts_per_frame + part, frame_priority(frame * parts_per_frame))
+            else:
+                frames.push(frame, frame_priority(frame))
+
+        frames_count = len(frames)
+
+
+        global_render_end = None      # This value will later be set by the task that receives the last frame.
+
+        global_frames_rendered = 0    # Necessary for measuring the total render-time correctly. Because of timeouts due to reconnection
+                                      # attempts, the end of the render doesn't necessarily coincide with all tasks finishing.
+
+
+        frame_holders = {}           # The servers each frame that hasn't been received yet has been sent to.
+        server_render_times = {}     # Total render time and number of frames rendered by each server.
+        server_speeds = {}           # Total estimated cost and render time of the frames rendered by each server.
+        server_holders = {}          # The servers currently rendering, by their index in the server list like the other statistics.
+        observed_times = {}          # The server that rendered each frame and the render time it reported.
+        frame_part_images = {}       # The images of the parts received so far for each split frame.
+
+        failed_frames = []           # Frames that Blender stopped on too often, which are skipped.
+
+        duplicates_sent = 0
+        duplicates_won = 0
+        time_saved = 0
+
+
+# Send requests to the servers and wait for all of them to finish.
+background_tasks = set()    # Requests sent on the side, like cancelling frames that have been received from another server.
+
+asyncio.run(main())
 
 
 if args.command == 'RENDER':
 
     # Signal success and total render time to the user.
-    global_render_time = global_render_end - program_start
-    print(f"Done. {frames_count} frame(s) rendered in {global_render_time:.3f} seconds ({global_render_time / frames_count:.3f} seconds per frame on average).")
+    if global_render_end == None:
+        print(f"Stopped. Only {global_frames_rendered} of {frames_count} frame(s) could be rendered.")
+    else:
+        global_render_time = global_render_end - program_start
+        if parts_per_frame != None:
+            print(f"Done. {frames_count // parts_per_frame} frame(s) of {parts_per_frame} {part_kind}(s) each rendered in {global_render_time:.3f} seconds ({global_render_time / frames_count:.3f} seconds per {part_kind} on average).")
+        else:
+            print(f"Done. {frames_count - len(failed_frames)} frame(s) rendered in {global_render_time:.3f} seconds ({global_render_time / frames_count:.3f} seconds per frame on average).")
+
+    # Comparing the two rates tells whether the network or the disk holds up receiving frames.
+    network, disk = frame_writer.network, frame_writer.disk
+    print(f"Received {network.bytes / 1000000:.1f} MB at {network.rate() / 1000000:.3f} MB/s, written to disk at {disk.rate() / 1000000:.3f} MB/s.")
+
+    if duplicates_sent > 0:
+        print(f"{duplicates_sent} straggling frame(s) duplicated, {duplicates_won} duplicate(s) won, saving an estimated {time_saved:.3f} seconds.")
+
+    save_frame_costs()    # Lets later runs of the session hand out the heaviest frames first.
+
+    if len(failed_frames) > 0:
+        sys.exit(f"{len(failed_frames)} frame(s) could not be rendered and are missing: {sorted(failed_frames)}.")
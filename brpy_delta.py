@@ -0,0 +1,147 @@
+import bisect
+import hashlib
+import math
+import os
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    # Only needed to find blocks that moved, blocks that stayed in place are found without it.
+
+
+DELTA_MIN_BLOCK_SIZE = 4 * 1024         # Files are compared in blocks of about the square root of their size, but no smaller than this
+DELTA_MAX_BLOCK_SIZE = 1024 * 1024      # and no larger than this.
+DELTA_SEGMENT_SIZE = 4 * 1024 * 1024    # The file being sent is searched for matching blocks in segments of this size.
+
+ADLER_MODULUS = 65521
+CANDIDATE_BITS = 24    # Windows are first looked up in a table with a bit for each of this many bits of their checksum.
+SIGNATURE = struct.Struct('!I16s')    # The Adler-32 checksum of a block, which can be rolled over the file cheaply, and its strong hash.
+
+
+def delta_block_size(size):
+    return min(DELTA_MAX_BLOCK_SIZE, max(DELTA_MIN_BLOCK_SIZE, 1 << round(math.log2(max(size, 1)) / 2)))
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def compute_signatures(path, block_size):
+    signatures = bytearray()
+
+    with open(path, 'rb') as file:
+        while block := file.read(block_size):
+            signatures += SIGNATURE.pack(zlib.adler32(block), strong_hash(block))
+
+    return bytes(signatures)
+
+
+def rolling_adler32(data, block_size):
+
+    # Both sums of Adler-32 for every block-sized window of the data at once, computed from running sums of the bytes.
+    # The second sum of a window weighs each byte by its distance to the end of the window, which is the same
+    # as adding up the running sums within the window, less the running sum before the window for each of them.
+    sums = numpy.zeros(len(data) + 1, numpy.int64)
+    numpy.cumsum(numpy.frombuffer(data, numpy.uint8), dtype=numpy.int64, out=sums[1:])
+
+    sums_of_sums = numpy.zeros(len(data) + 1, numpy.int64)
+    numpy.cumsum(sums[1:], out=sums_of_sums[1:])
+
+    a = (1 + sums[block_size:] - sums[:-block_size]) % ADLER_MODULUS
+    b = (block_size + sums_of_sums[block_size:] - sums_of_sums[:-block_size] - block_size * sums[:-block_size]) % ADLER_MODULUS
+
+    return a, b
+
+
+def candidate_index(a, b):
+
+    # Both sums go into the index, the first one only with its lowest bits, as its values are close together.
+    return b | (a & 0xff) << 16
+
+
+# Compare the file with the signatures of the blocks of a file the receiver already has, like the previous version of it.
+# Returns the checksums of the pieces the file is sent in from the offset on, along with the offset in the receiver's
+# file of each piece that can be copied from there. All other pieces have to be sent.
+def compute_delta(path, offset, block_size, signatures, piece_size):
+    blocks = {}    # The index of each block of the receiver's file, by its checksum and strong hash.
+    for index in range(len(signatures) // SIGNATURE.size):
+        weak, strong = SIGNATURE.unpack_from(signatures, index * SIGNATURE.size)
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    if numpy != None:
+        candidate_table = numpy.zeros(1 << CANDIDATE_BITS, bool)
+        weak_checksums = numpy.array(list(blocks), numpy.int64)
+        candidate_table[candidate_index(weak_checksums & 0xffff, weak_checksums >> 16)] = True
+
+    checksums = {}
+    copies = {}
+    size = os.path.getsize(path)
+
+    with open(path, 'rb') as file:
+        literal_start = offset    # The start of the data that couldn't be matched since the last copied block.
+        position = offset
+
+        while size - position >= block_size:
+            data = os.pread(file.fileno(), min(DELTA_SEGMENT_SIZE + block_size - 1, size - position), position)
+            window_count = len(data) - block_size + 1
+
+            # Without numpy, only blocks that are still at the same distance from the last match are found, like those of an edit in place.
+            if numpy != None:
+                a, b = rolling_adler32(data, block_size)
+                candidates = numpy.flatnonzero(candidate_table[candidate_index(a, b)])
+            else:
+                candidates = range(0, window_count, block_size)
+
+            segment_position = 0
+            candidate = 0
+            while candidate < len(candidates):
+                start = int(candidates[candidate])
+                candidate += 1
+
+                block = data[start:start + block_size]
+
+                weak = int(b[start]) << 16 | int(a[start]) if numpy != None else zlib.adler32(block)
+                if weak not in blocks:
+                    continue
+
+                index = blocks[weak].get(strong_hash(block))
+                if index == None:
+                    continue
+
+                add_literal(file, checksums, literal_start, position + start, piece_size)
+                add_copy(checksums, copies, position + start, index * block_size, block, piece_size)
+
+                segment_position = start + block_size
+                literal_start = position + segment_position
+
+                candidate = bisect.bisect_left(candidates, segment_position)    # Skips candidates overlapping the matched block.
+
+            position += max(segment_position, window_count)
+
+        add_literal(file, checksums, literal_start, size, piece_size)
+
+    return checksums, copies
+
+
+def add_literal(file, checksums, start, end, piece_size):
+    while start < end:
+        piece = os.pread(file.fileno(), min(piece_size, end - start), start)
+        checksums[start] = (len(piece), zlib.crc32(piece))
+        start += len(piece)
+
+
+def add_copy(checksums, copies, offset, source, block, piece_size):
+
+    # Blocks that follow each other in both files are copied together, up to the size of a piece.
+    if len(copies) > 0:
+        last_offset = next(reversed(copies))
+        last_size, last_checksum = checksums[last_offset]
+
+        if last_offset + last_size == offset and copies[last_offset] + last_size == source and last_size + len(block) <= piece_size:
+            checksums[last_offset] = (last_size + len(block), zlib.crc32(block, last_checksum))
+            return
+
+    checksums[offset] = (len(block), zlib.crc32(block))
+    copies[offset] = source
@@ -0,0 +1,306 @@
+import os
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    # Only needed for averaging sample parts, stitching tiles works without it.
+
+
+EXR_MAGIC = 20000630
+EXR_UNSUPPORTED_FLAGS = 0x200 | 0x800 | 0x1000    # Tiled, deep and multi-part images.
+
+# The number of scanlines stored together in one chunk for each compression method.
+EXR_CHUNK_SCANLINES = (1, 1, 1, 16, 32, 16, 32, 32, 32, 256)
+
+EXR_PIXEL_TYPES = ('<u4', '<f2', '<f4')    # Unsigned integer, half and single precision float samples.
+EXR_UINT = 0
+
+BOX2I = struct.Struct('<iiii')
+CHUNK_HEADER = struct.Struct('<iI')    # The y coordinate of the first scanline and the size of the data.
+
+COPY_SIZE = 4 * 1024 * 1024    # Chunks are copied in pieces of at most this size.
+
+
+class ExrFormatError(ValueError):
+    pass
+
+
+def read_exr_header(file):
+    magic, version = struct.unpack('<ii', file.read(8))
+    if magic != EXR_MAGIC:
+        raise ExrFormatError(f"'{file.name}' is not an OpenEXR image.")
+    if version & EXR_UNSUPPORTED_FLAGS:
+        raise ExrFormatError(f"'{file.name}' is not a single-part scanline image.")
+
+
+    # Attributes are kept as raw values, so they can be written back unchanged.
+    attributes = {}
+    while True:
+        name = read_string(file)
+        if name == '':
+            break
+
+        attribute_type = read_string(file)
+        size, = struct.unpack('<i', file.read(4))
+        if size < 0:
+            raise ExrFormatError(f"'{file.name}' has an attribute of negative size.")
+
+        attributes[name] = (attribute_type, file.read(size))
+
+    return version, attributes
+
+
+def read_string(file):
+    string = bytearray()
+    while (character := file.read(1)) not in (b'\0', b''):
+        string += character
+
+    return string.decode()
+
+
+def pack_exr_header(version, attributes):
+    attributes['lineOrder'] = ('lineOrder', b'\0')    # The chunks are written from top to bottom.
+
+    header = bytearray(struct.pack('<ii', EXR_MAGIC, version))
+    for name, (attribute_type, value) in attributes.items():
+        header += f"{name}\0{attribute_type}\0".encode() + struct.pack('<i', len(value)) + value
+    header += b'\0'
+
+    return header
+
+
+def read_exr_chunks(path):
+
+    # A truncated or corrupt image shows in reading values that are cut off, missing or out of range.
+    with open(path, 'rb') as file:
+        try:
+            version, attributes = read_exr_header(file)
+            for name in ('channels', 'compression', 'dataWindow'):
+                if name not in attributes:
+                    raise ExrFormatError(f"'{path}' has no {name} attribute.")
+
+            x_min, y_min, x_max, y_max = BOX2I.unpack(attributes['dataWindow'][1])
+            if x_max < x_min or y_max < y_min:
+                raise ExrFormatError(f"'{path}' has an empty data window.")
+
+            compression = attributes['compression'][1][0]
+            chunk_count = -(-(y_max - y_min + 1) // EXR_CHUNK_SCANLINES[compression])
+
+            offsets = struct.unpack(f'<{chunk_count}Q', file.read(8 * chunk_count))
+
+
+            # Only the location of each chunk is read, its data is copied straight from the file when stitching.
+            file_size = os.fstat(file.fileno()).st_size
+            chunks = []
+            for offset in offsets:
+                if offset > file_size:
+                    raise ExrFormatError(f"'{path}' is truncated or corrupt: a chunk lies beyond the end of the file.")
+
+                file.seek(offset)
+                y, size = CHUNK_HEADER.unpack(file.read(CHUNK_HEADER.size))
+                chunks.append((y, offset + CHUNK_HEADER.size, size))
+        except (struct.error, IndexError, UnicodeDecodeError) as error:
+            raise ExrFormatError(f"'{path}' is truncated or corrupt: {error}") from error
+
+    return version, attributes, chunks
+
+
+def read_channels(value):
+    channels = []
+    offset = 0
+    try:
+        while value[offset] != 0:
+            end = value.find(b'\0', offset)
+            if end == -1:
+                raise ExrFormatError("The name of a channel is cut off.")
+
+            pixel_type, linear, x_sampling, y_sampling = struct.unpack_from('<iB3xii', value, end + 1)
+            if (x_sampling, y_sampling) != (1, 1):
+                raise ExrFormatError("Subsampled channels are not supported.")
+            if pixel_type not in range(len(EXR_PIXEL_TYPES)):
+                raise ExrFormatError(f"Channel has unknown pixel type {pixel_type}.")
+
+            channels.append((value[offset:end].decode(), pixel_type))
+            offset = end + 17
+    except (struct.error, IndexError, UnicodeDecodeError) as error:
+        raise ExrFormatError(f"The list of channels is corrupt: {error}") from error
+
+    return channels
+
+
+def decompress_chunk(data, size, compression):
+    if compression == 0 or len(data) == size:
+        if len(data) != size:
+            raise ExrFormatError(f"Chunk holds {len(data)} bytes instead of {size}.")
+
+        return data    # Chunks that wouldn't get smaller are stored uncompressed.
+    if compression not in (2, 3):
+        raise ExrFormatError("Only uncompressed and ZIP compressed images can be averaged.")
+
+    try:
+        data = zlib.decompress(data)
+    except zlib.error as error:
+        raise ExrFormatError(f"Chunk can't be decompressed: {error}") from error
+
+    if len(data) != size:
+        raise ExrFormatError(f"Chunk decompresses to {len(data)} bytes instead of {size}.")
+
+
+    # Undo the prediction of each byte from the previous one, then split the bytes back into pairs.
+    predicted = numpy.frombuffer(data, numpy.uint8).copy()
+    predicted[1:] -= 128
+    interleaved = numpy.cumsum(predicted, dtype=numpy.uint8)
+
+    raw = numpy.empty_like(interleaved)
+    raw[0::2] = interleaved[:(len(raw) + 1) // 2]
+    raw[1::2] = interleaved[(len(raw) + 1) // 2:]
+
+    return raw.tobytes()
+
+
+def compress_chunk(raw, compression):
+    if compression == 0:
+        return raw
+
+    raw = numpy.frombuffer(raw, numpy.uint8)
+    interleaved = numpy.concatenate((raw[0::2], raw[1::2]))
+
+    predicted = interleaved.copy()
+    predicted[1:] = interleaved[1:] - interleaved[:-1] + 128
+
+    data = zlib.compress(predicted.tobytes())
+    if len(data) >= len(raw):
+        return raw.tobytes()
+
+    return data
+
+
+# Average the sample parts of an image, rendered with the same number of samples each, into one OpenEXR image.
+# Only one chunk of every part is held in memory at a time, so memory use doesn't grow with the size of the image.
+def average_exr(part_paths, path):
+    parts = [read_exr_chunks(part_path) for part_path in part_paths]
+
+    version, attributes, chunks = parts[0]
+    for part_path, (part_version, part_attributes, part_chunks) in zip(part_paths, parts):
+        for name in ('channels', 'compression', 'dataWindow'):
+            if part_attributes[name] != attributes[name]:
+                raise ExrFormatError(f"'{part_path}' doesn't match the other parts in {name}.")
+
+    x_min, y_min, x_max, y_max = BOX2I.unpack(attributes['dataWindow'][1])
+    compression = attributes['compression'][1][0]
+    chunk_scanlines = EXR_CHUNK_SCANLINES[compression]
+
+
+    # Within a chunk, each scanline holds the samples of one channel after the other.
+    width = x_max - x_min + 1
+    channels = read_channels(attributes['channels'][1])
+    scanline_type = numpy.dtype([(name, EXR_PIXEL_TYPES[pixel_type], width) for name, pixel_type in channels])
+
+    header = pack_exr_header(version, attributes)
+
+    part_files = [open(part_path, 'rb') for part_path in part_paths]
+    try:
+        with open(path, 'wb') as file:
+            file.write(header)
+            file.seek(8 * len(chunks), 1)    # The offset table is written once the size of every chunk is known.
+
+            offsets = []
+            for index, (y, offset, size) in enumerate(chunks):
+                scanline_count = min(chunk_scanlines, y_max - y + 1)
+
+                sums = None
+                for part_file, (part_version, part_attributes, part_chunks) in zip(part_files, parts):
+                    part_y, part_offset, part_size = part_chunks[index]
+
+                    part_file.seek(part_offset)
+                    raw = decompress_chunk(part_file.read(part_size), scanline_count * scanline_type.itemsize, compression)
+                    scanlines = numpy.frombuffer(raw, scanline_type)
+
+                    if sums == None:
+                        first_scanlines = scanlines
+                        sums = {name: scanlines[name].astype(numpy.float64) for name, pixel_type in channels if pixel_type != EXR_UINT}
+                    else:
+                        for name in sums:
+                            sums[name] += scanlines[name]
+
+
+                # Integer channels like object indices can't be averaged, they are taken from the first part.
+                averaged = first_scanlines.copy()
+                for name, channel_sum in sums.items():
+                    averaged[name] = channel_sum / len(parts)
+
+                data = compress_chunk(averaged.tobytes(), compression)
+
+                offsets.append(file.tell())
+                file.write(CHUNK_HEADER.pack(y, len(data)))
+                file.write(data)
+
+            file.seek(len(header))
+            file.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+    finally:
+        for part_file in part_files:
+            part_file.close()
+
+
+# Stack the horizontal tiles of an image, given from top to bottom, into one OpenEXR image. The compressed chunks
+# of the tiles are copied as they are, so the merge is lossless and doesn't need to decode any pixels.
+def stitch_exr(tile_paths, path):
+    tiles = [read_exr_chunks(tile_path) for tile_path in tile_paths]
+
+    version, attributes, chunks = tiles[0]
+    x_min, y_min, x_max, y_max = BOX2I.unpack(attributes['dataWindow'][1])
+    chunk_scanlines = EXR_CHUNK_SCANLINES[attributes['compression'][1][0]]
+
+
+    # Each tile continues where the one above it ends, which requires tiles to end on a chunk boundary.
+    height = 0
+    chunk_count = 0
+    for tile_path, (tile_version, tile_attributes, tile_chunks) in zip(tile_paths, tiles):
+        tile_x_min, tile_y_min, tile_x_max, tile_y_max = BOX2I.unpack(tile_attributes['dataWindow'][1])
+
+        if (tile_x_min, tile_x_max) != (x_min, x_max) or tile_attributes['channels'] != attributes['channels'] \
+                or tile_attributes['compression'] != attributes['compression']:
+            raise ExrFormatError(f"'{tile_path}' doesn't match the other tiles in width, channels or compression.")
+        if height % chunk_scanlines != 0:
+            raise ExrFormatError(f"The tile above '{tile_path}' doesn't end on a chunk boundary.")
+
+        tile_chunks[:] = [(y - tile_y_min + y_min + height, offset, size) for y, offset, size in tile_chunks]
+
+        height += tile_y_max - tile_y_min + 1
+        chunk_count += len(tile_chunks)
+
+
+    window = BOX2I.pack(x_min, y_min, x_max, y_min + height - 1)
+    attributes['dataWindow'] = ('box2i', window)
+    attributes['displayWindow'] = ('box2i', window)
+
+    header = pack_exr_header(version, attributes)
+
+
+    # The offset table follows the header, the chunks follow the offset table in the order of their scanlines.
+    offsets = []
+    offset = len(header) + 8 * chunk_count
+    for tile_version, tile_attributes, tile_chunks in tiles:
+        for y, tile_offset, size in tile_chunks:
+            offsets.append(offset)
+            offset += CHUNK_HEADER.size + size
+
+    with open(path, 'wb') as file:
+        file.write(header)
+        file.write(struct.pack(f'<{chunk_count}Q', *offsets))
+
+        for tile_path, (tile_version, tile_attributes, tile_chunks) in zip(tile_paths, tiles):
+            with open(tile_path, 'rb') as tile_file:
+                for y, tile_offset, size in tile_chunks:
+                    file.write(CHUNK_HEADER.pack(y, size))
+
+                    tile_file.seek(tile_offset)
+                    while size > 0:
+                        data = tile_file.read(min(size, COPY_SIZE))
+                        if len(data) == 0:
+                            raise ExrFormatError(f"'{tile_path}' is truncated.")
+
+                        file.write(data)
+                        size -= len(data)
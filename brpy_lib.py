@@ -1,29 +1,1296 @@
-import sys
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import heapq
+import json
+import lzma
+import math
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None    # Faster codecs are used if they are installed, zlib and lzma are always available.
 
-def receive_bytes(connection, size, prefix=''):
-    buffer = bytearray(size)
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+CHUNK_SIZE = 4 * 1024 * 1024    # Files are streamed in chunks of this size, so memory usage doesn't grow with the file size.
+
+WRITE_QUEUE_SIZE = 16                 # The number of received chunks that may wait to be written, before receiving has to wait for the disk.
+FSYNC_BATCH_SIZE = 32                 # When syncing in batches, files are synced once this many have been written
+FSYNC_BATCH_INTERVAL = 5              # or this many seconds have passed since the last batch.
+
+HISTOGRAM_BUCKETS = 24    # Durations are counted in buckets doubling in size from one millisecond up to more than an hour.
+STATS_STAGES = ('queue', 'render', 'save', 'send', 'relay')    # The stages a frame passes through on a node, which are timed.
+
+COMPRESSION_MAX_RATIO = 0.9     # Blocks that don't shrink below this fraction of their size are sent uncompressed,
+COMPRESSION_MAX_BACKOFF = 64    # after which up to this many blocks are sent uncompressed before compression is tried again.
+COMPRESSION_SAMPLE = 64 * 1024  # Bytes at the start of a block compressed first, to find out cheaply whether the block is worth compressing.
+
+LINK_PIECE_SIZE = 256 * 1024          # Streams sharing a link take turns sending pieces of at most this size.
+LINK_WINDOW_SIZE = 8 * 1024 * 1024    # The number of bytes a stream may send before the receiving side has to grant more.
+
+
+class ConnectionBrokenError(ConnectionError):
+    pass
+
+
+def receive_into(connection, view, prefix=''):
     total_bytes_received = 0
 
-    while True:
-            bytes_received = connection.recv_into(memoryview(buffer)[total_bytes_received:])
+    while total_bytes_received < len(view):
+        try:
+            bytes_received = connection.recv_into(view[total_bytes_received:])
+        except ConnectionResetError:
+            bytes_received = 0    # A peer closing with unread data resets the connection, which is just as broken.
 
-            if bytes_received == 0:
-                if prefix == '':
+        if bytes_received == 0:
+            if prefix == '':
+                try:
                     prefix = f"[{connection.getpeername()[0]}:{connection.getpeername()[1]}]"
-                print(f"{prefix} Connection broken, exiting.")
-                sys.exit()
+                except OSError:
+                    prefix = "[disconnected]"    # A reset connection no longer knows its peer.
+            print(f"{prefix} Connection broken.")
+            raise ConnectionBrokenError(prefix)
+
+        total_bytes_received += bytes_received
+
+
+def receive_bytes(connection, size, prefix=''):
+    buffer = bytearray(size)
+    receive_into(connection, memoryview(buffer), prefix)
+
+    return buffer
+
+
+JSON_PROTOCOL = 0      # Headers are JSON behind an 8-byte length, which every peer understands.
+BINARY_PROTOCOL = 1    # Headers are packed binary structures behind a 4-byte length, if both peers support it.
+
+PROTOCOLS = (JSON_PROTOCOL, BINARY_PROTOCOL)    # The protocol versions this node supports.
+
+
+# The messages of the binary protocol, each identified by its index. Fixed fields are packed with one struct,
+# variable fields are strings or lists of frames preceded by their length, optional fields are flagged by a bit each.
+BINARY_MESSAGES = (
+    # key,      value,        fixed fields,                                variable fields,          optional fields
+    ('type',    'SERVE',      (('port',), struct.Struct('!H')),            (),                       ()),
+    ('type',    'UPLOAD',     (('size',), struct.Struct('!Q')),            ('session', 'hash'),      ('delta',)),
+    ('type',    'CHUNK',      (('offset', 'size', 'checksum'), struct.Struct('!QQI')), (),           ('codec',)),
+    ('type',    'RENDER',     ((), struct.Struct('!')),                    ('session', 'frames'),    ('render_format', 'token', 'tiles', 'sample_parts')),
+    ('type',    'CANCEL',     ((), struct.Struct('!')),                    ('frames',),              ('session',)),
+    ('type',    'DELETE',     ((), struct.Struct('!')),                    ('session',),             ()),
+    ('status',  'OKAY',       ((), struct.Struct('!')),                    (),                       ('stats',)),
+    ('status',  'SEND',       (('offset',), struct.Struct('!Q')),          (),                       ()),
+    ('status',  'FAIL',       ((), struct.Struct('!')),                    ('error',),               ()),
+    ('type',    'REQUEST',    (('frame_count',), struct.Struct('!I')),     (),                       ('token',)),
+    ('type',    'HEARTBEAT',  ((), struct.Struct('!')),                    (),                       ()),
+    ('type',    'FRAME',      (('frame_size', 'frame_number'), struct.Struct('!Qi')), ('file_extension',), ('codec', 'render_time')),
+    ('type',    'STATS',      ((), struct.Struct('!')),                    (),                       ()),
+    ('status',  'DELTA',      (('offset', 'block_size', 'size'), struct.Struct('!QIQ')), ('base',),  ()),
+    ('type',    'COPY',       (('offset', 'size', 'checksum', 'source'), struct.Struct('!QQIQ')), (), ()),
+    ('type',    'FAILED',     (('frame_number',), struct.Struct('!i')),    ('error',),               ()),
+)
+
+BINARY_MESSAGE_CODES = {(key, value): code for code, (key, value, *fields) in enumerate(BINARY_MESSAGES)}
+
+BINARY_PREFIX = struct.Struct('!IBB')    # Length of the message after the length itself, message code and flags of optional fields.
+
+
+def pack_field(name, value, parts):
+    if name == 'frames':
+        if type(value) == int:
+            value = [value]
+        parts.append(struct.pack(f'!I{len(value)}i', len(value), *value))
+    elif name in ('tiles', 'sample_parts'):
+        parts.append(struct.pack('!I', value))
+    elif name == 'render_time':
+        parts.append(struct.pack('!d', value))
+    elif name == 'stats':
+        value = json.dumps(value).encode()    # Statistics are nested and may describe a whole tree of nodes.
+        parts.append(len(value).to_bytes(4))
+        parts.append(value)
+    else:
+        value = value.encode()
+        parts.append(len(value).to_bytes(2))
+        parts.append(value)
+
+
+def unpack_field(name, data, offset):
+    if name == 'frames':
+        count, = struct.unpack_from('!I', data, offset)
+        return list(struct.unpack_from(f'!{count}i', data, offset + 4)), offset + 4 + 4 * count
+    if name in ('tiles', 'sample_parts'):
+        return struct.unpack_from('!I', data, offset)[0], offset + 4
+    if name == 'render_time':
+        return struct.unpack_from('!d', data, offset)[0], offset + 8
+    if name == 'stats':
+        size = int.from_bytes(data[offset:offset + 4])
+        return json.loads(data[offset + 4:offset + 4 + size]), offset + 4 + size
+
+    size = int.from_bytes(data[offset:offset + 2])
+    return str(data[offset + 2:offset + 2 + size], 'utf-8'), offset + 2 + size
+
+
+def encode_message(header, protocol=JSON_PROTOCOL):
+    if protocol == JSON_PROTOCOL:
+        header_raw = json.dumps(header).encode()
+        return len(header_raw).to_bytes(8) + header_raw
+
+    key = 'type' if 'type' in header else 'status'
+    code = BINARY_MESSAGE_CODES[(key, header[key])]
+    key, value, (fixed_fields, fixed_struct), variable_fields, optional_fields = BINARY_MESSAGES[code]
+
+    parts = [b'', fixed_struct.pack(*(header[name] for name in fixed_fields))]
+    for name in variable_fields:
+        pack_field(name, header[name], parts)
+
+    flags = 0
+    for bit, name in enumerate(optional_fields):
+        if name in header:
+            flags |= 1 << bit
+            pack_field(name, header[name], parts)
+
+    size = sum(len(part) for part in parts) + BINARY_PREFIX.size - 4
+    parts[0] = BINARY_PREFIX.pack(size, code, flags)
+
+    return b''.join(parts)
+
+
+def decode_message(code, flags, data):
+    key, value, (fixed_fields, fixed_struct), variable_fields, optional_fields = BINARY_MESSAGES[code]
+
+    header = {key: value}
+    header.update(zip(fixed_fields, fixed_struct.unpack_from(data)))
+
+    offset = fixed_struct.size
+    for name in variable_fields:
+        header[name], offset = unpack_field(name, data, offset)
+
+    for bit, name in enumerate(optional_fields):
+        if flags & 1 << bit:
+            header[name], offset = unpack_field(name, data, offset)
+
+    return header
+
+
+async def receive_message(reader, prefix='', protocol=JSON_PROTOCOL):
+
+    # Returns the message as received, so it can be passed on to peers speaking the same protocol without encoding it again.
+    try:
+        if protocol == JSON_PROTOCOL:
+            message_prefix = await reader.readexactly(8)
+            header_raw = await reader.readexactly(int.from_bytes(message_prefix))
+        else:
+            message_prefix = await reader.readexactly(BINARY_PREFIX.size)
+            size, code, flags = BINARY_PREFIX.unpack(message_prefix)
+            header_raw = await reader.readexactly(size - BINARY_PREFIX.size + 4)
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        print(f"{prefix} Connection broken.")
+        raise ConnectionBrokenError(prefix)
+
+    if protocol == JSON_PROTOCOL:
+        return message_prefix + header_raw, json.loads(header_raw)
+
+    return message_prefix + header_raw, decode_message(code, flags, header_raw)
+
+
+async def send_message(writer, message_raw, payload=None):
+
+    # A payload is handed to the transport along with the message, so both can go out in a single system call.
+    if payload == None:
+        writer.write(message_raw)
+    else:
+        writer.writelines((message_raw, payload))
+
+    await writer.drain()    # Waits while the peer is slow to read, so buffered data stays bounded.
+
+
+async def negotiate_protocol(reader, writer, prefix='', timeout=None, multiplex=False, codecs=()):
+
+    # Peers that don't know of protocol negotiation break the connection or don't answer at all,
+    # in which case None is returned and a new connection has to be made using JSON headers.
+    # If multiplexing is asked for and the peer agrees to it, the connection becomes a link.
+    # Both sides tell each other the codecs they accept, each side compresses what it sends with one the other accepts.
+    await send_message(writer, encode_message(HelloRequest(PROTOCOLS, multiplex, codecs).__dict__))
+
+    try:
+        response_header_raw, response_header = await asyncio.wait_for(receive_message(reader, prefix), timeout)
+    except (ConnectionError, TimeoutError):
+        return None
+
+    return response_header
+
+
+async def relay_stream(reader, writer, size, prefix='', timeout=None):
+
+    # Whatever has arrived is passed on right away, so only the buffers of the two streams are ever held in memory.
+    while size > 0:
+        try:
+            chunk = await asyncio.wait_for(reader.read(min(size, CHUNK_SIZE)), timeout)
+        except ConnectionResetError:
+            chunk = b''
+
+        if len(chunk) == 0:
+            print(f"{prefix} Connection broken.")
+            raise ConnectionBrokenError(prefix)
+
+        writer.write(chunk)
+        await writer.drain()
+        size -= len(chunk)
+
+
+# The codecs this node can decompress, with functions to compress and decompress a block, in the order they are preferred in.
+# Installed codecs come first as they compress the fastest, lzma comes last as it compresses the best but the slowest.
+CODECS = {}
+
+if zstandard != None:
+    CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=1).compress(data), lambda data: zstandard.ZstdDecompressor().decompress(data))
+if lz4 != None:
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+
+CODECS['zlib'] = (lambda data: zlib.compress(data, 1), zlib.decompress)
+CODECS['lzma'] = (lambda data: lzma.compress(data, preset=1), lzma.decompress)
+
+COMPRESSION_BLOCK = struct.Struct('!II')    # Size of the data of a block and the size it is sent with, which are equal if it is sent uncompressed.
+
+
+class Compressor:
+
+    # Compresses the blocks sent over one connection with the first codec of this node the peer accepts,
+    # but only as long as compressing a block and sending the rest takes less time than sending the block as it is.
+    def __init__(self, codecs=(), accepted=()):
+        self.accepted = accepted           # The codecs the peer can decompress.
+        self.codec = next((codec for codec in codecs if codec in accepted), None)
+        self.compress_rate = None          # Exponential moving averages of the bytes compressed per second
+        self.send_rate = None              # and of the bytes sent per second.
+        self.skipped = 0                   # The number of blocks left to send uncompressed before trying compression again,
+        self.backoff = 1                   # which doubles each time compression doesn't pay off.
+
+    # Whether to send the next block as it is without trying to compress it, which lets it go from its file straight to the socket.
+    def skip(self):
+        if self.codec == None:
+            return True
+
+        if self.skipped > 0:
+            self.skipped -= 1
+            return True
+
+        return False
+
+    # Returns the block compressed, or as it is if compressing it doesn't pay off.
+    async def compress(self, data):
+
+        # Blocks that are already compressed, like most images, are recognized from a sample without compressing all of them.
+        if len(data) > COMPRESSION_SAMPLE:
+            sample = data[:COMPRESSION_SAMPLE]
+            if not self.pays(len(sample), len(await self.run_codec(sample))):
+                return data
+
+        compressed = await self.run_codec(data)
+        if not self.pays(len(data), len(compressed)):
+            return data
+
+        return compressed
+
+    async def run_codec(self, data):
+
+        # Compressing is left to a thread, the codecs release the GIL, so other connections aren't held up meanwhile.
+        compress_start = time.perf_counter()
+        compressed = await asyncio.to_thread(CODECS[self.codec][0], data)
+        compress_time = time.perf_counter() - compress_start
+
+        if compress_time > 0:
+            self.compress_rate = moving_average(self.compress_rate, len(data) / compress_time)
+
+        return compressed
+
+    def pays(self, size, compressed_size):
+        ratio = compressed_size / size
+        if ratio > COMPRESSION_MAX_RATIO or (self.send_rate != None and self.compress_rate != None and 1 / self.compress_rate + ratio / self.send_rate >= 1 / self.send_rate):
+            self.skipped = self.backoff
+            self.backoff = min(2 * self.backoff, COMPRESSION_MAX_BACKOFF)
+            return False
+
+        self.backoff = 1
+
+        return True
+
+    def sent(self, size, send_time):
+        if send_time > 0:
+            self.send_rate = moving_average(self.send_rate, size / send_time)
+
+
+async def send_block(writer, data, compressor, block=None):
+    if block == None:
+        block = data if compressor.skip() else await compressor.compress(data)
+
+    send_start = time.perf_counter()
+    await send_message(writer, COMPRESSION_BLOCK.pack(len(data), len(block)), block)
+    compressor.sent(len(block), time.perf_counter() - send_start)
+
+
+async def receive_block_header(reader, prefix='', timeout=None):
+    try:
+        return COMPRESSION_BLOCK.unpack(await asyncio.wait_for(reader.readexactly(COMPRESSION_BLOCK.size), timeout))
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        print(f"{prefix} Connection broken.")
+        raise ConnectionBrokenError(prefix)
+
+
+async def receive_block(reader, codec, prefix='', timeout=None):
+    size, sent_size = await receive_block_header(reader, prefix, timeout)
+
+    try:
+        block = await asyncio.wait_for(reader.readexactly(sent_size), timeout)
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        print(f"{prefix} Connection broken.")
+        raise ConnectionBrokenError(prefix)
+
+    if sent_size == size:
+        return block
+
+
+    # A block that can't be decompressed leaves the rest of the stream in doubt, so the connection is given up on.
+    try:
+        data = await asyncio.to_thread(CODECS[codec][1], block)
+    except Exception:
+        data = None
+
+    if data == None or len(data) != size:
+        print(f"{prefix} Received a block that could not be decompressed with codec '{codec}', breaking connection.")
+        raise ConnectionBrokenError(prefix)
+
+    return data
+
+
+async def relay_blocks(reader, writer, size, prefix='', timeout=None):
+
+    # Compressed blocks are passed on as they are, until they add up to the size of the data once decompressed.
+    while size > 0:
+        block_size, sent_size = await receive_block_header(reader, prefix, timeout)
+
+        writer.write(COMPRESSION_BLOCK.pack(block_size, sent_size))
+        await relay_stream(reader, writer, sent_size, prefix, timeout)
+
+        size -= block_size
+
+
+def parse_codecs(codec_list):
+    if codec_list == 'none':
+        return []
+
+    codecs = [codec.strip() for codec in codec_list.split(',')]
+    for codec in codecs:
+        if codec not in CODECS:
+            raise ValueError(codec)
+
+    return codecs
+
+
+async def send_file(writer, file, offset=0, count=None):
+    if not isinstance(writer.transport, LinkStream):
+        await asyncio.get_running_loop().sendfile(writer.transport, file, offset, count)    # Let the kernel copy from the file to the socket directly.
+        return
+
+
+    # The data of a stream is interleaved with that of other streams on its link, so it has to pass through the stream.
+    if count == None:
+        count = os.fstat(file.fileno()).st_size - offset
+
+    while count > 0:
+        chunk = os.pread(file.fileno(), min(count, CHUNK_SIZE), offset)
+        if len(chunk) == 0:
+            break
+
+        writer.write(chunk)
+        await writer.drain()
+
+        offset += len(chunk)
+        count -= len(chunk)
+
+
+def moving_average(average, value, weight=0.2):
+    if average == None:
+        return value
+
+    return average + weight * (value - average)
+
+
+def hash_file(path):
+
+    # The checksums of all chunks are collected on the way, so the file can later be sent without reading it again.
+    digest = hashlib.sha256()
+    checksums = {}
+
+    with open(path, 'rb') as file:
+        offset = 0
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+            checksums[offset] = (len(chunk), zlib.crc32(chunk))
+            offset += len(chunk)
+
+    return digest.hexdigest(), checksums
+
+
+async def stream_chunks(writer, upload, offset=0, protocol=JSON_PROTOCOL, compressor=None, delta=False):
+    with open(upload.path, 'rb') as file:
+        while offset < upload.size:
+
+            # The upload may still be arriving, in which case chunks are sent on as soon as they have been committed.
+            if not await upload.wait(offset + 1):
+                return False
+
+
+            # Chunks are sent with the boundaries they were received with, where those are known. Others are read
+            # up to the next known boundary to compute their checksum, like those of a partial file from an earlier run.
+            chunk_size, checksum = upload.checksums.get(offset, (None, None))
+            if chunk_size != None:
+                chunk = None
+            else:
+                boundary = min((chunk_offset for chunk_offset in upload.checksums if chunk_offset > offset), default=upload.size)
+                chunk_size = min(CHUNK_SIZE, boundary - offset)
+
+                if not await upload.wait(offset + chunk_size):
+                    return False
+
+                chunk = os.pread(file.fileno(), chunk_size, offset)
+                checksum = zlib.crc32(chunk)
+
+
+            # If the receiver has the file the chunk was copied from, it is told to copy it as well instead of being sent it.
+            if delta and offset in upload.copies:
+                await send_message(writer, encode_message(UploadCopy(offset, chunk_size, checksum, upload.copies[offset]).__dict__, protocol))
+
+                offset += chunk_size
+                continue
+
+
+            # Compressed chunks are sent as a block, the checksum still covers the chunk as it was read.
+            if compressor != None and not compressor.skip():
+                if chunk == None:
+                    chunk = os.pread(file.fileno(), chunk_size, offset)
+
+                block = await compressor.compress(chunk)
+                if len(block) < len(chunk):
+                    chunk_header = encode_message(UploadChunk(offset, chunk_size, checksum, compressor.codec).__dict__, protocol)
+
+                    await send_message(writer, chunk_header)
+                    await send_block(writer, chunk, compressor, block)
+
+                    offset += chunk_size
+                    continue
+
+
+            # While compression doesn't pay off, chunks are sent as they are, which lets the kernel copy them from the file.
+            chunk_header = encode_message(UploadChunk(offset, chunk_size, checksum).__dict__, protocol)
+
+            send_start = time.perf_counter()
+            if chunk != None:
+                await send_message(writer, chunk_header, chunk)
+            else:
+                await send_message(writer, chunk_header)
+                await send_file(writer, file, offset, chunk_size)
+
+            if compressor != None:
+                compressor.sent(chunk_size, time.perf_counter() - send_start)
+
+            offset += chunk_size
+
+    return True
+
+
+def hash_prefix(path, size, digest):
+    with open(path, 'rb') as file:
+        while chunk := file.read(min(CHUNK_SIZE, size - file.tell())):
+            digest.update(chunk)
+
+
+def store_chunk(file, chunk, expected_checksum, digest):
+
+    # Checks, writes and hashes a received chunk, which is done in a thread, so large uploads don't hold up other connections.
+    checksum = zlib.crc32(chunk)
+    if checksum != expected_checksum:
+        return None
+
+    file.write(chunk)
+    file.flush()    # Make the chunk visible to the tasks forwarding it to children.
+
+    digest.update(chunk)
+
+    return checksum
+
+
+async def receive_chunks(reader, upload, prefix='', protocol=JSON_PROTOCOL, base=None, timeout=None):
+
+    # Whatever an interrupted upload already committed is hashed first, so the digest covers the whole file.
+    # Reading it back is left to a thread, so other connections aren't held up meanwhile.
+    await asyncio.to_thread(hash_prefix, upload.path, upload.committed, upload.digest)
+
+    # Append to the partial file, so only chunks that arrived intact are ever committed to it.
+    # The file copied from is opened right away, so it stays readable even if its session moves on to another file meanwhile.
+    with open(upload.path, 'a+b') as file, open(base, 'rb') if base != None else contextlib.nullcontext() as base_file:
+        file.truncate(upload.committed)
+
+        # An uploader that stopped sending without closing the connection would keep others from taking over the upload.
+        offset = upload.committed
+        while offset < upload.size:
+            try:
+                chunk_header_raw, chunk_header = await asyncio.wait_for(receive_message(reader, prefix, protocol), timeout)
+            except TimeoutError:
+                return f"No chunk received for {timeout} seconds."
+
+            if chunk_header['offset'] != offset or chunk_header['size'] > min(CHUNK_SIZE, upload.size - offset):
+                return f"Expected chunk at offset {offset}, received chunk at offset {chunk_header['offset']}."
+
+            source = chunk_header.get('source')
+            if chunk_header['type'] == 'COPY':
+                if base == None:
+                    return f"Received copy at offset {offset}, but there is no file to copy from."
+
+                chunk = await asyncio.to_thread(os.pread, base_file.fileno(), chunk_header['size'], source)
+            elif 'codec' in chunk_header:
+                try:
+                    chunk = await receive_block(reader, chunk_header['codec'], prefix, timeout)
+                except TimeoutError:
+                    return f"Chunk at offset {offset} stopped arriving for {timeout} seconds."
+
+                if len(chunk) != chunk_header['size']:
+                    return f"Chunk at offset {offset} does not match its size."
+            else:
+                try:
+                    chunk = await asyncio.wait_for(reader.readexactly(chunk_header['size']), timeout)
+                except (asyncio.IncompleteReadError, ConnectionResetError):
+                    print(f"{prefix} Connection broken.")
+                    raise ConnectionBrokenError(prefix)
+                except TimeoutError:
+                    return f"Chunk at offset {offset} stopped arriving for {timeout} seconds."
+
+            checksum = await asyncio.to_thread(store_chunk, file, chunk, chunk_header['checksum'], upload.digest)
+            if checksum == None:
+                if chunk_header['type'] == 'COPY':
+                    return f"Copy at offset {offset} does not match its checksum."
+                return f"Chunk at offset {offset} does not match its checksum."
+
+            await upload.commit(len(chunk), checksum, source)
+            offset += len(chunk)
+
+
+LINK_FRAME = struct.Struct('!IBI')    # Stream, kind and size of the frames data of streams is sent in over a link.
+
+LINK_DATA = 0      # Data of a stream, which is opened by its first frame.
+LINK_WINDOW = 1    # Grants the stream to send as many more bytes as the size says, no data follows.
+LINK_CLOSE = 2     # The stream has been closed, no data follows.
+
+
+class LinkStream(asyncio.Transport):
+
+    # A transport for one of the streams of a link, so the streams of asyncio can be used on it like on a connection.
+    def __init__(self, link, stream_id, protocol):
+        peername = link.writer.get_extra_info('peername')
+        super().__init__({'peername': (peername[0], f"{peername[1]}/{stream_id}")})
+
+        self.link = link
+        self.stream_id = stream_id
+        self.protocol = protocol
+        self.buffer = bytearray()           # Data waiting to be sent.
+        self.window = LINK_WINDOW_SIZE      # The number of bytes that may be sent before the other side grants more.
+        self.credit = 0                     # Bytes received while reading was paused, which are granted once it resumes.
+        self.reading_paused = False
+        self.writing_paused = False
+        self.closing = False
+        self.lost = False
+        self.scheduled = False
+
+    def write(self, data):
+        if self.closing:
+            return
+
+        self.buffer += data
+        self.link.schedule(self)
+
+        if not self.writing_paused and len(self.buffer) > 2 * LINK_PIECE_SIZE:
+            self.writing_paused = True
+            self.protocol.pause_writing()
+
+    def sent(self):
+        if self.writing_paused and len(self.buffer) <= LINK_PIECE_SIZE:
+            self.writing_paused = False
+            self.protocol.resume_writing()
+
+    def can_write_eof(self):
+        return False
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        if self.closing:
+            return
+
+        self.closing = True
+        self.link.schedule(self)    # The stream is closed once its buffered data has been sent.
+
+    def abort(self):
+        self.buffer.clear()
+        self.close()
 
-            total_bytes_received += bytes_received
+    def get_write_buffer_size(self):
+        return len(self.buffer)
 
-            if total_bytes_received == size:
-                return buffer
+    def pause_reading(self):
+        self.reading_paused = True
+
+    def resume_reading(self):
+        self.reading_paused = False
+
+        if self.credit > 0 and not self.lost:
+            self.link.grant(self.stream_id, self.credit)
+            self.credit = 0
+
+    def is_reading(self):
+        return not self.reading_paused
+
+    def lose(self):
+        if self.lost:
+            return
+
+        self.lost = True
+        self.closing = True
+        self.buffer.clear()
+
+        self.protocol.connection_lost(None)    # The reader sees the end of the stream and the writer can't drain anymore.
+
+
+class Link:
+
+    # A single connection between a parent and a child node, carrying a stream for each client the parent serves.
+    def __init__(self, reader, writer, protocol, prefix, handle_stream=None, compressor=None):
+        self.reader = reader
+        self.writer = writer
+        self.protocol = protocol               # The protocol spoken on every stream of the link.
+        self.compressor = Compressor() if compressor == None else compressor    # Shared by every stream of the link.
+        self.prefix = prefix
+        self.handle_stream = handle_stream     # Called with the reader and writer of each stream the other side opens.
+        self.streams = {}
+        self.last_stream_id = 0
+        self.ready = collections.deque()       # Streams with data to send or waiting to be closed, in the order they take turns.
+        self.ready_event = asyncio.Event()
+        self.closed = False
+        self.tasks = set()
+
+    def open_stream(self):
+        if self.closed:
+            raise ConnectionResetError(self.prefix)
+
+        self.last_stream_id += 1
+        return self.add_stream(self.last_stream_id)
+
+    def add_stream(self, stream_id):
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+
+        transport = LinkStream(self, stream_id, protocol)
+        protocol.connection_made(transport)
+        self.streams[stream_id] = transport
+
+        return reader, asyncio.StreamWriter(transport, protocol, reader, asyncio.get_running_loop())
+
+    def schedule(self, transport):
+        if not transport.scheduled:
+            transport.scheduled = True
+            self.ready.append(transport)
+            self.ready_event.set()
+
+    def grant(self, stream_id, size):
+        self.writer.write(LINK_FRAME.pack(stream_id, LINK_WINDOW, size))
+
+    async def send_pieces(self):
+        while True:
+            await self.ready_event.wait()
+            self.ready_event.clear()
+
+            # Every stream sends at most one piece before it is the next stream's turn, so no client can hold up the others.
+            while len(self.ready) > 0 and not self.closed:
+                transport = self.ready.popleft()
+                transport.scheduled = False
+
+                size = min(len(transport.buffer), transport.window, LINK_PIECE_SIZE)
+                if size > 0:
+                    self.writer.writelines((LINK_FRAME.pack(transport.stream_id, LINK_DATA, size), transport.buffer[:size]))
+                    del transport.buffer[:size]
+                    transport.window -= size
+                    transport.sent()
+
+                if len(transport.buffer) > 0:
+                    if transport.window > 0:
+                        self.schedule(transport)
+                elif transport.closing and not transport.lost:
+                    self.writer.write(LINK_FRAME.pack(transport.stream_id, LINK_CLOSE, 0))
+                    self.streams.pop(transport.stream_id, None)
+                    transport.lose()
+
+                try:
+                    await self.writer.drain()
+                except ConnectionError:
+                    return    # The task receiving from the link notices the loss as well.
+
+    async def run(self):
+        sender = asyncio.create_task(self.send_pieces())
+
+        try:
+            while True:
+                stream_id, kind, size = LINK_FRAME.unpack(await self.reader.readexactly(LINK_FRAME.size))
+
+                if kind == LINK_DATA:
+                    data = await self.reader.readexactly(size)
+
+                    transport = self.streams.get(stream_id)
+                    if transport == None:
+
+                        # Data for streams that have already been closed is dropped, any other stream is a new one.
+                        if self.handle_stream == None or stream_id <= self.last_stream_id:
+                            continue
+
+                        self.last_stream_id = stream_id
+                        stream_reader, stream_writer = self.add_stream(stream_id)
+
+                        task = asyncio.create_task(self.handle_stream(stream_reader, stream_writer))
+                        self.tasks.add(task)
+                        task.add_done_callback(self.tasks.discard)
+
+                        transport = self.streams[stream_id]
+
+                    transport.protocol.data_received(data)
+
+                    # More data is only granted while it is being read, so a slow client only holds up its own stream.
+                    if transport.reading_paused:
+                        transport.credit += size
+                    else:
+                        self.grant(stream_id, size)
+
+                elif kind == LINK_WINDOW:
+                    transport = self.streams.get(stream_id)
+                    if transport != None:
+                        transport.window += size
+                        if len(transport.buffer) > 0:
+                            self.schedule(transport)
+
+                elif kind == LINK_CLOSE:
+                    transport = self.streams.pop(stream_id, None)
+                    if transport != None:
+                        transport.lose()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print(f"{self.prefix} Link broken.")
+        finally:
+            self.closed = True
+            sender.cancel()
+
+            for transport in list(self.streams.values()):
+                transport.lose()
+            self.streams.clear()
+
+            self.writer.close()
 
 
 class Child:
     def __init__(self, address):
         self.address = address
-        self.connections = {}
+        self.link = None                     # The link all clients share to reach the child, if the child supports links.
+        self.link_lock = asyncio.Lock()
+        self.relayed = Throughput()          # Frames relayed from the child to clients.
+
+
+class ChildLink:
+    def __init__(self, reader, writer, protocol, prefix, relayed=None):
+        self.reader = reader
+        self.writer = writer
+        self.protocol = protocol
+        self.prefix = prefix
+        self.relayed = Throughput() if relayed == None else relayed    # Shared by all clients of the same child.
+        self.credits = asyncio.Semaphore(1)    # The number of frames the child has requested, starting with its first one.
+        self.forwarded = {}                    # Render requests sent to the child that haven't been answered with a frame yet, by frame.
+        self.lost = False
+
+
+class Worker:
+    def __init__(self, process, reader, writer, cpus=None, crashes=0):
+        self.process = process
+        self.reader = reader
+        self.writer = writer
+        self.cpus = cpus          # The CPUs the worker is pinned to, if any.
+        self.crashes = crashes    # How often the workers before this one have crashed in a row.
+        self.blob = None    # The file currently loaded by the worker.
+        self.busy = False
+        self.last_used = 0
+
+
+class Prefetch:
+    def __init__(self, consumers, limit):
+        self.consumers = consumers
+        self.limit = limit
+        self.frame_time = None          # Exponential moving averages of the time it takes to render a frame locally
+        self.round_trip_time = None     # and of the time it takes for requested frames to arrive.
+        self.requested = consumers      # The client sends the first frame on its own and the rest are requested on startup.
+        self.started = 0
+        self.pending = {}               # Tokens of requests that haven't been answered yet, with the time they were sent.
+
+    def depth(self):
+
+        # Keep enough frames waiting to bridge one round trip to the client, without hoarding more than the limit.
+        if self.frame_time == None or self.round_trip_time == None:
+            return 1
+
+        frame_interval = self.frame_time / self.consumers
+        return max(1, min(self.limit, math.ceil(self.round_trip_time / frame_interval)))
+
+    def take(self):
+        self.started += 1
+
+        frame_count = self.depth() - (self.requested - self.started)
+        if frame_count <= 0:
+            return 0, None
+
+        self.requested += frame_count
+
+        token = uuid.uuid4().hex
+        self.pending[token] = time.time()
+
+        return frame_count, token
+
+    def give_back(self):
+        self.started -= 1
+
+    def forget(self, frame_count):
+        self.requested -= frame_count    # Requested frames that were cancelled before being started.
+
+    def arrived(self, token):
+        if token not in self.pending:
+            return
+
+        # Requests are answered in order, so older tokens won't be answered anymore, their frames went to children.
+        sent = self.pending[token]
+        for pending_token in list(self.pending):
+            del self.pending[pending_token]
+            if pending_token == token:
+                break
+
+        self.round_trip_time = moving_average(self.round_trip_time, time.time() - sent)
+
+    def rendered(self, frame_time):
+        self.frame_time = moving_average(self.frame_time, frame_time)
+
+
+class FrameQueue:
+    def __init__(self, wait_time=None, ordered=False):
+        self.heap = []                 # Entries of priority, sequence number, time added and item, the lowest priority is taken first.
+        self.sequence = 0              # Items of the same priority are taken in the order they were added,
+        self.front_sequence = 0        # except for those put back at the front, which are taken before all others.
+        self.condition = asyncio.Condition()
+        self.wait_time = wait_time     # A histogram of the time items spent in the queue, if given.
+        self.ordered = [] if ordered else None    # The entries sorted by priority as well, if items are to be found by their priority.
+        self.taken = set()             # The sequence numbers of entries taken by their position in the sorted entries, but still in the heap.
+
+    def __len__(self):
+        return len(self.heap) - len(self.taken)
+
+    def __iter__(self):
+        return (entry[3] for entry in self.heap if entry[1] not in self.taken)    # In no particular order.
+
+    def push(self, item, priority=0, front=False):
+
+        # Doesn't wake any task waiting for an item, so many items can be added before notifying once.
+        if front:
+            self.front_sequence -= 1
+            entry = (priority, self.front_sequence, time.perf_counter(), item)
+        else:
+            self.sequence += 1
+            entry = (priority, self.sequence, time.perf_counter(), item)
+
+        heapq.heappush(self.heap, entry)
+        if self.ordered != None:
+            bisect.insort(self.ordered, entry)
+
+    async def put(self, item, priority=0, front=False):
+        self.push(item, priority, front)
+        await self.notify(1)
+
+    async def notify(self, count=None):
+        async with self.condition:
+            if count == None:
+                self.condition.notify_all()    # Also lets waiting tasks check whether they should stop.
+            else:
+                self.condition.notify(count)
+
+    def get_nowait(self):
+        return self.pop()    # Raises an IndexError if the queue is empty.
+
+    def peek(self):
+        self.drop_taken()
+
+        return self.heap[0][3]
+
+    def pop(self):
+        self.drop_taken()
+
+        entry = heapq.heappop(self.heap)
+        if self.ordered != None:
+            del self.ordered[0]    # The first of the sorted entries is the one at the top of the heap.
+
+        return self.take(entry)
+
+    def drop_taken(self):
+
+        # Entries taken by their position are left in the heap until they reach its top.
+        while len(self.heap) > 0 and self.heap[0][1] in self.taken:
+            self.taken.remove(heapq.heappop(self.heap)[1])
+
+    def take(self, entry):
+        priority, sequence, added, item = entry
+        if self.wait_time != None:
+            self.wait_time.record(time.perf_counter() - added)
+
+        return item
+
+    def find(self, priority):
+
+        # The position of the first item whose priority isn't lower than the given one, among those sorted by priority.
+        return bisect.bisect_left(self.ordered, priority, key=lambda entry: entry[0])
+
+    def priority_at(self, position):
+        return self.ordered[position][0]
+
+    def pop_at(self, position):
+        entry = self.ordered.pop(position)
+        self.taken.add(entry[1])
+
+        return self.take(entry)
+
+    async def get(self, stop=None, pick=None):
+
+        # Waits for an item, unless stop() becomes true while waiting, in which case None is returned.
+        # If given, pick() takes the item from the queue instead of taking the first one.
+        async with self.condition:
+            await self.condition.wait_for(lambda: len(self) > 0 or (stop != None and stop()))
+
+            if stop != None and stop():
+                return None
+
+            return self.pop() if pick == None else pick()
+
+    def remove(self, predicate):
+        count = len(self)
+
+        self.heap = [entry for entry in self.heap if entry[1] not in self.taken and not predicate(entry[3])]
+        self.rebuild()
+
+        return count - len(self)
+
+    def reprioritize(self, priority):
+
+        # Gives every item the priority returned for it, items that end up with the same priority keep their order.
+        self.heap = [(priority(item), sequence, added, item) for old_priority, sequence, added, item in self.heap if sequence not in self.taken]
+        self.rebuild()
+
+    def rebuild(self):
+        heapq.heapify(self.heap)
+        self.taken.clear()
+
+        if self.ordered != None:
+            self.ordered = sorted(self.heap)
+
+
+class Histogram:
+    def __init__(self, counts=None, total=0):
+        self.counts = [0] * HISTOGRAM_BUCKETS if counts == None else counts    # Bucket i counts durations of up to 2 ** i milliseconds.
+        self.total = total
+
+    def record(self, duration):
+        mantissa, exponent = math.frexp(duration * 1000)
+        self.counts[min(max(exponent, 0), HISTOGRAM_BUCKETS - 1)] += 1
+        self.total += duration
+
+    def merge(self, other):
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.total += other.total
+
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, fraction):
+
+        # The upper bound of the bucket the quantile falls into, so the result is off by at most a factor of two.
+        rank = fraction * self.count()
+        counted = 0
+        for bucket, count in enumerate(self.counts):
+            counted += count
+            if counted >= rank and counted > 0:
+                return 2 ** bucket / 1000
+
+        return 0
+
+
+def format_stats(stats):
+
+    # Statistics are given in the text format of Prometheus, for every node of the tree and summed up for the whole tree.
+    lines = ["# TYPE brpy_stage_seconds summary"]
+    tree_stages = {stage: Histogram() for stage in STATS_STAGES}
+
+    nodes = [stats]
+    while len(nodes) > 0:
+        node = nodes.pop(0)
+        nodes += node.get('children', [])
+
+        labels = f'node="{node["node"]}"'
+        if node.get('unreachable', False):
+            lines.append(f"brpy_up{{{labels}}} 0")
+            continue
+        lines.append(f"brpy_up{{{labels}}} 1")
+
+        for stage in STATS_STAGES:
+            histogram = Histogram(**node['stages'][stage])
+            tree_stages[stage].merge(histogram)
+            lines += format_histogram(histogram, f'{labels},stage="{stage}"')
+
+        lines.append(f"brpy_queued_frames{{{labels}}} {node['queued_frames']}")
+        lines.append(f"brpy_workers{{{labels}}} {node['workers']}")
+        lines.append(f"brpy_busy_workers{{{labels}}} {node['busy_workers']}")
+        lines.append(f"brpy_sent_bytes{{{labels}}} {node['sent']['bytes']}")
+        lines.append(f"brpy_sent_bytes_per_second{{{labels}}} {node['sent']['rate']:.0f}")
+
+        for child, link in node['links'].items():
+            lines.append(f'brpy_relayed_bytes{{{labels},child="{child}"}} {link["bytes"]}')
+            lines.append(f'brpy_relayed_bytes_per_second{{{labels},child="{child}"}} {link["rate"]:.0f}')
+
+    for stage, histogram in tree_stages.items():
+        lines += format_histogram(histogram, f'node="tree",stage="{stage}"')
+
+    return '\n'.join(lines) + '\n'
+
+
+def format_histogram(histogram, labels):
+    lines = []
+    for fraction in (0.5, 0.9, 0.99):
+        lines.append(f'brpy_stage_seconds{{{labels},quantile="{fraction}"}} {histogram.quantile(fraction):g}')
+    lines.append(f"brpy_stage_seconds_sum{{{labels}}} {histogram.total:.3f}")
+    lines.append(f"brpy_stage_seconds_count{{{labels}}} {histogram.count()}")
+
+    return lines
+
+
+class Throughput:
+    def __init__(self):
+        self.bytes = 0
+        self.busy_time = 0    # The time during which at least one transfer was going on, overlapping transfers count once.
+        self.active = 0
+        self.active_since = None
+        self.lock = threading.Lock()    # Transfers may be timed from several threads.
+
+    def start(self):
+        with self.lock:
+            if self.active == 0:
+                self.active_since = time.perf_counter()
+            self.active += 1
+
+    def stop(self, size):
+        with self.lock:
+            self.bytes += size
+            self.active -= 1
+            if self.active == 0:
+                self.busy_time += time.perf_counter() - self.active_since
+
+    def rate(self):
+        return self.bytes / self.busy_time if self.busy_time > 0 else 0
+
+
+class FrameWriter:
+    def __init__(self, threads, fsync='frame'):
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads, 'writer')
+        self.slots = asyncio.Semaphore(WRITE_QUEUE_SIZE)    # Bounds the chunks received but not yet written.
+        self.fsync = fsync                                   # Either 'frame', 'batch' or 'none'.
+        self.unsynced = []                                   # Files written since the last batch was synced.
+        self.last_sync = time.time()
+        self.sync_lock = threading.Lock()                    # Files are committed by several writer threads.
+        self.network = Throughput()
+        self.disk = Throughput()
+
+    async def receive(self, reader, path, size, prefix='', timeout=None, codec=None):
+        loop = asyncio.get_running_loop()
+
+        # The file is written under a temporary name and only renamed once it is complete,
+        # so an interruption never leaves a cut off image behind under the name of the frame.
+        temporary_path = f"{path}.part"
+        fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+        writes = []
+        offset = 0
+        buffer = bytearray()
+
+        self.network.start()
+        try:
+
+            # Arriving data is collected into chunks, which the writer threads write at their offset in any order,
+            # while the next chunks are received. Receiving only waits for the disk once the queue of chunks is full.
+            # Compressed frames arrive in blocks, which are decompressed as they arrive.
+            while offset + len(buffer) < size:
+                if codec != None:
+                    piece = await receive_block(reader, codec, prefix, timeout)
+                else:
+                    try:
+                        piece = await asyncio.wait_for(reader.read(min(size - offset - len(buffer), CHUNK_SIZE - len(buffer))), timeout)
+                    except ConnectionResetError:
+                        piece = b''
+
+                if len(piece) == 0:
+                    print(f"{prefix} Connection broken.")
+                    raise ConnectionBrokenError(prefix)
+
+                buffer += piece
+
+                if len(buffer) >= CHUNK_SIZE or offset + len(buffer) >= size:
+                    await self.slots.acquire()
+
+                    write = loop.run_in_executor(self.executor, self.write_chunk, fd, buffer, offset)
+                    write.add_done_callback(lambda write: self.slots.release())
+                    writes.append(write)
+
+                    offset += len(buffer)
+                    buffer = bytearray()
+        except BaseException:
+            self.network.stop(offset + len(buffer))
+
+            await asyncio.gather(*writes, return_exceptions=True)    # The file must not be closed under a write that is still running.
+            os.close(fd)
+            os.remove(temporary_path)
+            raise
+
+        self.network.stop(size)
+
+        try:
+            await asyncio.gather(*writes)
+        finally:
+            os.close(fd)
+
+        await loop.run_in_executor(self.executor, self.commit, temporary_path, path)
+
+    async def discard(self, reader, size, prefix='', timeout=None, codec=None):
+        received = 0
+
+        self.network.start()
+        try:
+            while received < size:
+                if codec != None:
+                    piece = await receive_block(reader, codec, prefix, timeout)    # Blocks are only delimited by their headers.
+                else:
+                    try:
+                        piece = await asyncio.wait_for(reader.read(min(size - received, CHUNK_SIZE)), timeout)
+                    except ConnectionResetError:
+                        piece = b''
+
+                if len(piece) == 0:
+                    print(f"{prefix} Connection broken.")
+                    raise ConnectionBrokenError(prefix)
+
+                received += len(piece)
+        finally:
+            self.network.stop(received)
+
+    def write_chunk(self, fd, chunk, offset):
+        self.disk.start()
+        try:
+            os.pwrite(fd, chunk, offset)
+        finally:
+            self.disk.stop(len(chunk))
+
+    def commit(self, temporary_path, path):
+        if self.fsync == 'frame':
+            self.sync_file(temporary_path)
+
+        os.replace(temporary_path, path)
+
+
+        # Renaming the file is only durable once its directory is synced as well.
+        if self.fsync == 'frame':
+            self.sync_file(os.path.dirname(os.path.abspath(path)))
+        elif self.fsync == 'batch':
+            with self.sync_lock:
+                self.unsynced.append(path)
+                full = len(self.unsynced) >= FSYNC_BATCH_SIZE or time.time() - self.last_sync >= FSYNC_BATCH_INTERVAL
+
+            if full:
+                self.sync_batch()
+
+    def sync_batch(self):
+        with self.sync_lock:
+            paths, self.unsynced = self.unsynced, []
+            self.last_sync = time.time()
+
+        for path in paths:
+            try:
+                self.sync_file(path)
+            except FileNotFoundError:
+                pass    # Parts of split frames are removed once merged.
+
+        if len(paths) > 0:
+            self.sync_file(os.path.dirname(os.path.abspath(paths[0])))
+
+    def sync_file(self, path):
+        self.disk.start()
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+            self.disk.stop(0)
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.sync_batch)
+        self.executor.shutdown()
+
+
+class Upload:
+    def __init__(self, path, size, committed, checksums=None, base=None, copies=None):
+        self.path = path
+        self.size = size
+        self.committed = committed    # Number of bytes at the start of the file that have arrived intact.
+        self.checksums = {} if checksums == None else checksums
+        self.base = base              # The hash of the file chunks were copied from, if any,
+        self.copies = {} if copies == None else copies    # with the offset in it of each copied chunk, by its offset.
+        self.digest = hashlib.sha256()    # Of the committed part of the file.
+        self.failed = False
+        self.condition = asyncio.Condition()
+
+    async def commit(self, size, checksum, source=None):
+
+        # The chunk has already been added to the digest by whoever wrote it.
+        async with self.condition:
+            self.checksums[self.committed] = (size, checksum)
+            if source != None:
+                self.copies[self.committed] = source
+            self.committed += size
+            self.condition.notify_all()
+
+    async def fail(self):
+        async with self.condition:
+            self.failed = True
+            self.condition.notify_all()
+
+    async def wait(self, offset):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.committed >= offset or self.failed)
+
+            return not self.failed
 
 
 class Request:
@@ -40,23 +1307,97 @@ class SessionRequest(Request):
         super().__init__(type)
         self.session = session
 
+class StatsRequest(Request):
+    def __init__(self):
+        super().__init__('STATS')
+
 class UploadRequest(SessionRequest):
-    def __init__(self, session, size):
+    def __init__(self, session, size, hash, delta=None):
         super().__init__('UPLOAD', session)
         self.size = size
+        self.hash = hash
+        if delta != None:
+            self.delta = delta    # Asks for the file to be sent as a delta, an empty string for one against whatever file
+                                  # the session has, which the server sends the signatures of, or the hash of a file to copy from.
+
+class HelloRequest(Request):
+    def __init__(self, versions, multiplex=False, codecs=()):
+        super().__init__('HELLO')
+        self.versions = versions
+        if multiplex:
+            self.multiplex = multiplex    # Asks to turn the connection into a link carrying many streams.
+        if len(codecs) > 0:
+            self.codecs = codecs          # The codecs this side accepts compressed data in.
+
+class UploadChunk(Request):
+    def __init__(self, offset, size, checksum, codec=None):
+        super().__init__('CHUNK')
+        self.offset = offset
+        self.size = size
+        self.checksum = checksum
+        if codec != None:
+            self.codec = codec    # The chunk is sent as a block, which may be compressed with this codec.
 
 class RenderRequest(SessionRequest):
-    def __init__(self, session, frames, render_format):
+    def __init__(self, session, frames, render_format, token=None, tiles=None, sample_parts=None):
         super().__init__('RENDER', session)
         self.frames = frames
         if render_format != None:
             self.render_format = render_format
+        if token != None:
+            self.token = token    # Echoes the token of the request response this request answers.
+        if tiles != None:
+            self.tiles = tiles    # Each frame is split into this many tiles, the frames are numbered frame * tiles + tile.
+        if sample_parts != None:
+            self.sample_parts = sample_parts    # Likewise, each frame is split into this many parts of its samples.
+
+
+class UploadCopy(Request):
+    def __init__(self, offset, size, checksum, source):
+        super().__init__('COPY')
+        self.offset = offset
+        self.size = size
+        self.checksum = checksum
+        self.source = source    # The offset to copy the chunk from in the file the delta is against.
+
+
+class CancelRequest(SessionRequest):
+    def __init__(self, session, frames):
+        super().__init__('CANCEL', session)
+        self.frames = frames
 
 
 class OkayResponse:
     def __init__(self):
         self.status = 'OKAY'
 
+class StatsResponse(OkayResponse):
+    def __init__(self, stats):
+        super().__init__()
+        self.stats = stats    # The statistics of the node, including those of its children.
+
+class HelloResponse(OkayResponse):
+    def __init__(self, version, multiplex=False, codecs=()):
+        super().__init__()
+        self.version = version
+        if multiplex:
+            self.multiplex = multiplex
+        if len(codecs) > 0:
+            self.codecs = codecs
+
+class SendResponse:
+    def __init__(self, offset):
+        self.status = 'SEND'
+        self.offset = offset
+
+class DeltaResponse:
+    def __init__(self, offset, base, block_size, size):
+        self.status = 'DELTA'
+        self.offset = offset
+        self.base = base                # The hash of the file the delta is against,
+        self.block_size = block_size    # which is compared in blocks of this size.
+        self.size = size                # The size of the signatures of the blocks following the message.
+
 class FailResponse:
     def __init__(self, error):
         self.status = 'FAIL'
@@ -68,23 +1409,51 @@ class RenderResponse:
         self.type = type
 
 class RenderRequestResponse(RenderResponse):
-    def __init__(self, frame_count):
+    def __init__(self, frame_count, token=None):
         super().__init__('REQUEST')
         self.frame_count = frame_count
+        if token != None:
+            self.token = token
+
+class RenderHeartbeatResponse(RenderResponse):
+    def __init__(self):
+        super().__init__('HEARTBEAT')
+
+class RenderCancelResponse(RenderResponse):
+    def __init__(self, frames):
+        super().__init__('CANCEL')
+        self.frames = frames
 
 class RenderFrameResponse(RenderResponse):
-    def __init__(self, frame_size, frame_number, file_extension):
+    def __init__(self, frame_size, frame_number, file_extension, codec=None, render_time=None):
         super().__init__('FRAME')
         self.frame_size = frame_size
         self.frame_number = frame_number
         self.file_extension = file_extension
+        if codec != None:
+            self.codec = codec    # The frame is sent in blocks, each of which may be compressed with this codec.
+        if render_time != None:
+            self.render_time = render_time    # The seconds a worker spent rendering the frame, missing for cached frames.
+
+class RenderFailedResponse(RenderResponse):
+    def __init__(self, frame_number, error):
+        super().__init__('FAILED')
+        self.frame_number = frame_number
+        self.error = error
 
 
 class LocalRenderRequest:
-    def __init__(self, session, frame):
+    def __init__(self, session, blob, frame, background_save=False, tiles=None, sample_parts=None):
         self.session = session
-        self.frame = frame
+        self.blob = blob
+        self.frame = frame    # Only the file is loaded if no frame is given.
+        self.background_save = background_save
+        if tiles != None:
+            self.tiles = tiles
+        if sample_parts != None:
+            self.sample_parts = sample_parts
 
 class LocalRenderResponse:
-    def __init__(self, image_name):
+    def __init__(self, image_name, saved=True):
         self.image_name = image_name
+        self.saved = saved
@@ -1,12 +1,29 @@
 import bpy
 
 import json
+import math
 import os
 import socket
 import sys
 
 sys.path.append(os.path.dirname(__file__))
-from brpy_lib import receive_bytes, LocalRenderResponse
+from brpy_lib import receive_bytes, ConnectionBrokenError, LocalRenderResponse
+
+
+# The settings changed for rendering split frames, in the order they are restored in.
+SPLIT_SETTINGS = (
+    ('render', 'use_border'),
+    ('render', 'use_crop_to_border'),
+    ('render', 'border_min_x'),
+    ('render', 'border_max_x'),
+    ('render', 'border_min_y'),
+    ('render', 'border_max_y'),
+    ('image_settings', 'file_format'),    # The codec is only valid once the format is restored.
+    ('image_settings', 'exr_codec'),
+    ('cycles', 'samples'),
+    ('cycles', 'seed'),
+    ('cycles', 'use_denoising')
+)
 
 
 def setup():
@@ -20,42 +37,124 @@ def setup():
     bpy.context.scene.cycles.denoising_use_gpu = True
 
 
-# Start of render program.
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as connection:
-    connection.connect(("localhost", int(sys.argv[5])))
+    # Remember the settings of the file that rendering tiles or sample parts changes.
+    global file_settings
+    file_settings = {(owner, name): getattr(settings_owner(owner), name) for owner, name in SPLIT_SETTINGS}
 
 
-    session = sys.argv[6]
-    work_dir = os.getcwd()
+def settings_owner(owner):
+    scene = bpy.context.scene
+
+    return {'render': scene.render, 'image_settings': scene.render.image_settings, 'cycles': scene.cycles}[owner]
+
+
+def restore_settings():
+    for (owner, name), value in file_settings.items():
+        setattr(settings_owner(owner), name, value)
+
+
+def set_exr_output():
+    image_settings = bpy.context.scene.render.image_settings
+
+    # Split frames are saved as OpenEXR with one scanline per chunk, so the client can merge them chunk by chunk.
+    if image_settings.file_format != 'OPEN_EXR_MULTILAYER':
+        image_settings.file_format = 'OPEN_EXR'
+    image_settings.exr_codec = 'ZIPS'
+
+
+def set_tile(tile, tiles):
+    render = bpy.context.scene.render
+
+    # Tiles are horizontal stripes numbered from the top, the border is given from the bottom.
+    # Neighbouring tiles share the same border value, so Blender places them without gaps or overlap.
+    render.use_border = True
+    render.use_crop_to_border = True
+    render.border_min_x, render.border_max_x = 0, 1
+    render.border_min_y, render.border_max_y = 1 - (tile + 1) / tiles, 1 - tile / tiles
+
+    set_exr_output()
+
 
+def set_sample_part(part, parts):
+    cycles = bpy.context.scene.cycles
 
-    bpy.ops.wm.open_mainfile(filepath=f"{work_dir}/{session}.blend")
+    # Every part renders the same share of the samples with a seed of its own, so the client can simply average the parts.
+    # Denoising is left to the merged image, denoised parts would average to a blurrier and biased result.
+    cycles.samples = math.ceil(file_settings[('cycles', 'samples')] / parts)
+    cycles.seed = file_settings[('cycles', 'seed')] + part
+    cycles.use_denoising = False
 
-    setup()
+    set_exr_output()
+
+
+# Start of render program.
+with socket.socket(fileno=int(sys.argv[sys.argv.index('--') + 1])) as connection:    # Blender passes arguments after '--' on to the script,
+                                                                                   # which is the inherited end of a socket pair.
+
+
+    # The worker is started ahead of time and keeps running, the file to render is loaded once the first request names it.
+    blob = None
+    work_dir = os.getcwd()
 
 
     while True:
-        request_header_size = int.from_bytes(receive_bytes(connection, 8))
-        request_header = json.loads(receive_bytes(connection, request_header_size))
+        try:
+            request_header_size = int.from_bytes(receive_bytes(connection, 8))
+            request_header = json.loads(receive_bytes(connection, request_header_size))
+        except ConnectionBrokenError:
+            sys.exit()
 
 
-        if request_header['session'] != session:
-            session = request_header['session']
-            bpy.ops.wm.open_mainfile(filepath=f"{work_dir}/{session}.blend")
+        # Blobs are content-addressed, so a file only needs to be loaded again if the blob changes.
+        if request_header['blob'] != blob:
+            blob = request_header['blob']
+            bpy.ops.wm.open_mainfile(filepath=f"{work_dir}/{blob}")
 
             setup()
 
+        session = request_header['session']
         frame = request_header['frame']
 
 
-        image_name = session + str(frame)
-        bpy.context.scene.render.filepath = image_name
-        bpy.context.scene.frame_current = frame
+        if frame == None:
+            image_name = None
+        else:
+            restore_settings()
+
+            if 'tiles' in request_header:
+                frame, tile = divmod(frame, request_header['tiles'])
+                image_name = f"{session}{frame}_{tile}"
+
+                set_tile(tile, request_header['tiles'])
+            elif 'sample_parts' in request_header:
+                frame, part = divmod(frame, request_header['sample_parts'])
+                image_name = f"{session}{frame}_{part}"
+
+                set_sample_part(part, request_header['sample_parts'])
+            else:
+                image_name = session + str(frame)
+
+            bpy.context.scene.render.filepath = image_name
+            bpy.context.scene.frame_current = frame
+
+
+            image_name += bpy.context.scene.render.file_extension
+
+
+            # When saving in the background, respond as soon as the frame is rendered,
+            # so the server can have the next frame rendered while this one is being encoded.
+            if request_header['background_save']:
+                bpy.ops.render.render()
 
+                response_header = json.dumps(LocalRenderResponse(image_name, False).__dict__).encode()
+                connection.sendall(len(response_header).to_bytes(8))
+                connection.sendall(response_header)
 
-        bpy.ops.render.render(write_still=True)
+                bpy.data.images['Render Result'].save_render(filepath=f"{work_dir}/{image_name}")
+            else:
+                bpy.ops.render.render(write_still=True)
 
 
-        response_header = json.dumps(LocalRenderResponse(image_name + bpy.context.scene.render.file_extension).__dict__).encode()
+        response_header = json.dumps(LocalRenderResponse(image_name).__dict__).encode()
         connection.sendall(len(response_header).to_bytes(8))
         connection.sendall(response_header)
@@ -1,231 +1,1013 @@
 import argparse
+import asyncio
+import collections
 import copy
-import json
+import hashlib
 import os
+import shutil
 import socket
 import subprocess
 import sys
-import threading
+import time
+
+from brpy_delta import compute_signatures, delta_block_size
+from brpy_lib import (receive_message,
+    send_message,
+    encode_message,
+    negotiate_protocol,
+    relay_stream,
+    relay_blocks,
+    send_file,
+    send_block,
+    receive_block,
+    parse_codecs,
+    stream_chunks,
+    receive_chunks,
+    format_stats,
+    ConnectionBrokenError,
+    JSON_PROTOCOL,
+    STATS_STAGES,
+    PROTOCOLS,
+    CHUNK_SIZE,
+    CODECS,
 
-from brpy_lib import (receive_bytes,
     OkayResponse,
+    HelloResponse,
+    SendResponse,
+    DeltaResponse,
     FailResponse,
 
     RenderRequestResponse,
+    RenderHeartbeatResponse,
+    RenderCancelResponse,
     RenderFrameResponse,
+    RenderFailedResponse,
+    StatsResponse,
 
     LocalRenderRequest,
 
     ServeRequest,
-    Child
+    StatsRequest,
+    Child,
+    ChildLink,
+    Compressor,
+    Link,
+    Prefetch,
+    FrameQueue,
+    Histogram,
+    Throughput,
+    Upload,
+    Worker
 )
 
 
-def register_at_parent(parent):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as parent_connection:
-        parent_connection.connect(parent)
-        request_header = json.dumps(ServeRequest(args.port).__dict__).encode()
-        parent_connection.sendall(len(request_header).to_bytes(8))
-        parent_connection.sendall(request_header)
+MAX_FRAME_FAILURES = 3         # A frame that failed to render this many times is given up on and reported to the client as failed.
+WORKER_RESTART_DELAY = 1       # Workers that stopped on their own are restarted after this many seconds, doubled for every
+WORKER_RESTART_MAX_DELAY = 60  # further time in a row, up to this many seconds.
 
 
-def forward_requests(child, thread_id, request_header_size_raw, request_header_raw, blend_file=None):
-    child_connection = get_child_connection(child, thread_id)
+def spawn(tasks, coroutine):
 
-    child_connection.sendall(request_header_size_raw)
-    child_connection.sendall(request_header_raw)
+    # The event loop only keeps weak references to tasks, so they are kept in a set until they are done.
+    task = asyncio.create_task(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
 
-    if blend_file != None:
-        child_connection.sendall(blend_file)
+    return task
 
-    child_response_header_size = int.from_bytes(receive_bytes(child_connection, 8))
-    child_response_header = json.loads(receive_bytes(child_connection, child_response_header_size))
 
+async def register_at_parent(parent):
+    try:
+        parent_reader, parent_writer = await asyncio.open_connection(*parent)
+    except OSError:
+        print(f"Could not register at parent [{parent[0]}:{parent[1]}].")
+        return
+
+    request_header = encode_message(ServeRequest(args.port).__dict__)
+    await send_message(parent_writer, request_header)
+
+    parent_writer.close()
+
+
+async def connect_to_child(child):
+    child_prefix = f"[{child.address[0]}:{child.address[1]}]"
+
+
+    # Agree on a protocol with the child first, children that don't support negotiating it are sent JSON headers on a new connection.
+    child_reader, child_writer = await asyncio.open_connection(*child.address)
+
+    response_header = await negotiate_protocol(child_reader, child_writer, child_prefix, args.timeout, True, codecs)
+    if response_header == None:
+        child_writer.close()
+
+        child_reader, child_writer = await asyncio.open_connection(*child.address)
+        return child_reader, child_writer, JSON_PROTOCOL, False, Compressor()
+
+    compressor = Compressor(codecs, response_header.get('codecs', ()))
+
+    return child_reader, child_writer, response_header['version'], response_header.get('multiplex', False), compressor
+
+
+async def get_child_connection(child, child_connections):
+    try:
+        return child_connections[child]
+    except KeyError:
+        pass
+
+
+    # All clients share a single link to the child, each with a stream of its own on it.
+    # Children that don't support links are sent the requests of each client over a separate connection.
+    async with child.link_lock:
+        if child.link == None or child.link.closed:
+            child.link = None
+
+            child_reader, child_writer, protocol, multiplexed, compressor = await connect_to_child(child)
+            if not multiplexed:
+                child_connections[child] = (child_reader, child_writer, protocol, compressor)
+                return child_connections[child]
+
+            child.link = Link(child_reader, child_writer, protocol, f"[{child.address[0]}:{child.address[1]}]", compressor=compressor)
+            spawn(background_tasks, child.link.run())
+
+            print(f"Opened link to child [{child.address[0]}:{child.address[1]}].")
+
+        child_reader, child_writer = child.link.open_stream()
+
+    child_connections[child] = (child_reader, child_writer, child.link.protocol, child.link.compressor)
+    return child_connections[child]
+
+
+async def forward_requests(child, child_connections, request_header, upload=None):
+    child_prefix = f"[{child.address[0]}:{child.address[1]}]"
+
+
+    # Chunks copied from a file this node already had are only copied by the child as well if it has the same file.
+    request_header = request_header.copy()
+    request_header.pop('delta', None)
+    if upload != None and upload.base != None:
+        request_header['delta'] = upload.base
+
+    try:
+        child_reader, child_writer, protocol, compressor = await get_child_connection(child, child_connections)
+
+        await send_message(child_writer, encode_message(request_header, protocol))
+        child_response_header_raw, child_response_header = await receive_message(child_reader, child_prefix, protocol)
+
+
+        # The child only asks for the file if it doesn't already store a blob with the same hash,
+        # resuming from the offset of a partial file it may have kept from an interrupted upload.
+        if child_response_header['status'] in ('SEND', 'DELTA'):
+            delta = child_response_header['status'] == 'DELTA'
+            if delta:
+                await child_reader.readexactly(child_response_header['size'])    # No signatures are asked for, so there should be none.
+
+            if not await stream_chunks(child_writer, upload, child_response_header['offset'], protocol, compressor, delta):
+
+                # The upload to this node failed, so the child is left waiting for chunks that never come.
+                child_connections.pop(child)[1].close()
+                child_response_header = FailResponse("Upload to parent node failed.").__dict__
+            else:
+                child_response_header_raw, child_response_header = await receive_message(child_reader, child_prefix, protocol)
+
+    except OSError:
+        child_connections.pop(child, None)
+        child_response_header = FailResponse("Connection to child node broken.").__dict__
+
+    return child_response_header['status']
+
+
+def is_valid_hash(blend_hash):
+    return len(blend_hash) == 64 and all(character in '0123456789abcdef' for character in blend_hash)
+
+
+def find_delta_base(session, delta):
+
+    # A delta is either against the file the session has so far, or against the file with the given hash.
+    if delta == None:
+        return None
+
+    if delta == '':
+        try:
+            delta = os.path.basename(os.readlink(f"{session}.blend")).removesuffix('.blend')
+        except FileNotFoundError:
+            return None
+
+    if not is_valid_hash(delta) or not os.path.exists(f"blobs/{delta}.blend"):
+        return None
+
+    return delta
+
+
+def link_session(session, blend_hash):
+
+    # Sessions are symbolic links to a content-addressed blob, so the same file is only ever stored once.
+    # The link is replaced atomically, so a renderer never sees a session without a file.
+    os.symlink(f"blobs/{blend_hash}.blend", f"{session}.blend.part")
+    os.replace(f"{session}.blend.part", f"{session}.blend")
+
+    remove_unused_blobs()
+
+
+def unlink_session(session):
+    try:
+        os.remove(f"{session}.blend")
+    except FileNotFoundError:
+        return False
+
+    remove_unused_blobs()
+
+    return True
+
+
+def remove_unused_blobs():
+    linked_blobs = set()
+    for entry in os.scandir():
+        if entry.is_symlink() and entry.name.endswith('.blend'):
+            linked_blobs.add(os.path.basename(os.readlink(entry.path)))
+
+    for entry in os.scandir('blobs'):
+        if entry.name.endswith('.blend') and entry.name not in linked_blobs:
+            os.remove(entry.path)
 
-def forward_child_responses(client_connection, child_connection, send_lock, busy_lock, client_prefix):
-    child_prefix = child_connection.getpeername()
-    child_prefix = f"[{child_prefix[0]}:{child_prefix[1]}]"
 
+async def receive_child_response(link):
 
+    # Children only send heartbeats once they have been sent a frame, so a child is only lost if it stays silent for a whole
+    # timeout while holding frames. The message is received by a task of its own, so waiting for it is never cut off midway.
+    receiving = asyncio.ensure_future(receive_message(link.reader, link.prefix, link.protocol))
+    try:
+        while True:
+            holding = len(link.forwarded) > 0
+
+            await asyncio.wait((receiving,), timeout=args.timeout)
+            if receiving.done():
+                return receiving.result()
+
+            if holding and len(link.forwarded) > 0:
+                raise TimeoutError
+    finally:
+        receiving.cancel()
+
+
+async def forward_child_responses(client_writer, protocol, compressor, link, send_lock, render_requests, client_prefix):
     while True:
-        response_header_size_raw = receive_bytes(child_connection, 8)
-        response_header_size = int.from_bytes(response_header_size_raw)
+        relaying = False
+
+        try:
+            response_header_raw, response_header = await receive_child_response(link)
+
+            if response_header['type'] in ('CANCEL', 'HEARTBEAT'):
+                continue    # Cancellations are acknowledged and heartbeats are sent to the client by this node.
+
+
+            # Compressed frames are passed on as they are if the client accepts their codec, otherwise they are decompressed on the way.
+            codec = response_header.get('codec')
+            if codec != None and codec not in compressor.accepted:
+                del response_header['codec']
+
+
+            # Messages are only encoded again if the client and the child speak different protocols.
+            if link.protocol != protocol or response_header.get('codec') != codec:
+                response_header_raw = encode_message(response_header, protocol)
+
+            async with send_lock:
+                await send_message(client_writer, response_header_raw)
 
-        response_header_raw = receive_bytes(child_connection, response_header_size)
-        response_header = json.loads(response_header_raw)
+                # Frames are relayed piece by piece as they arrive instead of being buffered as a whole.
+                if response_header['type'] == 'FRAME':
+                    print(f"{client_prefix} Forwarding frame {response_header['frame_number']} from {link.prefix}.")
 
+                    relaying = True
+                    relay_start = time.perf_counter()
+                    link.relayed.start()
+                    try:
+                        if codec == None:
+                            await relay_stream(link.reader, client_writer, response_header['frame_size'], link.prefix, args.timeout)
+                        elif codec in compressor.accepted:
+                            await relay_blocks(link.reader, client_writer, response_header['frame_size'], link.prefix, args.timeout)
+                        else:
+                            size = response_header['frame_size']
+                            while size > 0:
+                                block = await receive_block(link.reader, codec, link.prefix, args.timeout)
+                                await send_message(client_writer, block)
+                                size -= len(block)
+                    finally:
+                        link.relayed.stop(response_header['frame_size'])
+
+                    stage_times['relay'].record(time.perf_counter() - relay_start)
 
-        response = b''
+                    link.forwarded.pop(response_header['frame_number'], None)
 
-        if response_header['type'] == 'FRAME':
-            response = receive_bytes(child_connection, response_header['frame_size'])
-            print(f"{client_prefix} Forwarding frame {response_header['frame_number']} from {child_prefix}.")
+                if response_header['type'] == 'FAILED':
+                    print(f"{client_prefix} Forwarding failure of frame {response_header['frame_number']} from {link.prefix}.")
 
-        with send_lock:
-            client_connection.sendall(response_header_size_raw)
-            client_connection.sendall(response_header_raw)
-            client_connection.sendall(response)
+                    link.forwarded.pop(response_header['frame_number'], None)
+
+        except OSError:
+
+            # A frame that was cut off can't be completed, so the client has to reassign everything it sent here.
+            if relaying:
+                client_writer.transport.abort()
+
+            await take_back_frames(link, render_requests, client_prefix)
+            return
 
 
         if response_header['type'] == 'REQUEST':
-            with busy_lock:
-                busy_lock.notify()
-            print(f"{client_prefix} Forwarding frame request from {child_prefix}.")
+            for frame in range(response_header['frame_count']):
+                link.credits.release()
 
+            print(f"{client_prefix} Forwarding frame request from {link.prefix}.")
 
-def handle_child_render(child_connection, render_requests, render_requests_lock, busy_lock, client_prefix):
-    child_prefix = child_connection.getpeername()
-    child_prefix = f"[{child_prefix[0]}:{child_prefix[1]}]"
 
+async def handle_child_render(link, render_requests, client_prefix):
     while True:
+        await link.credits.acquire()    # Only forward as many frames as the child has requested.
+
+        request = await render_requests.get(lambda: link.lost)
+        if request == None:
+            return
+
+        print(f"{client_prefix} Forwarding render request for frame {request['frames']} of session '{request['session']}' to {link.prefix}.")
+
+
+        link.forwarded[request['frames']] = request
+
+        try:
+            await send_message(link.writer, encode_message(request, link.protocol))
+        except OSError:
+
+            # The task receiving from the child notices the loss as well, the request is put back by whichever comes first.
+            if link.forwarded.pop(request['frames'], None) != None:
+                await render_requests.put(request, front=True)
+
+            return
+
+
+async def take_back_frames(link, render_requests, client_prefix):
+    link.lost = True
+
+    requests = list(link.forwarded.values())
+    link.forwarded.clear()
+
+
+    # Frames the child hadn't delivered yet are rendered by this node or the remaining children instead.
+    for request in reversed(requests):
+        render_requests.push(request, front=True)
+    link.credits.release()    # Wakes the task sending render requests to the child, so it can stop.
+
+    await render_requests.notify()
+
+    print(f"{client_prefix} Lost child {link.prefix}, reassigning frame(s) {[request['frames'] for request in requests]}.")
+
+
+async def send_heartbeats(writer, protocol, send_lock):
+    response_header = encode_message(RenderHeartbeatResponse().__dict__, protocol)
+
+    # Tells the client this node is still alive while no frames are being sent, e.g. during long renders.
+    while True:
+        await asyncio.sleep(args.heartbeat_interval)
+
+        try:
+            async with send_lock:
+                await send_message(writer, response_header)
+        except OSError:
+            return
+
+
+def open_frame(image):
+
+    # Images are opened before the task sending them is started, so they can still be sent if they are evicted from the cache in the meantime.
+    try:
+        return open(image, 'rb')
+    except FileNotFoundError:
+        return None
+
+
+async def send_frame(writer, protocol, compressor, send_lock, image, file, frame, client_prefix, session, keep=False, render_time=None):
+    with file:
+        frame_size = os.fstat(file.fileno()).st_size
+        send_start = time.perf_counter()
+
+        try:
+            async with send_lock:
+
+                # Frames are only sent in blocks while compressing the first one pays off, otherwise the kernel copies
+                # the image to the socket without it being read into memory.
+                data = None
+                block = None
+                if frame_size > 0 and not compressor.skip():
+                    data = os.pread(file.fileno(), min(CHUNK_SIZE, frame_size), 0)
+                    block = await compressor.compress(data)
+
+                compressed = block != None and len(block) < len(data)
+
+                response_header = encode_message(
+                    RenderFrameResponse(
+                        frame_size,
+                        frame,
+                        image.split('.')[-1],
+                        compressor.codec if compressed else None,
+                        render_time    # Lets the client learn how heavy the frame is and how fast this node renders.
+                    ).__dict__,
+                    protocol
+                )
+
+                await send_message(writer, response_header)
+
+                frames_sent.start()
+                try:
+                    if compressed:
+
+                        # The image is compressed block by block, so it never has to be held in memory as a whole.
+                        await send_block(writer, data, compressor, block)
+
+                        offset = len(data)
+                        while offset < frame_size:
+                            data = os.pread(file.fileno(), min(CHUNK_SIZE, frame_size - offset), offset)
+                            await send_block(writer, data, compressor)
+                            offset += len(data)
+                    else:
+                        file_start = time.perf_counter()
+                        await send_file(writer, file)
+                        compressor.sent(frame_size, time.perf_counter() - file_start)
+                finally:
+                    frames_sent.stop(frame_size)
+        except OSError:
+            print(f"{client_prefix} Could not send frame {frame} of session '{session}', the client is gone.")
+            return
+        finally:
+            if not keep:
+                os.remove(image)
+
+    stage_times['send'].record(time.perf_counter() - send_start)    # Includes waiting for other frames sent to the same client.
+
+    print(f"{client_prefix} Sent frame {frame} of session '{session}'.")
+
+
+def frame_cache_key(blob, request):
+
+    # A frame is identified by the content of its file and everything in the request that changes the image.
+    key = (blob, request['frames'], request.get('tiles'), request.get('sample_parts'), request.get('render_format'))
+
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+
+def look_up_cached_frame(cache_key):
+    global frame_cache_size
+
+    try:
+        image, size = frame_cache[cache_key]
+    except KeyError:
+        return None, None
+
+
+    # A cached image that has gone missing, e.g. removed by hand, no longer counts as cached.
+    file = open_frame(image)
+    if file == None:
+        del frame_cache[cache_key]
+        frame_cache_size -= size
+
+        return None, None
+
+    frame_cache.move_to_end(cache_key)
+    os.utime(image)    # Keeps the order of use across restarts of the server.
+
+    return image, file
+
+
+def cache_frame(image, cache_key):
+    global frame_cache_size
+
+    try:
+        size = os.path.getsize(image)
+    except FileNotFoundError:
+        return image, False    # Left for sending the frame to report.
+
+    if frame_cache_limit == None or size > frame_cache_limit:
+        return image, False
+
+
+    # The image is moved into the cache and sent from there.
+    cached_image = f"cache/{cache_key}{os.path.splitext(image)[1]}"
+    os.replace(image, cached_image)
+
+    if cache_key in frame_cache:
+        frame_cache_size -= frame_cache.pop(cache_key)[1]
+
+    frame_cache[cache_key] = (cached_image, size)
+    frame_cache_size += size
+
+    evict_cached_frames()
+
+    return cached_image, True
+
+
+def evict_cached_frames():
+    global frame_cache_size
+
+    # The frames used the longest time ago are evicted first.
+    while frame_cache_size > frame_cache_limit:
+        cache_key, (image, size) = frame_cache.popitem(last=False)
+        frame_cache_size -= size
+
+        os.remove(image)
+
+
+async def send_cached_frame(writer, protocol, compressor, send_lock, request, prefetch, tasks, client_prefix):
+    if frame_cache_limit == None:
+        return False
+
+    try:
+        blob = os.readlink(f"{request['session']}.blend")
+    except FileNotFoundError:
+        return False
+
+    image, file = look_up_cached_frame(frame_cache_key(blob, request))
+    if image == None:
+        return False
+
+    print(f"{client_prefix} Frame {request['frames']} of session '{request['session']}' is cached, sending it without rendering.")
+
+
+    # The frame counts as taken, so more frames are requested in its place.
+    await request_more_frames(writer, protocol, send_lock, prefetch, client_prefix)
+
+    spawn(tasks, send_frame(writer, protocol, compressor, send_lock, image, file, request['frames'], client_prefix, request['session'], True))
+
+    return True
+
+
+async def collect_stats():
+    stats = {
+        'node': f"{socket.gethostname()}:{args.port}",
+        'stages': {stage: histogram.__dict__ for stage, histogram in stage_times.items()},
+        'queued_frames': sum(len(render_requests) for render_requests in client_queues),
+        'workers': len(workers),
+        'busy_workers': sum(worker.busy for worker in workers),
+        'sent': {'bytes': frames_sent.bytes, 'rate': frames_sent.rate()},
+        'links': {f"{child.address[0]}:{child.address[1]}": {'bytes': child.relayed.bytes, 'rate': child.relayed.rate()} for child in children}
+    }
+
+
+    # The statistics of the children are collected at the same time, each of them collecting those of its own children.
+    stats['children'] = await asyncio.gather(*(request_child_stats(child) for child in children))
+
+    return stats
+
+
+async def request_child_stats(child):
+    child_prefix = f"[{child.address[0]}:{child.address[1]}]"
+    child_connections = {}
+
+    try:
+        child_reader, child_writer, child_protocol, child_compressor = await asyncio.wait_for(get_child_connection(child, child_connections), args.timeout)
+
+        await send_message(child_writer, encode_message(StatsRequest().__dict__, child_protocol))
+        response_header_raw, response_header = await asyncio.wait_for(receive_message(child_reader, child_prefix, child_protocol), args.timeout)
+
+        return response_header['stats']
+    except (OSError, TimeoutError, KeyError):
+        return {'node': f"{child.address[0]}:{child.address[1]}", 'unreachable': True}    # Includes children too old to know of statistics.
+    finally:
+        for child_reader, child_writer, child_protocol, child_compressor in child_connections.values():
+            child_writer.close()
+
+
+async def handle_stats_http(reader, writer):
+
+    # Any request is answered with the statistics as plain text, the request itself only has to be read to its end.
+    try:
+        await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), args.timeout)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError, TimeoutError):
+        writer.close()
+        return
+
+    body = format_stats(await collect_stats()).encode()
+
+    try:
+        writer.write(f"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+    except OSError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_worker(cpus=None, crashes=0):
+
+    # The worker talks to the server over one end of a socket pair that it inherits.
+    server_end, worker_end = socket.socketpair()
+
+    command = [blender, '-b', '-P', f"{os.path.dirname(__file__)}/brpy_render.py", '--', str(worker_end.fileno())]
+
+    # Pin the worker to its CPU set before Blender starts, so all of its threads inherit the affinity. taskset does that
+    # without running any code of this server between fork and exec, which isn't safe while the server runs threads.
+    if cpus != None:
+        command[2:2] = ['-t', str(len(cpus))]
+        if taskset != None:
+            command[0:0] = [taskset, '-c', format_cpus(cpus)]
+
+    process = await asyncio.create_subprocess_exec(*command, stdout=subprocess.DEVNULL, pass_fds=(worker_end.fileno(),))
+    worker_end.close()
+
+
+    # Without taskset, Blender is pinned right after it started, which is still before it loads a file and starts rendering threads.
+    if cpus != None and taskset == None:
+        try:
+            os.sched_setaffinity(process.pid, cpus)
+        except ProcessLookupError:
+            pass    # Already gone, which shows once the worker is used.
+
+    worker_reader, worker_writer = await asyncio.open_connection(sock=server_end)
+
+
+    worker = Worker(process, worker_reader, worker_writer, cpus, crashes)
+
+    async with workers_condition:
+        workers.append(worker)
+        workers_condition.notify()
+
+    if cpus == None:
+        print(f"Blender worker {process.pid} started.")
+    else:
+        print(f"Blender worker {process.pid} started on CPUs {format_cpus(cpus)}.")
+
+    return worker
+
+
+async def restart_worker(worker, crashed=False):
+    workers.remove(worker)
+
+    worker.writer.close()
+    try:
+        worker.process.kill()
+    except ProcessLookupError:
+        pass    # Already gone.
+    await worker.process.wait()
+
+    if not crashed:
+        print(f"Blender worker {worker.process.pid} stopped, starting a new one.")
+        await start_worker(worker.cpus)
+        return
+
+
+    # A worker that keeps crashing, e.g. on a broken file, is restarted more and more slowly.
+    crashes = worker.crashes + 1
+    delay = min(WORKER_RESTART_MAX_DELAY, WORKER_RESTART_DELAY * 2 ** (crashes - 1))
+
+    print(f"Blender worker {worker.process.pid} stopped, starting a new one in {delay} seconds.")
+    await asyncio.sleep(delay)
+
+    await start_worker(worker.cpus, crashes)
+
+
+def crash_worker(worker):
+
+    # Restarting is delayed after a crash, so it happens in the background.
+    spawn(background_tasks, restart_worker(worker, True))
+
+
+def abandon_worker(worker):
+
+    # A worker whose response won't be awaited anymore would answer the next request with it, so it is replaced.
+    spawn(background_tasks, restart_worker(worker))
+
+
+def parse_cpus(cpu_list):
+    cpus = set()
+
+    for cpu_range in cpu_list.split(','):
+        first, separator, last = cpu_range.partition('-')
+        cpus.update(range(int(first), int(last if separator else first) + 1))
+
+    return cpus
+
+
+def format_cpus(cpus):
+    cpus = sorted(cpus)
+    cpu_ranges = []
+
+    for cpu in cpus:
+        if len(cpu_ranges) > 0 and cpu_ranges[-1][1] == cpu - 1:
+            cpu_ranges[-1][1] = cpu
+        else:
+            cpu_ranges.append([cpu, cpu])
+
+    return ','.join(str(first) if first == last else f"{first}-{last}" for first, last in cpu_ranges)
+
+
+async def acquire_worker(blob, wait=True):
+    async with workers_condition:
         while True:
-            try:
-                request = render_requests.pop(0)
-                break
-            except IndexError:
-                with render_requests_lock:
-                    render_requests_lock.wait()
+            idle_workers = [worker for worker in workers if not worker.busy]
+
+            if len(idle_workers) > 0:
+
+                # Prefer a worker that already has the file loaded, then one that has none loaded, then the one idle for the longest time.
+                worker = min(idle_workers, key=lambda worker: (worker.blob != blob, worker.blob != None, worker.last_used))
+                worker.busy = True
+
+                return worker
+
+            if not wait:
+                return None
+
+            await workers_condition.wait()
+
+
+async def release_worker(worker):
+    async with workers_condition:
+        worker.busy = False
+        worker.last_used = time.time()
+        workers_condition.notify()
+
+
+async def render_on_worker(worker, session, blob, frame, background_save=False, tiles=None, sample_parts=None):
+    request_header = encode_message(LocalRenderRequest(session, blob, frame, background_save, tiles, sample_parts).__dict__)
+    await send_message(worker.writer, request_header)
+
+    worker.blob = None    # Unknown until the worker has responded, in case it fails to load the file.
+
+    response_header = await receive_from_worker(worker)
 
-        print(f"{client_prefix} Forwarding render request for frame {request['frames']} of session '{request['session']}' to {child_prefix}.")
+    worker.blob = blob
 
+    return response_header['image_name']
 
-        request = json.dumps(request).encode()
-        child_connection.sendall(len(request).to_bytes(8))
-        child_connection.sendall(request)
 
+async def receive_from_worker(worker):
+    response_header_raw, response_header = await receive_message(worker.reader, f"[Blender worker {worker.process.pid}]")
+    return response_header
 
-        with busy_lock:
-            busy_lock.wait()
 
+async def preload_session(session):
 
-def send_frame(connection, send_lock, image, frame, client_prefix, session):
+    # Have an idle worker load the file of a session ahead of time, so the first frame doesn't wait for it.
+    # The session may have been deleted or replaced in the meantime, in which case there is nothing to preload.
     try:
-        with open(image, 'rb') as file:
-            image_data = file.read()
-    except UnboundLocalError:
-        print("Could not find saved frame, something must have gone wrong with the render. Exiting.")
-        sys.exit()
+        blob = os.readlink(f"{session}.blend")
+    except OSError:
+        return
 
-    os.remove(image)
+    if any(worker.blob == blob for worker in workers):
+        return
 
+    worker = await acquire_worker(blob, False)
+    if worker == None:
+        return
 
-    response_header = json.dumps(
-        RenderFrameResponse(
-            len(image_data),
-            frame,
-            image.split('.')[-1]
-        ).__dict__
-    ).encode()
-    response = image_data
+    try:
+        await render_on_worker(worker, session, blob, None)
+        print(f"Blender worker {worker.process.pid} preloaded file '{session}.blend'.")
+    except ConnectionError:
+        await restart_worker(worker)
+        return
 
+    await release_worker(worker)
 
-    with send_lock:
-        connection.sendall(len(response_header).to_bytes(8))
-        connection.sendall(response_header)
-        connection.sendall(response)
 
-    print(f"{client_prefix} Sent frame {frame} of session '{session}'.")
+async def finish_background_save(worker, image, request, writer, protocol, compressor, send_lock, saving_slots, render_requests, prefetch, render_time, client_prefix):
+    frame = request['frames']
+    session = request['session']
 
+    save_start = time.perf_counter()
+    try:
+        await receive_from_worker(worker)
+    except ConnectionError:
+        print(f"{client_prefix} Blender stopped while saving frame {frame} of session '{session}'.")
 
-def handle_local_render(connection, render_requests, render_requests_lock, session, send_lock, client_prefix):
-    blender_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    blender_port = args.port + 1
+        saving_slots.release()
 
+        crash_worker(worker)
+        await retry_frame(request, writer, protocol, send_lock, render_requests, prefetch, client_prefix)
+        return
+    except asyncio.CancelledError:
+        abandon_worker(worker)
+        raise
 
-    while True:
+    stage_times['save'].record(time.perf_counter() - save_start)
+
+    image, keep = cache_frame(image, frame_cache_key(worker.blob, request))
+    file = open_frame(image)
+
+    await release_worker(worker)
+    saving_slots.release()
+
+    if file == None:
+        print(f"{client_prefix} Could not find the saved image of frame {frame} of session '{session}'.")
+
+        await retry_frame(request, writer, protocol, send_lock, render_requests, prefetch, client_prefix)
+        return
+
+    frame_failures.pop((session, frame), None)
+
+    await send_frame(writer, protocol, compressor, send_lock, image, file, frame, client_prefix, session, keep, render_time)
+
+
+async def retry_frame(request, writer, protocol, send_lock, render_requests, prefetch, client_prefix):
+    frame = request['frames']
+    session = request['session']
+
+    # A frame that failed to render is rendered again, unless it has failed too often already, e.g. by Blender running out of memory on it every time.
+    failures = frame_failures.get((session, frame), 0) + 1
+    if failures < MAX_FRAME_FAILURES:
+        frame_failures[(session, frame)] = failures
+
+        prefetch.give_back()
+        await render_requests.put(request, front=True)
+        return
+
+    frame_failures.pop((session, frame), None)
+
+    print(f"{client_prefix} Rendering frame {frame} of session '{session}' failed {failures} times, giving up on it.")
+
+    response_header = encode_message(RenderFailedResponse(frame, f"Rendering the frame failed {failures} times.").__dict__, protocol)
+    try:
+        async with send_lock:
+            await send_message(writer, response_header)
+    except OSError:
+        pass
+
+
+async def request_more_frames(writer, protocol, send_lock, prefetch, client_prefix):
+    frame_count, token = prefetch.take()
+
+    if frame_count > 0:
+        print(f"{client_prefix} Requesting {frame_count} more frame(s).")
+
+        response_header = encode_message(RenderRequestResponse(frame_count, token).__dict__, protocol)
         try:
-            blender_socket.bind(('', blender_port))
-            break
+            async with send_lock:
+                await send_message(writer, response_header)
         except OSError:
-            blender_port = (blender_port + 1) % 65536
+            return False
 
-    subprocess.Popen((blender, '-b', '-P', f"{os.path.dirname(__file__)}/brpy_render.py", '--', str(blender_port), session), stdout=subprocess.DEVNULL)
+    return True
 
-    blender_socket.listen()
-    blender_socket, address = blender_socket.accept()
 
+async def handle_local_render(writer, protocol, compressor, render_requests, send_lock, saving_slots, prefetch, rendering, tasks, client_prefix):
     while True:
-        while True:
-            try:
-                request = render_requests.pop(0)
-                break
-            except IndexError:
-                with render_requests_lock:
-                    render_requests_lock.wait()
+        request = await render_requests.get()
+        rendering[request['frames']] = None    # Taken, but no worker has been acquired yet.
+
+
+        # Request more frames as soon as one is taken, so enough frames are waiting to render once this one is done.
+        if not await request_more_frames(writer, protocol, send_lock, prefetch, client_prefix):
+            return    # The client is gone.
 
 
         frame = request['frames']
         session = request['session']
 
+        # The file may have been deleted since the job started. The client reassigns the frames of this node, this one
+        # included, once the connection is gone.
+        try:
+            blob = os.readlink(f"{session}.blend")
+        except FileNotFoundError:
+            print(f"{client_prefix} No file for session '{session}' has been uploaded, closing the connection so frame {frame} is rendered elsewhere.")
+
+            rendering.pop(frame, None)
+            writer.transport.abort()
+            return
 
-        # Send render request to locally running render script using bpy.
-        request_header = json.dumps(LocalRenderRequest(session, frame).__dict__).encode()
-        blender_socket.sendall(len(request_header).to_bytes(8))
-        blender_socket.sendall(request_header)
 
+        # Send render request to a locally running render script using bpy, preferably one that already has the file loaded.
+        worker = await acquire_worker(blob)
 
-        response_header_size = int.from_bytes(receive_bytes(blender_socket, 8))
-        response_header = json.loads(receive_bytes(blender_socket, response_header_size))
+        if frame not in rendering:
+            print(f"{client_prefix} Skipping cancelled frame {frame} of session '{session}'.")
 
-        image = response_header['image_name']
+            await release_worker(worker)
+            continue
 
+        rendering[frame] = worker    # Lets the client cancel the frame by stopping the worker.
 
-        print(f"{client_prefix} Rendered frame {frame} of session '{session}', requesting more work.")
+        render_start = time.time()
+        try:
+            image = await render_on_worker(worker, session, blob, frame, args.background_save, request.get('tiles'), request.get('sample_parts'))
+        except ConnectionError:
+            if frame not in rendering:
+                print(f"{client_prefix} Stopped rendering cancelled frame {frame} of session '{session}'.")
+                await restart_worker(worker)
+            else:
+                print(f"{client_prefix} Blender stopped while rendering frame {frame} of session '{session}'.")
 
-        response_header = json.dumps(RenderRequestResponse(1).__dict__).encode()
-        with send_lock:
-            connection.sendall(len(response_header).to_bytes(8))
-            connection.sendall(response_header)
+                rendering.pop(frame)
 
+                crash_worker(worker)
+                await retry_frame(request, writer, protocol, send_lock, render_requests, prefetch, client_prefix)
 
-        threading.Thread(target=send_frame, args=(connection, send_lock, image, frame, client_prefix, session)).start()
+            continue
+        except asyncio.CancelledError:
+            abandon_worker(worker)
+            raise
 
+        # The frame may have been cancelled just as it finished, in which case the worker has been stopped anyway.
+        if rendering.pop(frame, None) == None:
+            print(f"{client_prefix} Discarding cancelled frame {frame} of session '{session}'.")
 
-def get_child_connection(child, thread_id):
-    try:
-        child_connection = child.connections[thread_id]
-    except KeyError:
-        child_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        child_connection.connect(child.address)
-        child.connections[thread_id] = child_connection
+            if os.path.exists(image):
+                os.remove(image)
+
+            await restart_worker(worker)
+            continue
+
+        worker.crashes = 0
+
+        render_time = time.time() - render_start
+        prefetch.rendered(render_time)
+        stage_times['render'].record(render_time)    # Includes saving the frame, unless it is saved in the background.
+
+
+        if args.background_save:
+
+            # The worker responds as soon as the frame is rendered and saves it afterwards. Meanwhile the next frame
+            # can already be rendered by another worker, unless too many frames are still being saved.
+            print(f"{client_prefix} Rendered frame {frame} of session '{session}', saving it in the background.")
+
+            try:
+                await saving_slots.acquire()
+            except asyncio.CancelledError:
+                abandon_worker(worker)
+                raise
+
+            spawn(
+                tasks,
+                finish_background_save(
+                    worker,
+                    image,
+                    request,
+                    writer,
+                    protocol,
+                    compressor,
+                    send_lock,
+                    saving_slots,
+                    render_requests,
+                    prefetch,
+                    render_time,
+                    client_prefix
+                )
+            )
+        else:
+            await release_worker(worker)
+
+            print(f"{client_prefix} Rendered frame {frame} of session '{session}'.")
+
+            image, keep = cache_frame(image, frame_cache_key(blob, request))
+            file = open_frame(image)
 
-    return child_connection
+            if file == None:
+                print(f"{client_prefix} Could not find the saved image of frame {frame} of session '{session}'.")
 
+                await retry_frame(request, writer, protocol, send_lock, render_requests, prefetch, client_prefix)
+                continue
 
-def handle_requests(connection):
+            frame_failures.pop((session, frame), None)
+
+            spawn(tasks, send_frame(writer, protocol, compressor, send_lock, image, file, frame, client_prefix, session, keep, render_time))
+
+
+async def handle_requests(reader, writer, protocol=JSON_PROTOCOL, compressor=None):
 
     # Used to distinguish requests from different clients.
-    client_name = connection.getpeername()
+    client_name = writer.get_extra_info('peername')
     client_prefix = f"[{client_name[0]}:{client_name[1]}]"
 
+    print(f"{client_prefix} New connection, handling requests.")
+
 
-    # As multiple threads may try to send data to a client simultaneously, that needs to be guarded by a lock.
-    send_lock = threading.Lock()
+    # As multiple tasks may try to send data to a client simultaneously, that needs to be guarded by a lock.
+    send_lock = asyncio.Lock()
+
+    if compressor == None:
+        compressor = Compressor()    # Nothing is compressed until the client has told which codecs it accepts.
 
 
     startup = True
 
-    thread_id = threading.get_ident()
 
+    render_requests = FrameQueue(stage_times['queue'])
+    client_queues.add(render_requests)
 
-    render_requests = []
-    render_requests_lock = threading.Condition()
+    saving_slots = asyncio.Semaphore(args.local_workers)    # Limits how many frames may be saved in the background at once.
 
+    prefetch = Prefetch(args.local_workers, args.prefetch_limit)
 
-    for child in children:
-        try:
-            del child.connections[thread_id]
-        except KeyError:
-            pass
+    rendering = {}    # The workers rendering frames for this client, by frame.
 
+    child_connections = {}    # The connections to children made on behalf of this client.
+    child_links = []          # The children frames of this client are forwarded to.
 
-    with connection:
-        while True:
-            request_header_size_raw = receive_bytes(connection, 8)
-            request_header_size = int.from_bytes(request_header_size_raw)
+    tasks = set()    # The tasks working for this client, which are cancelled once it is gone.
 
-            request_header_raw = receive_bytes(connection, request_header_size)
-            request_header = json.loads(request_header_raw)
+
+    try:
+        while True:
+            try:
+                request_header_raw, request_header = await receive_message(reader, client_prefix, protocol)
+            except ConnectionBrokenError:
+                return
 
 
             try:
@@ -238,107 +1020,278 @@ def handle_requests(connection):
 
                         continue
 
+                    case 'STATS':
+                        response_header = encode_message(StatsResponse(await collect_stats()).__dict__, protocol)
+                        await send_message(writer, response_header)
+
+                        continue
+
+                    case 'HELLO':
+
+                        # Use the newest protocol both sides support, the response itself is still sent with JSON headers.
+                        version = max(set(request_header['versions']) & set(PROTOCOLS), default=JSON_PROTOCOL)
+
+                        multiplex = request_header.get('multiplex', False)
+
+                        response_header = encode_message(HelloResponse(version, multiplex, codecs).__dict__)
+                        await send_message(writer, response_header)
+
+                        protocol = version
+                        compressor = Compressor(codecs, request_header.get('codecs', ()))
+
+
+                        # A parent node turns the connection into a link, which carries the requests of each of its clients in a stream of its own.
+                        if multiplex:
+                            print(f"{client_prefix} Opened link from parent node.")
+
+                            await Link(
+                                reader,
+                                writer,
+                                protocol,
+                                client_prefix,
+                                lambda stream_reader, stream_writer: handle_requests(stream_reader, stream_writer, protocol, compressor),
+                                compressor
+                            ).run()
+
+                            return
+
+                        continue
+
 
             if not session.isalnum():
                 print(f"{client_prefix} Invalid session name of '{session}', breaking connection to client.")
-                sys.exit()
+                return
 
 
             match request_header['type']:
                 case 'UPLOAD':
-                    print(f"{client_prefix} Receiving new file for session '{session}'.")
-                    blend_file = receive_bytes(connection, request_header['size'])
-
-                    with open(f"{session}.blend", 'wb') as file:
-                        file.write(blend_file)
-                    print(f"{client_prefix} Saved file '{session}.blend'.")
-
-
-                    for child in children:
-                        threading.Thread(
-                            target=forward_requests,
-                            args=(
-                                child,
-                                thread_id,
-                                request_header_size_raw,
-                                request_header_raw,
-                                blend_file
-                            )
-                        ).start()
+                    blend_hash = request_header['hash']
+                    if not is_valid_hash(blend_hash):
+                        print(f"{client_prefix} Invalid hash of '{blend_hash}', breaking connection to client.")
+                        return
+
+                    blob = f"blobs/{blend_hash}.blend"
+
+
+                    # Another client may be uploading the same file right now, wait for it to finish instead of writing the same partial file.
+                    while blob in uploads:
+                        await uploads[blob].wait()
+
+                    stored = os.path.exists(blob)
+                    if not stored:
+                        uploads[blob] = asyncio.Event()
+
+                    try:
+                        if stored:
+                            link_session(session, blend_hash)
+
+                            upload = Upload(blob, request_header['size'], request_header['size'])
+                            print(f"{client_prefix} File for session '{session}' is already stored, skipping upload.")
+                        else:
+
+                            # Resume from a partial file an interrupted upload may have left behind.
+                            try:
+                                offset = os.path.getsize(f"{blob}.part")
+                            except FileNotFoundError:
+                                offset = 0
+
+                            if offset > request_header['size']:
+                                offset = 0
+
+                            upload = Upload(f"{blob}.part", request_header['size'], offset, base=find_delta_base(session, request_header.get('delta')))
+
+                            with open(upload.path, 'ab') as file:
+                                file.truncate(offset)    # Children may start reading the partial file before the first chunk has arrived.
+
+
+                        # Forward the request to children right away, so they receive every chunk as soon as it has arrived here
+                        # instead of waiting for the whole file. Children only request the file if they don't store it yet.
+                        forwards = [
+                            spawn(tasks, forward_requests(child, child_connections, request_header, upload))
+                            for child in children
+                        ]
+
+
+                        error = None
+                        if not stored:
+
+                            # Clients asking for a delta without knowing the file this node has are sent the signatures of its blocks.
+                            if upload.base != None:
+                                base = f"blobs/{upload.base}.blend"
 
+                                signatures = b''
+                                block_size = 0
+                                if request_header['delta'] == '':
+                                    block_size = delta_block_size(os.path.getsize(base))
+                                    signatures = await asyncio.to_thread(compute_signatures, base, block_size)
 
-                    response_header = json.dumps(OkayResponse().__dict__).encode()
+                                response_header = encode_message(DeltaResponse(upload.committed, upload.base, block_size, len(signatures)).__dict__, protocol)
+                                await send_message(writer, response_header, signatures)
+                            else:
+                                base = None
+
+                                response_header = encode_message(SendResponse(upload.committed).__dict__, protocol)
+                                await send_message(writer, response_header)
+
+                            if upload.committed > 0:
+                                print(f"{client_prefix} Resuming upload of file for session '{session}' at {upload.committed / 1000000:.1f} MB.")
+                            elif upload.base != None:
+                                print(f"{client_prefix} Receiving file for session '{session}' as a delta against blob '{upload.base}'.")
+                            else:
+                                print(f"{client_prefix} Receiving new file for session '{session}'.")
+
+                            try:
+                                error = await receive_chunks(reader, upload, client_prefix, protocol, base, args.timeout)
+                            except ConnectionBrokenError:
+                                error = "Connection to client broken."
+
+                            if error == None and upload.digest.hexdigest() != blend_hash:
+                                error = "File does not match its hash."
+
+                            if error != None:
+                                await upload.fail()
+
+
+                        # Only respond once every child has confirmed, which in turn only happens once all of its children have.
+                        statuses = await asyncio.gather(*forwards)
+
+
+                        if error != None:
+                            print(f"{client_prefix} Upload of file for session '{session}' failed: {error} Breaking connection to client.")
+
+                            if upload.committed == upload.size:
+                                os.remove(upload.path)    # Corrupt as a whole, so it can't be resumed.
+                            else:
+                                print(f"{client_prefix} Keeping partial file to resume from.")
+
+
+                            # The connection can't be used anymore because the client may still be sending chunks, it has to reconnect and resume.
+                            response_header = encode_message(FailResponse(error).__dict__, protocol)
+                            try:
+                                await send_message(writer, response_header)
+                            except OSError:
+                                pass
+
+                            return
+
+
+                        if not stored:
+                            os.replace(upload.path, blob)
+                            link_session(session, blend_hash)
+
+                        print(f"{client_prefix} Linked file '{session}.blend' to blob '{blend_hash}'.")
+
+                        spawn(background_tasks, preload_session(session))
+
+
+                        if statuses.count('OKAY') == len(children):
+                            response_header = encode_message(OkayResponse().__dict__, protocol)
+                        else:
+                            response_header = encode_message(FailResponse("Upload to a child node failed.").__dict__, protocol)
+                            print(f"{client_prefix} Upload of file for session '{session}' to a child node failed.")
+                    finally:
+                        if not stored:
+                            uploads.pop(blob).set()
 
                 case 'RENDER':
+                    prefetch.arrived(request_header.get('token'))
+
                     frames = request_header['frames']
                     if type(frames) == int:
-                        render_requests.append(request_header)
+                        frames = [frames]
 
-                        with render_requests_lock:
-                            render_requests_lock.notify()
+                    queued_frames = 0
+                    for frame in frames:
+                        request = copy.copy(request_header)
+                        request['frames'] = frame
 
-                        print(f"{client_prefix} Received render request for frame {frames} of session '{session}'.")
+                        # Frames rendered before are sent from the cache right away, without waiting for a worker.
+                        if await send_cached_frame(writer, protocol, compressor, send_lock, request, prefetch, tasks, client_prefix):
+                            continue
 
-                    else:
-                        for frame in frames:
-                            request = copy.copy(request_header)
-                            request['frames'] = frame
-                            render_requests.append(request)
+                        render_requests.push(request)
+                        queued_frames += 1
 
-                            print(f"{client_prefix} Received render request for frame {frame} of session '{session}'.")
+                        print(f"{client_prefix} Received render request for frame {frame} of session '{session}'.")
 
 
-                        with render_requests_lock:
-                            render_requests_lock.notify(len(frames))
+                    await render_requests.notify(queued_frames)
 
 
                     if startup:
-                        threading.Thread(
-                            target=handle_local_render,
-                            args=(
-                                connection,
-                                render_requests,
-                                render_requests_lock,
-                                request_header['session'],
-                                send_lock,
-                                client_prefix
+
+                        # Without the file of the session, frames can only be passed on to children, local render loops
+                        # would take frames they can't render.
+                        local_workers = args.local_workers
+                        if not os.path.islink(f"{session}.blend"):
+                            print(f"{client_prefix} No file for session '{session}' has been uploaded, only children render its frames.")
+                            local_workers = 0
+
+                        for local_worker in range(local_workers):
+                            spawn(
+                                tasks,
+                                handle_local_render(
+                                    writer,
+                                    protocol,
+                                    compressor,
+                                    render_requests,
+                                    send_lock,
+                                    saving_slots,
+                                    prefetch,
+                                    rendering,
+                                    tasks,
+                                    client_prefix
+                                )
                             )
-                        ).start()
 
+                        spawn(tasks, send_heartbeats(writer, protocol, send_lock))
+
+
+                        # Children that can't be reached are left out, their share of frames is rendered elsewhere.
+                        for child in children:
+                            try:
+                                child_reader, child_writer, child_protocol, child_compressor = await get_child_connection(child, child_connections)
+                            except OSError:
+                                print(f"{client_prefix} Could not connect to child [{child.address[0]}:{child.address[1]}], rendering without it.")
+                                continue
+
+                            child_prefix = child_writer.get_extra_info('peername')
+                            child_links.append(ChildLink(child_reader, child_writer, child_protocol, f"[{child_prefix[0]}:{child_prefix[1]}]", child.relayed))
+
+
+                        # The client reassigns the frames of this node once the connection is gone.
+                        if local_workers + len(child_links) == 0:
+                            print(f"{client_prefix} No children to render frames of session '{session}' either, closing the connection.")
 
-                        if len(children) > 0:
-                            response_header = json.dumps(RenderRequestResponse(len(children)).__dict__).encode()
+                            writer.transport.abort()
+                            return
 
-                            with send_lock:
-                                connection.sendall(len(response_header).to_bytes(8))
-                                connection.sendall(response_header)
 
+                        # Request enough frames to keep every child and every local render loop busy, the client already sent one.
+                        initial_frame_count = len(child_links) + local_workers - 1
 
-                            for child in children:
-                                child_connection = get_child_connection(child, thread_id)
-                                busy_lock = threading.Condition()
+                        if initial_frame_count > 0:
+                            response_header = encode_message(RenderRequestResponse(initial_frame_count).__dict__, protocol)
 
-                                threading.Thread(
-                                    target=handle_child_render,
-                                    args=(
-                                        child_connection,
-                                        render_requests,
-                                        render_requests_lock,
-                                        busy_lock,
-                                        client_prefix
-                                    )
-                                ).start()
+                            async with send_lock:
+                                await send_message(writer, response_header)
 
-                                threading.Thread(
-                                    target=forward_child_responses,
-                                    args=(
-                                        connection,
-                                        child_connection,
-                                        send_lock,
-                                        busy_lock,
-                                        client_prefix
-                                    )
-                                ).start()
+
+                        for link in child_links:
+                            spawn(tasks, handle_child_render(link, render_requests, client_prefix))
+
+                            spawn(
+                                tasks,
+                                forward_child_responses(
+                                    writer,
+                                    protocol,
+                                    compressor,
+                                    link,
+                                    send_lock,
+                                    render_requests,
+                                    client_prefix
+                                )
+                            )
 
 
                         startup = False
@@ -346,29 +1299,78 @@ def handle_requests(connection):
 
                     continue
 
-                case 'DELETE':
+                case 'CANCEL':
+
+                    # Another server delivered these frames first, so drop them from the queue or stop rendering them.
+                    cancelled_frames = render_requests.remove(lambda request: request['frames'] in request_header['frames'])
+
+                    prefetch.forget(cancelled_frames)
+
+                    for frame in request_header['frames']:
+                        if frame in rendering:
+                            worker = rendering.pop(frame)
+                            if worker != None:
+                                worker.process.kill()
+
+
+                    # Children may have the frames queued or be rendering them.
+                    for link in child_links:
+                        for frame in request_header['frames']:
+                            link.forwarded.pop(frame, None)
+
+                        if link.lost:
+                            continue
+
+                        try:
+                            await send_message(link.writer, encode_message(request_header, link.protocol))
+                        except OSError:
+                            pass    # The task receiving from the child notices the loss.
+
+                    print(f"{client_prefix} Cancelled frame(s) {request_header['frames']} of session '{session}'.")
+
+
+                    response_header = encode_message(RenderCancelResponse(request_header['frames']).__dict__, protocol)
+
+                    # The client may already be done if the cancelled frames were the last ones it was waiting for.
                     try:
-                        os.remove(f"{session}.blend")
-                        response_header = json.dumps(OkayResponse().__dict__).encode()
+                        async with send_lock:
+                            await send_message(writer, response_header)
+                    except OSError:
+                        return
+
+                    continue
+
+                case 'DELETE':
+                    deleted = unlink_session(session)
+
+                    if deleted:
+                        response_header = encode_message(OkayResponse().__dict__, protocol)
                         print(f"{client_prefix} File '{session}.blend' deleted.")
-                    except FileNotFoundError:
-                        response_header = json.dumps(FailResponse("File does not exist on server.").__dict__).encode()
+                    else:
+                        response_header = encode_message(FailResponse("File does not exist on server.").__dict__, protocol)
                         print(f"{client_prefix} Could not remove nonexistant file '{session}.blend'.")
 
-                    for child in children:
-                        threading.Thread(
-                            target=forward_requests,
-                            args=(
-                                child,
-                                thread_id,
-                                request_header_size_raw,
-                                request_header_raw
-                            )
-                        ).start()
 
+                    # Children are done before responding, as the client closes the connection once it has the response.
+                    await asyncio.gather(*(forward_requests(child, child_connections, request_header) for child in children))
+
+
+            try:
+                await send_message(writer, response_header)
+            except OSError:
+                return    # The client is gone.
+
+    finally:
+        client_queues.discard(render_requests)
+
+        # Stop everything done for this client, closing the connections to the children ends their handling of it as well.
+        for task in tasks:
+            task.cancel()
+
+        for child_reader, child_writer, child_protocol, child_compressor in child_connections.values():
+            child_writer.close()
 
-            connection.sendall(len(response_header).to_bytes(8))
-            connection.sendall(response_header)
+        writer.close()
 
 
 # Start of server program.
@@ -402,6 +1404,124 @@ parser.add_argument(
     help="the port to listen on for incomming connections\n\n"
 )
 
+parser.add_argument(
+    '-w', '--workers',
+    metavar='workers',
+    type=int,
+    help="""the number of Blender processes kept running to render frames
+defaults to the number of local workers
+
+workers are started along with the server and shared by all clients
+a worker keeps its .blend file loaded, so frames are preferably
+rendered by a worker that already has the file of their session loaded\n\n"""
+)
+
+parser.add_argument(
+    '-l', '--local-workers',
+    metavar='local-workers',
+    type=int,
+    default=1,
+    help="""the number of frames of a client rendered at the same time on this node
+each one is rendered by its own worker
+
+rendering several frames at once keeps large machines busy during
+single-threaded phases like scene synchronization and image encoding\n\n"""
+)
+
+parser.add_argument(
+    '--prefetch-limit',
+    metavar='prefetch-limit',
+    type=int,
+    default=8,
+    help="""the maximum number of frames requested ahead of time
+
+frames are requested early enough to bridge the time it takes for them to arrive,
+based on the measured render time and round trip time to the client
+the limit keeps a node from hoarding frames at the end of a job\n\n"""
+)
+
+parser.add_argument(
+    '--background-save',
+    action='store_true',
+    help="""request the next frame as soon as a frame is rendered and save it in the background
+
+a worker stays busy while saving, so use more workers than local workers
+for the next frame to be rendered while the previous one is being encoded
+most useful with slowly encoding formats like PNG\n\n"""
+)
+
+parser.add_argument(
+    '--cache-size',
+    metavar='cache-size',
+    type=float,
+    help="""keep rendered frames in a cache of at most this many megabytes in the working directory
+
+frames are identified by the content of their .blend file, their frame number and render settings
+cached frames are sent right away when requested again, without rendering them
+the frames used the longest time ago are evicted once the cache is full
+disabled by default\n\n"""
+)
+
+parser.add_argument(
+    '--stats-port',
+    metavar='stats-port',
+    type=int,
+    help="""serve statistics of this node and its children over HTTP on this port
+
+the statistics are given in the text format of Prometheus and include how long frames
+spend in each stage, the number of waiting frames, the number of busy workers and
+the throughput of frames sent to clients and relayed from children
+they can also be requested with the STATS command of the client\n\n"""
+)
+
+parser.add_argument(
+    '--compression',
+    metavar='codecs',
+    help=f"""a comma separated list of the codecs frames and .blend files may be compressed with,
+in the order they are preferred in, or 'none' to send and accept everything uncompressed
+defaults to all codecs available on this node, which are: {', '.join(CODECS)}
+
+each connection uses the first of these codecs the other side accepts as well
+compression is turned off for a while whenever it doesn't pay off, e.g. for frames
+that are already compressed or if the connection is faster than compressing\n\n"""
+)
+
+parser.add_argument(
+    '--cpu-sets',
+    metavar='cpu-sets',
+    help="""a list of CPU sets that workers are pinned to, one set per worker in turn
+
+takes a list of semicolon separated CPU lists or NUMA nodes:
+
+    "0-31;32-63" or "node0;node1"
+
+a worker uses as many threads as its CPU set contains CPUs\n\n"""
+)
+
+parser.add_argument(
+    '--heartbeat-interval',
+    metavar='heartbeat-interval',
+    type=float,
+    default=5,
+    help="""the number of seconds between heartbeats sent to clients while rendering
+
+heartbeats let clients tell a slow render apart from a lost node\n\n"""
+)
+
+parser.add_argument(
+    '--timeout',
+    metavar='timeout',
+    type=float,
+    default=30,
+    help="""the number of seconds a child may stay silent before it is considered lost
+
+the frames of a lost child are reassigned to this node and the remaining children
+should be well above the heartbeat interval of the children
+
+an upload is given up on if no data of it arrives for this long either, so an uploader
+that went silent doesn't keep others from resuming the same file\n\n"""
+)
+
 parser.add_argument(
     '--parents',
     metavar='parents',
@@ -437,6 +1557,52 @@ else:
 if args.port < 0 or args.port > 65535:
     sys.exit(f"Port {args.port} is not within the range of 0 to 65535, exiting.")
 
+if args.local_workers < 1:
+    sys.exit(f"At least one local worker is needed, but {args.local_workers} were requested. Exiting.")
+
+if args.prefetch_limit < 1:
+    sys.exit(f"The prefetch limit must be at least 1, but is {args.prefetch_limit}. Exiting.")
+
+if args.heartbeat_interval <= 0 or args.timeout <= 0:
+    sys.exit(f"The heartbeat interval and timeout must be positive, but are {args.heartbeat_interval} and {args.timeout}. Exiting.")
+
+if args.cache_size != None and args.cache_size < 0:
+    sys.exit(f"The cache size must not be negative, but is {args.cache_size}. Exiting.")
+
+if args.compression == None:
+    codecs = list(CODECS)
+else:
+    try:
+        codecs = parse_codecs(args.compression)
+    except ValueError as error:
+        sys.exit(f"Codec '{error}' is not available, must be one of {', '.join(CODECS)} or 'none'. Exiting.")
+
+if args.workers == None:
+    args.workers = args.local_workers
+elif args.workers < 1:
+    sys.exit(f"At least one worker is needed, but {args.workers} were requested. Exiting.")
+
+
+cpu_sets = []
+taskset = shutil.which('taskset')
+
+if args.cpu_sets != None:
+    for cpu_set in args.cpu_sets.split(';'):
+        cpu_set = cpu_set.strip()
+
+        # NUMA nodes are resolved to the CPUs they contain.
+        if cpu_set.startswith('node'):
+            try:
+                with open(f"/sys/devices/system/node/{cpu_set}/cpulist") as file:
+                    cpu_set = file.read().strip()
+            except FileNotFoundError:
+                sys.exit(f"NUMA node '{cpu_set}' does not exist, exiting.")
+
+        try:
+            cpu_sets.append(parse_cpus(cpu_set))
+        except ValueError:
+            sys.exit(f"CPU set '{cpu_set}' is malformed, must be a comma separated list of CPUs and ranges like '0-3,8'. Exiting.")
+
 
 # Change working directory last, so previous arguments are read from where the command was executed.
 try:
@@ -448,10 +1614,44 @@ except FileNotFoundError:
 except NotADirectoryError:
     sys.exit(f"'{args.work_dir}' is not a directory, exiting.")
 
+os.makedirs('blobs', exist_ok=True)    # Content-addressed store that the .blend files of sessions link to.
+
+
+frame_cache = collections.OrderedDict()    # Path and size of cached frames by key, from least to most recently used.
+frame_cache_size = 0
+frame_cache_limit = None
+
+if args.cache_size != None:
+    frame_cache_limit = int(args.cache_size * 1000000)
+
+
+    # Pick up the frames cached by previous runs, in the order they were last used.
+    os.makedirs('cache', exist_ok=True)
+
+    for entry in sorted(os.scandir('cache'), key=lambda entry: entry.stat().st_mtime):
+        frame_cache[os.path.splitext(entry.name)[0]] = (entry.path, entry.stat().st_size)
+        frame_cache_size += entry.stat().st_size
+
+    evict_cached_frames()
+
 
 parents = []
 children = []
 
+workers = []
+workers_condition = asyncio.Condition()    # Signals when a worker becomes idle.
+
+background_tasks = set()    # Tasks not tied to a client, like starting workers.
+
+uploads = {}    # Blobs currently being uploaded, with an event that is set once the upload has ended.
+
+frame_failures = {}    # How often Blender stopped on each frame, by session and frame.
+
+
+stage_times = {stage: Histogram() for stage in STATS_STAGES}    # How long frames spent in each stage on this node.
+frames_sent = Throughput()                                     # Frames sent to clients, rendered by this node.
+client_queues = set()                                          # The render requests of each client waiting on this node.
+
 
 if args.parents != None:
     args.parents = args.parents.split(',')
@@ -469,22 +1669,35 @@ if args.children != None:
         children.append(Child((child[0], int(child[1]))))
 
 
-# Main thread starts to listen for connections.
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+async def serve():
+
+    # A single event loop handles all connections, so the server is started within it.
     try:
-        server.bind(('', args.port))
+        server = await asyncio.start_server(handle_requests, '', args.port)
     except PermissionError:
         sys.exit(f"No permission to bind to port {args.port}, exiting.")
-    server.listen()
     print(f"Listening on port {args.port} for incoming requests.")
 
+    if args.stats_port != None:
+        try:
+            stats_server = await asyncio.start_server(handle_stats_http, '', args.stats_port)
+        except PermissionError:
+            sys.exit(f"No permission to bind to port {args.stats_port}, exiting.")
+        print(f"Serving statistics over HTTP on port {args.stats_port}.")
+
 
     for parent in parents:
-        threading.Thread(target=register_at_parent, args=(parent,)).start()
+        spawn(background_tasks, register_at_parent(parent))
 
 
-    # Keep listening for incoming connections and offload their requests to new threads.
-    while True:
-        connection, address = server.accept()
-        threading.Thread(target=handle_requests, args=(connection,)).start()
-        print(f"[{address[0]}:{address[1]}] New connection, handling requests.")
+    # Start the workers right away, so clients don't have to wait for Blender to start up.
+    for worker in range(args.workers):
+        cpus = cpu_sets[worker % len(cpu_sets)] if len(cpu_sets) > 0 else None
+        spawn(background_tasks, start_worker(cpus))
+
+
+    async with server:
+        await server.serve_forever()
+
+
+asyncio.run(serve())
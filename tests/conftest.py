@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# The modules are run as scripts from the root of the repository, where the tests import them from as well.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,118 @@
+import random
+import zlib
+
+import pytest
+
+import brpy_delta
+from brpy_delta import compute_delta, compute_signatures, delta_block_size
+
+
+PIECE_SIZE = 64 * 1024
+
+
+# Rebuild the file the way the receiver does, from the pieces copied from its own file and those sent literally.
+def reconstruct(base, new, checksums, copies, start=0):
+    data = bytearray()
+    for offset in sorted(checksums):
+        assert offset == start + len(data)
+
+        size, checksum = checksums[offset]
+        if offset in copies:
+            piece = base[copies[offset]:copies[offset] + size]
+        else:
+            piece = new[offset:offset + size]
+
+        assert len(piece) == size
+        assert zlib.crc32(piece) == checksum
+        data += piece
+
+    return bytes(data)
+
+
+def compute(tmp_path, base, new, offset=0):
+    (tmp_path / 'base').write_bytes(base)
+    (tmp_path / 'new').write_bytes(new)
+
+    block_size = delta_block_size(len(base))
+    signatures = compute_signatures(tmp_path / 'base', block_size)
+
+    return compute_delta(tmp_path / 'new', offset, block_size, signatures, PIECE_SIZE)
+
+
+def copied_size(checksums, copies):
+    return sum(checksums[offset][0] for offset in copies)
+
+
+@pytest.fixture(params=['numpy', 'no numpy'])
+def search(request, monkeypatch):
+    if request.param == 'no numpy':
+        monkeypatch.setattr(brpy_delta, 'numpy', None)
+    elif brpy_delta.numpy == None:
+        pytest.skip("numpy is not installed")
+
+    return request.param
+
+
+def test_edit_in_place(tmp_path, search):
+    random.seed(1)
+    base = random.randbytes(300000)
+    new = bytearray(base)
+    new[1000:1010] = b'x' * 10
+    new[200000:200050] = random.randbytes(50)
+    new = bytes(new)
+
+    checksums, copies = compute(tmp_path, base, new)
+
+    assert reconstruct(base, new, checksums, copies) == new
+    assert copied_size(checksums, copies) > len(new) * 0.9
+
+
+def test_moved_blocks(tmp_path, search):
+    random.seed(2)
+    base = random.randbytes(300000)
+    new = base[:1000] + b'inserted' + base[1000:150000] + base[160000:]
+
+    checksums, copies = compute(tmp_path, base, new)
+
+    assert reconstruct(base, new, checksums, copies) == new
+    if search == 'numpy':
+        assert copied_size(checksums, copies) > len(new) * 0.9    # Blocks after the insertion are found at their new offset.
+
+
+def test_unrelated_file(tmp_path, search):
+    random.seed(3)
+    base = random.randbytes(100000)
+    new = random.randbytes(120000)
+
+    checksums, copies = compute(tmp_path, base, new)
+
+    assert copies == {}
+    assert reconstruct(base, new, checksums, copies) == new
+    assert max(size for size, checksum in checksums.values()) <= PIECE_SIZE
+
+
+def test_offset_and_short_files(tmp_path, search):
+    random.seed(4)
+    base = random.randbytes(50000)
+
+    checksums, copies = compute(tmp_path, base, base, 20000)
+    assert reconstruct(base, base, checksums, copies, 20000) == base[20000:]
+
+    checksums, copies = compute(tmp_path, base, b'short')
+    assert copies == {}
+    assert checksums == {0: (5, zlib.crc32(b'short'))}
+
+    checksums, copies = compute(tmp_path, base, b'')
+    assert checksums == {}
+
+
+def test_identical_file_is_copied_in_pieces(tmp_path, search):
+    random.seed(5)
+    base = random.randbytes(200000)
+
+    checksums, copies = compute(tmp_path, base, base)
+
+    assert reconstruct(base, base, checksums, copies) == base
+    assert copied_size(checksums, copies) == len(base) - len(base) % delta_block_size(len(base))
+    assert all(copies[offset] == offset for offset in copies)
+    assert all(size <= PIECE_SIZE for size, checksum in checksums.values())
@@ -0,0 +1,159 @@
+import struct
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from brpy_exr import (
+    average_exr,
+    compress_chunk,
+    decompress_chunk,
+    pack_exr_header,
+    read_exr_chunks,
+    stitch_exr,
+    BOX2I,
+    CHUNK_HEADER,
+    EXR_CHUNK_SCANLINES,
+    EXR_PIXEL_TYPES,
+    ExrFormatError,
+)
+
+
+WIDTH = 8
+CHANNELS = (('I', 0), ('R', 1), ('Z', 2))    # An object index, a half and a single precision float channel.
+SCANLINE_TYPE = numpy.dtype([(name, EXR_PIXEL_TYPES[pixel_type], WIDTH) for name, pixel_type in CHANNELS])
+
+
+# Write the scanlines as a single-part scanline image, the way Blender saves them.
+def write_exr(path, scanlines, y_min=0, compression=3):
+    channels = b''.join(name.encode() + b'\0' + struct.pack('<iB3xii', pixel_type, 0, 1, 1) for name, pixel_type in CHANNELS) + b'\0'
+    window = BOX2I.pack(0, y_min, WIDTH - 1, y_min + len(scanlines) - 1)
+    attributes = {
+        'channels': ('chlist', channels),
+        'compression': ('compression', bytes([compression])),
+        'dataWindow': ('box2i', window),
+        'displayWindow': ('box2i', window),
+    }
+    header = pack_exr_header(2, attributes)
+
+    chunk_scanlines = EXR_CHUNK_SCANLINES[compression]
+    chunks = [compress_chunk(scanlines[start:start + chunk_scanlines].tobytes(), compression) for start in range(0, len(scanlines), chunk_scanlines)]
+
+    offsets = []
+    offset = len(header) + 8 * len(chunks)
+    for data in chunks:
+        offsets.append(offset)
+        offset += CHUNK_HEADER.size + len(data)
+
+    with open(path, 'wb') as file:
+        file.write(header)
+        file.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+        for index, data in enumerate(chunks):
+            file.write(CHUNK_HEADER.pack(y_min + index * chunk_scanlines, len(data)))
+            file.write(data)
+
+
+def read_scanlines(path):
+    version, attributes, chunks = read_exr_chunks(path)
+    x_min, y_min, x_max, y_max = BOX2I.unpack(attributes['dataWindow'][1])
+    compression = attributes['compression'][1][0]
+    chunk_scanlines = EXR_CHUNK_SCANLINES[compression]
+
+    data = bytearray()
+    with open(path, 'rb') as file:
+        for y, offset, size in chunks:
+            file.seek(offset)
+            scanline_count = min(chunk_scanlines, y_max - y + 1)
+            data += decompress_chunk(file.read(size), scanline_count * SCANLINE_TYPE.itemsize, compression)
+
+    return (y_min, y_max), numpy.frombuffer(bytes(data), SCANLINE_TYPE)
+
+
+def make_scanlines(height, seed):
+    generator = numpy.random.default_rng(seed)
+
+    scanlines = numpy.zeros(height, SCANLINE_TYPE)
+    scanlines['I'] = generator.integers(0, 1000, (height, WIDTH))
+    scanlines['R'] = generator.random((height, WIDTH)) * 4
+    scanlines['Z'] = generator.random((height, WIDTH)) * 100
+
+    return scanlines
+
+
+@pytest.mark.parametrize('compression', [0, 3])
+def test_write_and_read(tmp_path, compression):
+    scanlines = make_scanlines(40, 1)
+    write_exr(tmp_path / 'image.exr', scanlines, 5, compression)
+
+    window, read = read_scanlines(tmp_path / 'image.exr')
+
+    assert window == (5, 44)
+    assert read.tobytes() == scanlines.tobytes()
+
+
+@pytest.mark.parametrize('compression', [0, 3])
+def test_stitch_tiles(tmp_path, compression):
+    chunk_scanlines = EXR_CHUNK_SCANLINES[compression]
+    scanlines = make_scanlines(3 * chunk_scanlines + 5, 2)
+
+    # Every tile is rendered with its own data window, the stitched image takes the window of the top one.
+    bounds = (0, chunk_scanlines, 3 * chunk_scanlines, len(scanlines))
+    tile_paths = []
+    for index, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        tile_paths.append(tmp_path / f'tile{index}.exr')
+        write_exr(tile_paths[-1], scanlines[start:end], 100 + start, compression)
+
+    stitch_exr(tile_paths, tmp_path / 'image.exr')
+
+    window, read = read_scanlines(tmp_path / 'image.exr')
+    assert window == (100, 100 + len(scanlines) - 1)
+    assert read.tobytes() == scanlines.tobytes()
+
+
+def test_stitch_rejects_tiles_off_chunk_boundaries(tmp_path):
+    scanlines = make_scanlines(40, 3)
+    write_exr(tmp_path / 'tile0.exr', scanlines[:10])
+    write_exr(tmp_path / 'tile1.exr', scanlines[10:])
+
+    with pytest.raises(ExrFormatError):
+        stitch_exr([tmp_path / 'tile0.exr', tmp_path / 'tile1.exr'], tmp_path / 'image.exr')
+
+
+@pytest.mark.parametrize('compression', [0, 3])
+def test_average_sample_parts(tmp_path, compression):
+    parts = [make_scanlines(37, seed) for seed in range(3)]
+
+    part_paths = []
+    for index, scanlines in enumerate(parts):
+        part_paths.append(tmp_path / f'part{index}.exr')
+        write_exr(part_paths[-1], scanlines, 0, compression)
+
+    average_exr(part_paths, tmp_path / 'image.exr')
+
+    window, read = read_scanlines(tmp_path / 'image.exr')
+    assert window == (0, 36)
+
+    for name in ('R', 'Z'):
+        expected = sum(scanlines[name].astype(numpy.float64) for scanlines in parts) / len(parts)
+        assert numpy.array_equal(read[name], expected.astype(read[name].dtype))
+
+    assert numpy.array_equal(read['I'], parts[0]['I'])    # Integer channels can't be averaged.
+
+
+def test_average_rejects_mismatched_parts(tmp_path):
+    write_exr(tmp_path / 'part0.exr', make_scanlines(32, 4))
+    write_exr(tmp_path / 'part1.exr', make_scanlines(48, 5))
+
+    with pytest.raises(ExrFormatError):
+        average_exr([tmp_path / 'part0.exr', tmp_path / 'part1.exr'], tmp_path / 'image.exr')
+
+
+def test_truncated_image(tmp_path):
+    write_exr(tmp_path / 'image.exr', make_scanlines(64, 6))
+    data = (tmp_path / 'image.exr').read_bytes()
+
+    for size in (4, 100, 300, len(data) // 2):
+        (tmp_path / 'truncated.exr').write_bytes(data[:size])
+
+        with pytest.raises(ExrFormatError):
+            read_exr_chunks(tmp_path / 'truncated.exr')
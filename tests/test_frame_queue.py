@@ -0,0 +1,138 @@
+import asyncio
+
+from brpy_lib import FrameQueue
+
+
+def take_all(queue):
+    return [queue.get_nowait() for index in range(len(queue))]
+
+
+def test_priority_then_insertion_order():
+    queue = FrameQueue()
+    for frame, priority in ((1, 2), (2, 0), (3, 1), (4, 0), (5, 2)):
+        queue.push(frame, priority)
+
+    assert len(queue) == 5
+    assert take_all(queue) == [2, 4, 3, 1, 5]
+    assert len(queue) == 0
+
+
+def test_front_requeue():
+    queue = FrameQueue()
+    for frame in range(1, 5):
+        queue.push(frame)
+
+    assert queue.get_nowait() == 1
+    assert queue.get_nowait() == 2
+
+    # Frames put back are taken before all others of their priority, the last one put back first.
+    queue.push(2, front=True)
+    queue.push(1, front=True)
+    queue.push(5)
+
+    assert take_all(queue) == [1, 2, 3, 4, 5]
+
+
+def test_front_requeue_keeps_priority():
+    queue = FrameQueue()
+    queue.push(1, (0, -5))
+    queue.push(2, (1, -9))
+    queue.push(3, (1, -9), front=True)
+    queue.push(4, (1, -10))
+
+    assert take_all(queue) == [1, 4, 3, 2]
+
+
+def test_remove():
+    queue = FrameQueue()
+    for frame in range(10):
+        queue.push(frame, frame % 3)
+
+    assert queue.remove(lambda frame: frame % 2 == 0) == 5
+    assert len(queue) == 5
+    assert take_all(queue) == [3, 9, 1, 7, 5]
+
+
+def test_get_waits_and_stops():
+    async def run():
+        queue = FrameQueue()
+        stopped = False
+
+        getter = asyncio.create_task(queue.get(lambda: stopped))
+        await asyncio.sleep(0)
+        await queue.put(7)
+        assert await getter == 7
+
+        getter = asyncio.create_task(queue.get(lambda: stopped))
+        await asyncio.sleep(0)
+        stopped = True
+        await queue.notify()
+        assert await getter == None
+
+    asyncio.run(run())
+
+
+def test_peek_and_reprioritize():
+    queue = FrameQueue()
+    for frame in range(10):
+        queue.push(frame, frame % 3)
+
+    assert queue.peek() == 0
+    queue.remove(lambda frame: frame % 2 == 0)
+    assert sorted(queue) == [1, 3, 5, 7, 9]
+
+    queue.reprioritize(lambda frame: -frame)
+    assert queue.peek() == 9
+    assert take_all(queue) == [9, 7, 5, 3, 1]
+
+
+def test_ordered_find_and_pop_at():
+    queue = FrameQueue(ordered=True)
+    costs = {1: 5, 2: 9, 3: 2, 4: 3, 6: 8, 8: 1}
+    for frame, cost in costs.items():
+        queue.push(frame, (frame % 2, -cost))    # Two passes, the heaviest frames first within each.
+
+    # The heaviest frame of the first pass costing at most 4 is the first from that cost on.
+    position = queue.find((0, -4))
+    assert queue.priority_at(position) == (0, -3)
+    assert queue.pop_at(position) == 4
+    assert len(queue) == 5
+    assert 4 not in list(queue)
+
+    # If no frame of the pass is light enough, the first found is of the next pass and the lightest one is just before it.
+    position = queue.find((0, -0.5))
+    assert queue.priority_at(position) == (1, -5)
+    assert queue.pop_at(position - 1) == 8
+
+    # Taking items by their position doesn't upset the order of the others.
+    assert queue.peek() == 2
+    assert take_all(queue) == [2, 6, 1, 3]
+
+
+def test_ordered_queue_stays_consistent():
+    queue = FrameQueue(ordered=True)
+    for frame in range(20):
+        queue.push(frame, -frame)
+
+    taken = [queue.pop_at(queue.find(-10)), queue.get_nowait(), queue.pop_at(0)]
+    assert taken == [10, 19, 18]
+
+    queue.push(10, -10, front=True)
+    assert queue.remove(lambda frame: frame > 15) == 2
+    queue.reprioritize(lambda frame: frame)
+
+    assert len(queue) == 16
+    assert take_all(queue) == list(range(16))
+
+
+def test_get_with_pick():
+    async def run():
+        queue = FrameQueue(ordered=True)
+        for frame in range(5):
+            queue.push(frame, frame)
+
+        assert await queue.get(pick=lambda: queue.pop_at(len(queue) - 1)) == 4
+        assert await queue.get() == 0
+        assert len(queue) == 3
+
+    asyncio.run(run())
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from brpy_lib import (
+    decode_message,
+    encode_message,
+    receive_block,
+    receive_message,
+    send_block,
+    BINARY_MESSAGES,
+    BINARY_PREFIX,
+    BINARY_PROTOCOL,
+    CODECS,
+    COMPRESSION_BLOCK,
+    JSON_PROTOCOL,
+    Compressor,
+    RenderFrameResponse,
+    RenderRequest,
+    UploadChunk,
+)
+
+
+# A value for every field of the binary messages, picked to exercise the edges of their encoding.
+FIELD_VALUES = {
+    'port': 65535,
+    'size': 2 ** 40,
+    'offset': 2 ** 33 + 1,
+    'checksum': 2 ** 32 - 1,
+    'source': 12345,
+    'block_size': 4096,
+    'frame_size': 7,
+    'frame_number': -3,
+    'frame_count': 4,
+    'session': 'shot 010',
+    'hash': 'ab' * 32,
+    'delta': '',
+    'base': 'cd' * 32,
+    'codec': 'zlib',
+    'frames': [1, -2, 2 ** 31 - 1],
+    'render_format': 'OPEN_EXR',
+    'token': 'ünïcode',
+    'tiles': 4,
+    'sample_parts': 2,
+    'stats': {'stages': {'render': [1, 2, 3]}, 'children': []},
+    'error': "Blender crashed.",
+    'file_extension': 'exr',
+    'render_time': 1.25,
+}
+
+
+# Stands in for a connection, everything written to it can be read back from its reader.
+class Pipe:
+    def __init__(self):
+        self.reader = asyncio.StreamReader()
+        self.written = 0
+
+    def write(self, data):
+        self.reader.feed_data(data)
+        self.written += len(data)
+
+    def writelines(self, data):
+        for part in data:
+            self.write(part)
+
+    async def drain(self):
+        pass
+
+
+def round_trip(header, protocol):
+    async def send_and_receive():
+        pipe = Pipe()
+        pipe.write(encode_message(header, protocol))
+
+        return await receive_message(pipe.reader, protocol=protocol)
+
+    return asyncio.run(send_and_receive())
+
+
+def message_headers():
+    for key, value, (fixed_fields, fixed_struct), variable_fields, optional_fields in BINARY_MESSAGES:
+        header = {key: value}
+        for name in fixed_fields + variable_fields:
+            header[name] = FIELD_VALUES[name]
+
+        yield pytest.param(header, id=f'{value}-required')
+        if len(optional_fields) > 0:
+            yield pytest.param(dict(header, **{name: FIELD_VALUES[name] for name in optional_fields}), id=f'{value}-optional')
+
+
+@pytest.mark.parametrize('protocol', [JSON_PROTOCOL, BINARY_PROTOCOL])
+@pytest.mark.parametrize('header', list(message_headers()))
+def test_message_round_trip(header, protocol):
+    message_raw, received = round_trip(header, protocol)
+
+    assert received == header
+    assert message_raw == encode_message(header, protocol)    # Relays pass on the message as received.
+
+
+def test_every_optional_field_alone():
+    for code, (key, value, (fixed_fields, fixed_struct), variable_fields, optional_fields) in enumerate(BINARY_MESSAGES):
+        for name in optional_fields:
+            header = {key: value, name: FIELD_VALUES[name]}
+            header.update((name, FIELD_VALUES[name]) for name in fixed_fields + variable_fields)
+
+            message_raw = encode_message(header, BINARY_PROTOCOL)
+            size, message_code, flags = BINARY_PREFIX.unpack_from(message_raw)
+
+            assert message_code == code
+            assert size == len(message_raw) - 4
+            assert decode_message(message_code, flags, message_raw[BINARY_PREFIX.size:]) == header
+
+
+def test_message_classes():
+    render_request = RenderRequest('shot', 5, None, tiles=2).__dict__
+    assert round_trip(render_request, BINARY_PROTOCOL)[1] == dict(render_request, frames=[5])    # Single frames are sent as a list.
+
+    for header in (UploadChunk(0, 10, 20).__dict__, UploadChunk(0, 10, 20, 'zlib').__dict__, RenderFrameResponse(100, 1, 'png', render_time=0.5).__dict__):
+        assert round_trip(header, BINARY_PROTOCOL)[1] == header
+        assert json.loads(encode_message(header)[8:]) == header
+
+
+def send_and_receive_blocks(compressor, blocks):
+    async def run():
+        pipe = Pipe()
+        for block in blocks:
+            await send_block(pipe, block, compressor)
+
+        return [await receive_block(pipe.reader, compressor.codec) for block in blocks], pipe.written
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('codec', list(CODECS))
+def test_compressed_blocks(codec):
+    compressible = b'frame ' * 100000
+    received, sent_size = send_and_receive_blocks(Compressor([codec], [codec]), [compressible])
+
+    assert received == [compressible]
+    assert sent_size < len(compressible) / 2
+
+
+def test_incompressible_blocks_back_off():
+    compressor = Compressor(['zlib'], ['zlib'])
+    blocks = [os.urandom(200000) for index in range(6)]
+
+    received, sent_size = send_and_receive_blocks(compressor, blocks)
+
+    assert received == blocks
+    assert sent_size == sum(len(block) + COMPRESSION_BLOCK.size for block in blocks)
+    assert compressor.backoff > 1    # Compression is tried less and less often.
+
+
+def test_compressor_without_common_codec():
+    compressor = Compressor(['zlib'], ['lzma'])
+
+    assert compressor.codec == None
+    assert compressor.skip()
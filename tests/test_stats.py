@@ -0,0 +1,152 @@
+import re
+
+from brpy_lib import format_stats, FrameQueue, Histogram, Throughput, STATS_STAGES
+
+
+# A line of the text format of Prometheus, a metric name with its labels and a value.
+SAMPLE_LINE = re.compile(r'^(brpy_\w+)\{((?:\w+="[^"]*",?)+)\} (-?[0-9.e+-]+)$')
+
+
+def make_histogram(durations):
+    histogram = Histogram()
+    for duration in durations:
+        histogram.record(duration)
+
+    return histogram
+
+
+def node_stats(node, durations, children=()):
+    return {
+        'node': node,
+        'stages': {stage: make_histogram(durations).__dict__ for stage in STATS_STAGES},
+        'queued_frames': 3,
+        'workers': 4,
+        'busy_workers': 2,
+        'sent': {'bytes': 1000, 'rate': 250.4},
+        'links': {child['node']: {'bytes': 500, 'rate': 100} for child in children},
+        'children': list(children),
+    }
+
+
+def parse_samples(text):
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith('#'):
+            continue
+
+        match = SAMPLE_LINE.match(line)
+        assert match != None, line
+
+        name, labels, value = match.groups()
+        samples[name, labels] = float(value)
+
+    return samples
+
+
+def test_histogram_quantiles():
+    histogram = make_histogram([0.0015] * 50 + [0.1] * 40 + [10] * 10)
+
+    assert histogram.count() == 100
+    assert abs(histogram.total - 104.075) < 1e-9
+
+    # Quantiles are the upper bounds of their buckets, so they are at least the true value and less than twice of it.
+    for fraction, duration in ((0.5, 0.0015), (0.9, 0.1), (0.99, 10)):
+        assert duration <= histogram.quantile(fraction) < 2 * duration
+
+    assert Histogram().quantile(0.5) == 0
+
+
+def test_histogram_edges():
+    histogram = make_histogram([0, 0.0001, 10 ** 6])
+
+    assert histogram.counts[0] == 2
+    assert histogram.counts[-1] == 1    # Durations beyond the last bucket are counted in it.
+    assert histogram.quantile(1) == 2 ** (len(histogram.counts) - 1) / 1000
+
+
+def test_histogram_merge():
+    first = make_histogram([0.002, 0.004])
+    second = make_histogram([0.004, 1])
+
+    # Histograms are sent between nodes as their attributes.
+    first.merge(Histogram(**second.__dict__))
+
+    assert first.counts == make_histogram([0.002, 0.004, 0.004, 1]).counts
+    assert abs(first.total - 1.01) < 1e-9
+    assert second.count() == 2
+
+
+def test_queue_wait_time_is_recorded():
+    histogram = Histogram()
+    queue = FrameQueue(histogram)
+    queue.push(1)
+    queue.push(2)
+    queue.get_nowait()
+    queue.get_nowait()
+
+    assert histogram.count() == 2
+
+
+def test_throughput_counts_overlapping_transfers_once():
+    throughput = Throughput()
+    assert throughput.rate() == 0
+
+    throughput.start()
+    throughput.start()
+    throughput.stop(100)
+    throughput.stop(300)
+
+    assert throughput.bytes == 400
+    assert throughput.active == 0
+    assert throughput.rate() == 400 / throughput.busy_time
+
+
+def test_format_stats():
+    leaf = node_stats('leaf:9000', [0.5, 0.5])
+    unreachable = {'node': 'gone:9000', 'unreachable': True}
+    root = node_stats('root:9000', [0.001, 0.002], [leaf, unreachable])
+
+    samples = parse_samples(format_stats(root))
+
+    assert samples['brpy_up', 'node="root:9000"'] == 1
+    assert samples['brpy_up', 'node="leaf:9000"'] == 1
+    assert samples['brpy_up', 'node="gone:9000"'] == 0
+    assert not any('node="gone:9000"' in labels for name, labels in samples if name != 'brpy_up')
+
+    assert samples['brpy_queued_frames', 'node="root:9000"'] == 3
+    assert samples['brpy_busy_workers', 'node="leaf:9000"'] == 2
+    assert samples['brpy_sent_bytes_per_second', 'node="root:9000"'] == 250
+    assert samples['brpy_relayed_bytes', 'node="root:9000",child="leaf:9000"'] == 500
+    assert samples['brpy_relayed_bytes', 'node="root:9000",child="gone:9000"'] == 500    # The link is known even if the child isn't reachable.
+
+    assert samples['brpy_stage_seconds_count', 'node="leaf:9000",stage="render"'] == 2
+    assert samples['brpy_stage_seconds', 'node="leaf:9000",stage="render",quantile="0.5"'] == 0.512
+
+    # The tree sums up the stages of all reachable nodes.
+    for stage in STATS_STAGES:
+        assert samples['brpy_stage_seconds_count', f'node="tree",stage="{stage}"'] == 4
+        assert samples['brpy_stage_seconds_sum', f'node="tree",stage="{stage}"'] == 1.003
+        assert samples['brpy_stage_seconds', f'node="tree",stage="{stage}",quantile="0.99"'] == 0.512
+
+
+def test_metrics_text_shape():
+    text = format_stats(node_stats('root:9000', [0.25], [node_stats('leaf:9000', [])]))
+    lines = text.splitlines()
+
+    assert text.endswith('\n')
+    assert lines[0] == "# TYPE brpy_stage_seconds summary"
+
+    # Every sample is given once, and every stage of every node has all quantiles, its sum and its count.
+    samples = parse_samples(text)
+    assert len(samples) == len(lines) - 1
+
+    for node in ('root:9000', 'leaf:9000', 'tree'):
+        for stage in STATS_STAGES:
+            labels = f'node="{node}",stage="{stage}"'
+            for fraction in ('0.5', '0.9', '0.99'):
+                assert ('brpy_stage_seconds', f'{labels},quantile="{fraction}"') in samples
+            assert ('brpy_stage_seconds_sum', labels) in samples
+            assert ('brpy_stage_seconds_count', labels) in samples
+
+    assert samples['brpy_stage_seconds_count', 'node="leaf:9000",stage="send"'] == 0
+    assert samples['brpy_stage_seconds', 'node="leaf:9000",stage="send",quantile="0.5"'] == 0